@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 from optparse import OptionParser
 from scipy.stats import poisson, nbinom
+from scipy.special import gammaln
 from numpy import array
+import numpy as np
 from bisect import bisect_left, bisect_right
-import copy, math, os, pdb, random, subprocess, sys
+import collections, copy, filecmp, hashlib, itertools, json, math, multiprocessing, os, pdb, Queue, random, shutil, struct, subprocess, sys, time, zlib
 import pysam
-import bam_fragments, fdr, gff, stats
+import fdr, gff, stats
 
 ################################################################################
 # clip_peaks.py
@@ -30,6 +32,66 @@ out_dir = None
 verbose = None
 print_filtered_peaks = None
 
+# peak calling inputs shared by the genes processed in this process
+peak_calling = None
+
+# compiled annotation format, and the arrays saved in it
+annotation_version = 3
+annotation_arrays = ['chroms', 'strands', 'tx_ids', 'tx_gene_ids', 'tx_chroms', 'tx_strands', 'tx_fpkms', 'exon_offsets', 'exon_starts', 'exon_ends', 'junction_offsets', 'junctions', 'cluster_ids', 'cluster_offsets', 'cluster_txs', 'window_sizes', 'txome_sizes']
+
+# regions closer than this many bp are fetched together in sweep_reads
+sweep_gap = 10000
+
+# most bp of control reads filter_peaks_control positions at once
+control_block_span = 1000000
+
+# read position cache format, and the columns saved in it
+positions_version = 1
+positions_columns = [('positions','float64'), ('weights','float64'), ('multimap','bool')]
+
+# peak calling journal format
+journal_version = 1
+
+# gene cluster peaks cache format
+cluster_cache_version = 1
+
+# shared Cufflinks cache format, and the Cufflinks files saved in it
+cufflinks_cache_version = 2
+cufflinks_cache_files = ['transcripts.gtf', 'isoforms.fpkm_tracking']
+
+# BAM preflight sidecar format
+preflight_version = 3
+
+# EM abundance estimation: relative change in each transcript's fragment
+# count (or absolute change, under one fragment) at which to stop, and the
+# most iterations to run
+em_tolerance = 1e-4
+em_max_iterations = 1000
+
+# transcript abundance tables read by read_abundances: the format, and its
+# columns for the transcript_id, FPKM, or else the fragment count and
+# effective length to compute FPKM from, and the status marking failures
+abundance_formats = [('Cufflinks', 'tracking_id', 'FPKM', None, None, 'FPKM_status'),
+                     ('RSEM', 'transcript_id', 'FPKM', None, None, None),
+                     ('Salmon', 'Name', None, 'NumReads', 'EffectiveLength', None),
+                     ('kallisto', 'target_id', None, 'est_counts', 'eff_length', None)]
+
+# window stats columns, and zlib level for each cluster's chunk
+window_stats_dtype = [('start','<i4'), ('count','<i4'), ('p','<f8'), ('lambda','<f8')]
+window_stats_level = 1
+
+# cost model coefficients for scheduling gene clusters (seconds)
+cost_per_bp = 2e-6
+cost_per_isoform = 1e-4
+cost_per_bam_kb = 5e-4
+
+# scan statistic p-values shared across genes, keyed by (k, w, T, lambda)
+scan_pval_cache = {}
+scan_pval_cache_max = 2000000
+
+# scan statistic critical counts, keyed by (w, T, sig_p, lambda)
+scan_crit_cache = {}
+
 ################################################################################
 # main
 ################################################################################
@@ -41,25 +103,32 @@ def main():
     parser.add_option('-a', dest='abundance_bam', help='BAM file to inform transcript abundance estimates [Default: <clip_bam>]')
     parser.add_option('-c', dest='control_bam', help='BAM file to inform control comparisons [Default: None]')
     parser.add_option('-o', dest='out_dir', default='peaks', help='Output directory [Default: %default]')
+    parser.add_option('--resume', dest='resume', action='store_true', default=False, help='Resume an interrupted run in the output directory, skipping the gene clusters it finished [Default: %default]')
 
     # peak calling options
-    parser.add_option('-w', dest='window_size', type='int', default=50, help='Window size for scan statistic [Default: %default]')
-    parser.add_option('-p', dest='p_val', type='float', default=.01, help='P-value required of window scan statistic tests [Default: %default]')
+    parser.add_option('-w', dest='window_size', default='50', help='Window size for scan statistic, or a comma-separated list of sizes to scan, the first of which estimates the control overdispersion [Default: %default]')
+    parser.add_option('-p', dest='p_val', default='0.01', help='P-value required of window scan statistic tests, or a comma-separated list of cutoffs [Default: %default]')
     parser.add_option('-m', '--max_multimap_fraction', dest='max_multimap_fraction', type='float', default=0.3, help='Maximum proportion of the read count that can be contributed by multimapping reads [Default: %default]')
     parser.add_option('-f', dest='print_filtered_peaks', action='store_true', default=False, help='Print peaks filtered at each step [Default: %default]')
     parser.add_option('-i', '--ignore', dest='ignore_bed', help='Ignore peaks overlapping troublesome regions in the given BED file')
     parser.add_option('-u', '--unstranded', dest='unstranded', action='store_true', default=False, help='Sequencing is unstranded [Default: %default]')
+    parser.add_option('--cache_positions', dest='cache_positions', default=False, action='store_true', help='Cache the read positions for each gene cluster in the Cufflinks output directory (or the output directory with --quant), and reuse them in later runs [Default: %default]')
+    parser.add_option('--cache_clusters', dest='cache_clusters', default=False, action='store_true', help='Cache the peaks for each gene cluster in the output directory, and reuse them in later runs for clusters whose transcripts, FPKMs, and reads are unchanged [Default: %default]')
 
     # cufflinks options
     parser.add_option('--cuff', dest='cuff_out_dir', help='Cufflinks output directory to estimate the model parameters from.')
     parser.add_option('--compatible-hits-norm', dest='compatible_hits_norm', action='store_true', default=True, help='Count only fragments compatible with the reference transcriptome [Default: %default]')
     parser.add_option('--total-hits-norm', dest='total_hits_norm', action='store_true', default=False, help='Count all mapped fragments [Default: %default]')
-    parser.add_option('-t', dest='threads', type='int', default=1, help='Number of threads to use [Default: %default]')
+    parser.add_option('--quant', dest='quant_file', help='Transcript abundances for the reference GTF from Salmon (quant.sf), kallisto (abundance.tsv), RSEM (isoforms.results), or Cufflinks (isoforms.fpkm_tracking), instead of running Cufflinks')
+    parser.add_option('--em', dest='em', action='store_true', default=False, help='Estimate transcript abundances for the reference GTF with a built-in EM, instead of running Cufflinks [Default: %default]')
+    parser.add_option('-t', dest='threads', type='int', default=1, help='Number of threads to use for Cufflinks and peak calling [Default: %default]')
+    parser.add_option('--cuff_cache', dest='cuff_cache', help='Directory shared across runs that caches the abundances estimated for each abundance BAM, GTF, and Cufflinks parameters')
+    parser.add_option('--cuff_cache_size', dest='cuff_cache_size', type='float', default=20, help='Maximum size of the Cufflinks cache in GB, evicting the least recently used runs beyond it [Default: %default]')
 
     # debug options
     parser.add_option('-v', '--verbose', dest='verbose', action='store_true', default=False, help='Verbose output [Default: %default]')
     parser.add_option('-g', '--gene', dest='gene_only', help='Call peaks on the specified gene only')
-    parser.add_option('--print_windows', dest='print_windows', default=False, action='store_true', help='Print statistics for all windows [Default: %default]')
+    parser.add_option('--print_windows', dest='print_windows', default=False, action='store_true', help='Save statistics for all windows to window_stats.bin, indexed by window_stats.index [Default: %default]')
 
     (options,args) = parser.parse_args()
 
@@ -72,6 +141,17 @@ def main():
     if options.compatible_hits_norm == options.total_hits_norm:
         parser.error('Must choose one of compatible-hits-norm or total-hits-norm')
 
+    if options.cuff_out_dir and options.quant_file:
+        parser.error('Must choose one of --cuff or --quant')
+
+    if options.em and (options.cuff_out_dir or options.quant_file):
+        parser.error('Must choose one of --em, --cuff, or --quant')
+
+    # scan every combination of window size and p-value
+    window_sizes = [int(w) for w in options.window_size.split(',')]
+    p_vals = [float(p) for p in options.p_val.split(',')]
+    scales = [(window_size, p_val) for window_size in window_sizes for p_val in p_vals]
+
     # set globals
     global out_dir
     out_dir = options.out_dir
@@ -92,68 +172,117 @@ def main():
     if options.abundance_bam == None:
         options.abundance_bam = clip_bam
 
-    if not options.cuff_out_dir:
-        # run Cufflinks on new gtf file and abundance BAM
+    if options.quant_file:
+        # reference transcripts with the given abundances
+        options.cuff_out_dir = out_dir
+        write_exons_gtf(ref_gtf, '%s/transcripts.gtf' % out_dir)
+        abundance_file = options.quant_file
+
+    elif options.cuff_out_dir:
+        abundance_file = '%s/isoforms.fpkm_tracking' % options.cuff_out_dir
+
+    else:
+        # read length from the abundance BAM's preflight, the same on every
+        # run for the same BAM
+        abundance_preflight = preflight_bam(options.abundance_bam)
+        read_length = abundance_preflight['read_length']
+        read_sd = abundance_preflight['read_sd']
+
+        options.cuff_out_dir = out_dir
+
         if options.compatible_hits_norm:
             hits_norm = '--compatible-hits-norm'
         else:
             hits_norm = '--total-hits-norm'
-            
-        # compute read length
-        read_length, read_sd = estimate_read_stats(options.abundance_bam)
 
-        options.cuff_out_dir = out_dir
-        subprocess.call('cufflinks -u -m %d -s %d -o %s -p %d %s -G %s %s' % (read_length, read_sd, options.cuff_out_dir, options.threads, hits_norm, ref_gtf, options.abundance_bam), shell=True)
+        # look for an earlier run on the same inputs
+        cache_key = None
+        if options.cuff_cache:
+            cache_key = cufflinks_cache_key(options.abundance_bam, ref_gtf, options.em, options.em and not options.unstranded, hits_norm)
+
+        if cache_key and load_cufflinks_cache(options.cuff_cache, cache_key, options.cuff_out_dir):
+            if verbose:
+                print >> sys.stderr, 'Reusing abundances cached in %s/%s' % (options.cuff_cache, cache_key)
+
+        else:
+            if options.em:
+                # write Cufflinks' output files from the built-in EM
+                estimate_abundances(options.abundance_bam, ref_gtf, read_length, not options.unstranded, options.compatible_hits_norm, options.cuff_out_dir)
+
+            else:
+                # run Cufflinks on new gtf file and abundance BAM
+                subprocess.call('cufflinks -u -m %d -s %d -o %s -p %d %s -G %s %s' % (read_length, read_sd, options.cuff_out_dir, options.threads, hits_norm, ref_gtf, options.abundance_bam), shell=True)
 
-    # store transcripts
-    transcripts = read_genes('%s/transcripts.gtf'%options.cuff_out_dir, key_id='transcript_id')
+            if cache_key:
+                save_cufflinks_cache(options.cuff_cache, cache_key, options.cuff_out_dir, int(options.cuff_cache_size*(1<<30)))
 
-    # merge overlapping genes
-    g2t_merge, antisense_clusters = merged_g2t('%s/transcripts.gtf'%options.cuff_out_dir, options.unstranded)
+        abundance_file = '%s/isoforms.fpkm_tracking' % options.cuff_out_dir
 
-    if options.unstranded:
-        # alter strands
-        ambiguate_strands(transcripts, g2t_merge, antisense_clusters)
+    # load the compiled annotation, or compile it
+    annotation_dir = '%s/clip_peaks_annotation.%s' % (options.cuff_out_dir, annotation_key(['%s/transcripts.gtf'%options.cuff_out_dir, abundance_file], options.unstranded, window_sizes))
+    if os.path.isdir(annotation_dir):
+        transcripts, g2t_merge, txome_sizes = load_annotation(annotation_dir)
 
-    # set junctions
-    set_transcript_junctions(transcripts)
+    else:
+        # store transcripts
+        transcripts = read_genes('%s/transcripts.gtf'%options.cuff_out_dir, key_id='transcript_id')
+
+        # merge overlapping genes
+        g2t_merge, antisense_clusters = merged_g2t('%s/transcripts.gtf'%options.cuff_out_dir, options.unstranded)
+
+        if options.unstranded:
+            # alter strands
+            ambiguate_strands(transcripts, g2t_merge, antisense_clusters)
+
+        # set junctions
+        set_transcript_junctions(transcripts)
 
-    # set transcript FPKMs
-    set_transcript_fpkms(transcripts, options.cuff_out_dir)
+        # set transcript FPKMs
+        set_transcript_fpkms(transcripts, abundance_file)
+
+        # compute # of tests we will perform at each window size
+        txome_sizes = {}
+        for window_size in window_sizes:
+            txome_sizes[window_size] = transcriptome_size(transcripts, g2t_merge, window_size)
+
+        # save for later runs
+        save_annotation(annotation_dir, transcripts, g2t_merge, txome_sizes)
 
     if verbose:
         print >> sys.stderr, 'Computing global statistics...'
 
+    # index and count the CLIP and control BAMs
+    preflight_bam_files = [clip_bam]
+    if options.control_bam:
+        preflight_bam_files.append(options.control_bam)
+    preflights = preflight_bams(preflight_bam_files, '%s/transcripts.gtf'%options.cuff_out_dir, options.threads)
+
     if options.compatible_hits_norm:
-        # count transcriptome CLIP reads (overestimates small RNA single ended reads by counting antisense)
-        subprocess.call('intersectBed -abam %s -b %s > %s/clip.bam' % (clip_bam, '%s/transcripts.gtf'%options.cuff_out_dir, out_dir), shell=True)
-        clip_reads = bam_fragments.count('%s/clip.bam' % out_dir)
-        os.remove('%s/clip.bam' % out_dir)
+        # count transcriptome reads (overestimates small RNA single ended reads by counting antisense)
+        count_key = 'compatible_fragments'
     else:
-        # count CLIP reads
-        clip_reads = bam_fragments.count(clip_bam)
+        # count all reads
+        count_key = 'fragments'
+
+    clip_reads = preflights[0][count_key]
     if verbose:
         print >> sys.stderr, '\t%d CLIP reads' % clip_reads
+        print >> sys.stderr, '\t%.1f%% multimapping CLIP alignments' % (100*multimap_fraction(preflights[0]))
+        for window_size in window_sizes:
+            print >> sys.stderr, '\t%d transcriptome windows of %d bp' % (txome_sizes[window_size], window_size)
 
-    # compute # of tests we will perform
-    txome_size = transcriptome_size(transcripts, g2t_merge, options.window_size)
-    if verbose:
-        print >> sys.stderr, '\t%d transcriptome windows' % txome_size
+    normalization_factor = None
+    if options.control_bam:
+        control_reads = preflights[1][count_key]
+        if verbose:
+            print >> sys.stderr, '\t%d Control reads' % control_reads
+
+        # compute normalization factor for the control
+        normalization_factor = clip_reads / control_reads
 
     ############################################
     # process genes
     ############################################
-    # index
-    subprocess.call('samtools index %s' % clip_bam, shell=True)
-
-    # open clip-seq bam
-    clip_in = pysam.Samfile(clip_bam, 'rb')
-    
-    # open window output
-    windows_out = None
-    if options.print_windows:
-        windows_out = open('%s/window_stats.txt' % out_dir, 'w')
-
     # possibly limit genes to examine
     if options.gene_only:
         gene_ids = []
@@ -166,109 +295,167 @@ def main():
     else:
         gene_ids = g2t_merge.keys()
 
-    # initalize peak list
-    putative_peaks = []
-    multimap_peaks = []
-
-    # for each gene
-    for gene_id in gene_ids:
+    # estimate each gene's cost
+    cluster_costs = estimate_cluster_costs(gene_ids, g2t_merge, transcripts, bam_index_offsets(clip_bam))
+
+    # load the cached read positions, or position the reads and cache them
+    positions_dirs = [None, None]
+    if options.cache_positions:
+        gene_regions = []
+        for gene_id in gene_ids:
+            gene_transcripts = {}
+            for tid in g2t_merge[gene_id]:
+                gene_transcripts[tid] = transcripts[tid]
+            (gchrom, gstrand, gstart, gend) = gene_attrs(gene_transcripts)
+            gene_regions.append((gchrom, gstart, gend, gstrand))
+
+        # CLIP reads keep zero mapq reads, as in peak calling
+        for bi, (bam_file, mapq_zero) in enumerate([(clip_bam, True), (options.control_bam, False)]):
+            if bam_file:
+                positions_dir = '%s/clip_peaks_positions.%s' % (options.cuff_out_dir, positions_key(bam_file, gene_ids, gene_regions, mapq_zero))
+                if not os.path.isdir(positions_dir):
+                    if verbose:
+                        print >> sys.stderr, 'Caching read positions from %s...' % bam_file
+                    save_positions(positions_dir, bam_file, gene_ids, gene_regions, mapq_zero, options.threads)
+                if os.path.isdir(positions_dir):
+                    positions_dirs[bi] = positions_dir
+
+        # the sweeps pair each gene's CLIP and control reads, so use the cache
+        # for both or neither
+        if options.control_bam and positions_dirs[1] is None:
+            positions_dirs[0] = None
+
+    # journal finished genes, describing the inputs that determine their peaks
+    journal_dir = '%s/journal' % out_dir
+    manifest = {'version':journal_version, 'clip_bam':file_fingerprint(clip_bam), 'control_bam':None,
+                'annotation':os.path.abspath(annotation_dir), 'window_sizes':window_sizes, 'p_vals':p_vals,
+                'gene_only':options.gene_only, 'compatible_hits_norm':options.compatible_hits_norm, 'verbose':verbose}
+    if options.control_bam:
+        manifest['control_bam'] = file_fingerprint(options.control_bam)
+
+    # skip genes finished by the interrupted run
+    journal_results = {}
+    if options.resume:
+        journal_results = load_journal(journal_dir, manifest)
+        if journal_results is None:
+            print >> sys.stderr, 'WARNING: Journal in %s does not match this run; starting over' % journal_dir
+            journal_results = {}
+        elif verbose:
+            print >> sys.stderr, 'Resuming with %d of %d genes finished' % (len(journal_results), len(gene_ids))
+    if not journal_results:
+        start_journal(journal_dir, manifest)
+
+    # reuse the cached peaks of unchanged clusters
+    done_results = dict(journal_results)
+    if options.cache_clusters:
+        cache_file = '%s/clip_peaks_clusters.jsonl' % out_dir
+        cluster_cache = load_cluster_cache(cache_file)
+
+        cache_bams = [clip_bam]
+        if options.control_bam:
+            cache_bams.append(options.control_bam)
+        run_key = 'clip_reads=%r txome_sizes=%s window_sizes=%s p_vals=%s norm_factor=%r verbose=%d' % (clip_reads, ','.join(['%d:%d' % (w,txome_sizes[w]) for w in window_sizes]), ','.join([str(w) for w in window_sizes]), ','.join([repr(p) for p in p_vals]), normalization_factor, verbose)
+        keys = cluster_keys(gene_ids, g2t_merge, transcripts, cache_bams, run_key)
+
+        cached_clusters = 0
+        for gi in range(len(gene_ids)):
+            if keys[gi] in cluster_cache and gene_ids[gi] not in done_results:
+                done_results[gene_ids[gi]] = cluster_cache[keys[gi]][1]
+                cached_clusters += 1
         if verbose:
-            print >> sys.stderr, 'Processing %s...' % gene_id
-
-        # make a more focused transcript hash for this gene
-        gene_transcripts = {}
-        for tid in g2t_merge[gene_id]:
-            gene_transcripts[tid] = transcripts[tid]
+            print >> sys.stderr, 'Reusing cached peaks for %d of %d gene clusters' % (cached_clusters, len(gene_ids))
 
-        # obtain basic gene attributes
-        (gchrom, gstrand, gstart, gend) = gene_attrs(gene_transcripts)
+    call_gis = [gi for gi in range(len(gene_ids)) if gene_ids[gi] not in done_results]
+    call_gene_ids = [gene_ids[gi] for gi in call_gis]
 
-        if verbose:
-            print >> sys.stderr, '\tFetching alignments...'
+    init_args = (clip_bam, transcripts, g2t_merge, call_gene_ids, window_sizes, p_vals, clip_reads, txome_sizes, options.control_bam, normalization_factor, positions_dirs[0], positions_dirs[1], journal_dir)
 
-        # choose a single event position and weight the reads
-        read_pos_weights = position_reads(clip_in, gchrom, gstart, gend, gstrand, mapq_zero=True)
+    if options.threads <= 1:
+        # call peaks on all genes here
+        init_peak_calling(*init_args)
 
-        if verbose:
-            print >> sys.stderr, '\tCounting and computing in windows...'
+        windows_file = None
+        if options.print_windows:
+            windows_file = '%s/window_stats.0.bin' % out_dir
 
-        # count reads and compute p-values in windows
-        window_stats = count_windows(clip_in, options.window_size, read_pos_weights, gene_transcripts, gstart, gend, clip_reads, txome_size, windows_out)
+        call_results = call_peaks_batch((call_gene_ids, windows_file))
 
-        if verbose:
-            print >> sys.stderr, '\tRefining peaks...'
+        # put window output in gene order
+        if options.print_windows:
+            combine_window_stats([(windows_file, cr[1], cr[2]) for cr in call_results], call_gene_ids)
 
-        # post-process windows to peaks
-        peaks = windows2peaks(read_pos_weights, gene_transcripts, gstart, window_stats, options.window_size, options.p_val, clip_reads, txome_size)            
+    else:
+        # call peaks in parallel, largest genes first
+        call_results = call_peaks_parallel(call_gene_ids, [cluster_costs[gi] for gi in call_gis], options.threads, options.print_windows, init_args)
 
-        # save peaks
-        for pstart, pend, pfrags, pmmfrac, ppval in peaks:
-            putative_peaks.append(Peak(gchrom, pstart, pend, gstrand, gene_id, pfrags, pmmfrac, ppval))
+    # merge with the journaled and cached genes
+    gene_results = [done_results.get(gene_id) for gene_id in gene_ids]
+    for ci in range(len(call_gis)):
+        gene_results[call_gis[ci]] = call_results[ci]
 
-    clip_in.close()
+    if options.cache_clusters:
+        save_cluster_cache(cache_file, cluster_cache, gene_ids, keys, gene_results)
 
-    ############################################
-    # filter peaks using ignore BED
-    ############################################
-    if options.ignore_bed:
-        putative_peaks = filter_peaks_ignore(putative_peaks, options.ignore_bed)
+    # log predicted and actual costs
+    if verbose:
+        costs_out = open('%s/cluster_costs.txt' % out_dir, 'w')
+        for gi in range(len(gene_ids)):
+            cols = (gene_ids[gi],) + cluster_costs[gi] + (gene_results[gi][3],)
+            print >> costs_out, '%s\t%d\t%d\t%.1f\t%.4f\t%.4f' % cols
+        costs_out.close()
 
-    ############################################
-    # filter peaks using the control
-    ############################################
     if options.control_bam:
-        # index
-        subprocess.call('samtools index %s' % options.control_bam, shell=True)
-
-        if options.compatible_hits_norm:
-            # count transcriptome control reads
-            subprocess.call('intersectBed -abam %s -b %s/transcripts.gtf > %s/control.bam' % (options.control_bam, options.cuff_out_dir, out_dir), shell=True)
-            control_reads = bam_fragments.count('%s/control.bam' % out_dir)
-            os.remove('%s/control.bam' % out_dir)
-        else:
-            # count countrol reads
-            control_reads = bam_fragments.count(options.control_bam)
-        if verbose:
-            print >> sys.stderr, '\t%d Control reads' % control_reads
-
-        # compute normalization factor for the control
-        normalization_factor = clip_reads / control_reads
-
-        # estimate overdispersion
+        # estimate overdispersion from the windows compared during peak calling
         if verbose:
             print >> sys.stderr, 'Estimating overdispersion...'
-        overdispersion = estimate_overdispersion(clip_bam, options.control_bam, g2t_merge, transcripts, options.window_size, normalization_factor)
+        overdispersion = estimate_overdispersion([gr[4] for gr in gene_results])
         if verbose:
             print >> sys.stderr, 'Overdisperion estimated to be %f' % overdispersion
 
-        # filter peaks 
-        if verbose:
-            print >> sys.stderr, 'Filtering peaks using control BAM...'
-        final_peaks = filter_peaks_control(putative_peaks, options.p_val, overdispersion, options.control_bam, normalization_factor)
+    for si in range(len(scales)):
+        window_size, p_val = scales[si]
 
-    else:
-        final_peaks = putative_peaks
+        # name output files by scale, if there are several
+        scale_suffix = ''
+        if len(scales) > 1:
+            scale_suffix = '_w%d_p%g' % (window_size, p_val)
 
-    ############################################
-    # output peaks
-    ############################################
-    peaks_out = open('%s/peaks.gff' % out_dir, 'w')
-    if verbose or print_filtered_peaks:
-        mm_peaks_out = open('%s/filtered_peaks_multimap.gff' % out_dir, 'w')
+        # save peaks
+        putative_peaks = PeakTable.build(itertools.chain(*[gr[0][si] for gr in gene_results]))
+
+        ############################################
+        # filter peaks using ignore BED
+        ############################################
+        if options.ignore_bed:
+            putative_peaks = filter_peaks_ignore(putative_peaks, options.ignore_bed, scale_suffix)
+
+        ############################################
+        # filter peaks using the control
+        ############################################
+        if options.control_bam:
+            # filter peaks 
+            if verbose:
+                print >> sys.stderr, 'Filtering peaks using control BAM...'
+            final_peaks = filter_peaks_control(putative_peaks, p_val, overdispersion, options.control_bam, normalization_factor, scale_suffix)
 
-    peak_id = 1
-    for peak in final_peaks:
+        else:
+            final_peaks = putative_peaks
+
+        ############################################
+        # output peaks
+        ############################################
         # filter out multimap-dominated peaks
-        if peak.mm_frac <= options.max_multimap_fraction:
-            peak.id = peak_id
-            print >> peaks_out, peak.gff_str()
-            peak_id += 1
-        elif verbose or print_filtered_peaks:
-            print >> mm_peaks_out, peak.gff_str()
-
-    peaks_out.close()
-    if verbose or print_filtered_peaks:
-        mm_peaks_out.close()
+        mm_pass = (final_peaks.peaks['mm_frac'] <= options.max_multimap_fraction)
+
+        output_peaks = final_peaks.subset(mm_pass)
+        peaks_out = open('%s/peaks%s.gff' % (out_dir,scale_suffix), 'w')
+        write_lines(peaks_out, output_peaks.gff_lines(ids=range(1,len(output_peaks)+1)))
+        peaks_out.close()
+
+        if verbose or print_filtered_peaks:
+            mm_peaks_out = open('%s/filtered_peaks_multimap%s.gff' % (out_dir,scale_suffix), 'w')
+            write_lines(mm_peaks_out, final_peaks.subset(~mm_pass).gff_lines())
+            mm_peaks_out.close()
 
 
 ################################################################################
@@ -289,6 +476,511 @@ def ambiguate_strands(transcripts, g2t, antisense_clusters):
                 transcripts[tid].strand = '*'
 
 
+################################################################################
+# annotation_key
+#
+# Hash the annotation files and the options that change the compiled
+# annotation, to name its cache.
+#
+# Input
+#  annotation_files: Transcripts GTF and abundance table.
+#  unstranded:       Sequencing is unstranded.
+#  window_sizes:     Scan statistic window sizes.
+#
+# Output
+#  key:              Hex digest identifying the compiled annotation.
+################################################################################
+def annotation_key(annotation_files, unstranded, window_sizes):
+    key_hash = hashlib.sha1()
+    key_hash.update('annotation_v%d unstranded=%d window_sizes=%s' % (annotation_version, unstranded, ','.join([str(w) for w in sorted(window_sizes)])))
+
+    for annotation_file in annotation_files:
+        hash_file(key_hash, annotation_file)
+
+    return key_hash.hexdigest()[:16]
+
+
+################################################################################
+# bam_index_offsets
+#
+# Read the linear index from a BAM file's .bai, which gives the virtual file
+# offset of the first alignment overlapping each 16 kb bin of a chromosome.
+# Differences between offsets estimate how much BAM lies in a region without
+# decompressing it.
+#
+# Input
+#  bam_file:      Indexed BAM file.
+#
+# Output
+#  index_offsets: Hash mapping chromosomes to arrays of virtual offsets for
+#                  each 16 kb bin, filled forward over empty bins, and ending
+#                  with the offset after the chromosome's last alignment when
+#                  the index records it. Empty if the index can't be read.
+################################################################################
+def bam_index_offsets(bam_file):
+    index_offsets = {}
+
+    try:
+        bam_in = pysam.Samfile(bam_file, 'rb')
+        references = bam_in.references
+        bam_in.close()
+        bai = open('%s.bai' % bam_file, 'rb').read()
+    except (IOError, ValueError):
+        return index_offsets
+
+    if bai[:4] != 'BAI\1':
+        return index_offsets
+
+    n_ref = struct.unpack_from('<i', bai, 4)[0]
+    bo = 8
+    for ri in range(n_ref):
+        # skip bins, except the pseudo-bin locating the chromosome's alignments
+        ref_end = []
+        n_bin = struct.unpack_from('<i', bai, bo)[0]
+        bo += 4
+        for bi in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', bai, bo)
+            if bin_id == 37450 and n_chunk == 2:
+                ref_end = [struct.unpack_from('<Q', bai, bo+16)[0]]
+            bo += 8 + 16*n_chunk
+
+        # read linear index
+        n_intv = struct.unpack_from('<i', bai, bo)[0]
+        bo += 4
+        ioffsets = np.frombuffer(bai, dtype='<u8', count=n_intv, offset=bo).astype('int64')
+        bo += 8*n_intv
+
+        if n_intv > 0:
+            index_offsets[references[ri]] = np.maximum.accumulate(np.append(ioffsets, ref_end).astype('int64'))
+
+    return index_offsets
+
+
+################################################################################
+# cached_read_pos_weights
+#
+# Input
+#  positions:        Cached read positions from load_positions.
+#  gene_id:          Merged gene_id.
+#
+# Output
+#  read_pos_weights: Sorted list of read alignment (position, weight, multimap)
+#                     tuples, as positioned when the cache was saved.
+################################################################################
+def cached_read_pos_weights(positions, gene_id):
+    pstart, pend = positions['index'][gene_id]
+    return zip(positions['positions'][pstart:pend].tolist(), positions['weights'][pstart:pend].tolist(), positions['multimap'][pstart:pend].tolist())
+
+
+################################################################################
+# cached_sweep
+#
+# Input
+#  positions:        Cached read positions from load_positions.
+#  gene_ids:         List of merged gene_id's.
+#  regions:          List of (chrom, start, end, strand) tuples for the genes.
+#
+# Output
+#  (gi, read_pos_weights) tuples, yielded in sweep_order like sweep_reads.
+################################################################################
+def cached_sweep(positions, gene_ids, regions):
+    for gi in sweep_order(regions):
+        yield gi, cached_read_pos_weights(positions, gene_ids[gi])
+
+
+################################################################################
+# call_peaks_batch
+#
+# Call peaks in a batch of merged gene clusters, using the inputs set by
+# init_peak_calling. Each batch opens its own handle on the CLIP BAM, so that
+# batches can run in separate processes, and positions the reads for all of
+# its genes in one sweep over the BAM. Genes are processed in coordinate order,
+# but returned in the given order. With a control BAM, the control reads are
+# positioned in a parallel sweep and compared to the CLIP reads to estimate
+# the overdispersion. Cached read positions replace the sweeps. Each gene's
+# results are appended to this process's journal as they finish.
+#
+# Input
+#  batch:        Tuple of a list of gene_id's and a window stats file name (or
+#                 None).
+#
+# Output
+#  gene_results: List of (scale_peak_tuples, windows_offset, windows_bytes,
+#                 seconds, od_stats) tuples for each gene in order, locating
+#                 the gene's window stats in the file. scale_peak_tuples are
+#                 from call_peaks_gene, and od_stats from overdispersion_stats
+#                 at the first window size (or None without a control).
+################################################################################
+def call_peaks_batch(batch):
+    gene_ids, windows_file = batch
+    pc = peak_calling
+
+    # open clip-seq bam
+    clip_in = None
+    if pc['clip_positions'] is None:
+        clip_in = pysam.Samfile(pc['clip_bam'], 'rb')
+
+    # open window output
+    windows_out = None
+    if windows_file:
+        windows_out = open(windows_file, 'wb')
+
+    # open journal
+    journal_out = None
+    if pc['journal_dir']:
+        journal_out = open('%s/genes.%d.jsonl' % (pc['journal_dir'],os.getpid()), 'a')
+
+    # collect gene regions
+    gene_regions = []
+    for gene_id in gene_ids:
+        gene_transcripts = {}
+        for tid in pc['g2t'][gene_id]:
+            gene_transcripts[tid] = pc['transcripts'][tid]
+        (gchrom, gstrand, gstart, gend) = gene_attrs(gene_transcripts)
+        gene_regions.append((gchrom, gstart, gend, gstrand))
+
+    gene_results = [None]*len(gene_ids)
+
+    # sweep the control alongside; both sweeps yield genes in sweep_order
+    if pc['clip_positions'] is None:
+        clip_sweep = sweep_reads(clip_in, gene_regions, mapq_zero=True)
+    else:
+        clip_sweep = cached_sweep(pc['clip_positions'], gene_ids, gene_regions)
+
+    control_in = None
+    if not pc['control_bam']:
+        control_sweep = itertools.repeat((None,None))
+    elif pc['control_positions'] is None:
+        control_in = pysam.Samfile(pc['control_bam'], 'rb')
+        control_sweep = sweep_reads(control_in, gene_regions)
+    else:
+        control_sweep = cached_sweep(pc['control_positions'], gene_ids, gene_regions)
+
+    # for each gene, as its reads are positioned
+    gene_t0 = time.time()
+    for (gi, read_pos_weights), (gi_control, control_read_pos_weights) in itertools.izip(clip_sweep, control_sweep):
+        if pc['control_bam'] and gi_control != gi:
+            raise ValueError('Control sweep reached %s while the CLIP sweep reached %s' % (gene_ids[gi_control], gene_ids[gi]))
+
+        windows_offset = 0
+        if windows_out:
+            windows_offset = windows_out.tell()
+
+        scale_peak_tuples = call_peaks_gene(clip_in, gene_ids[gi], windows_out, read_pos_weights)
+
+        windows_bytes = 0
+        if windows_out:
+            windows_bytes = windows_out.tell() - windows_offset
+
+        od_stats = None
+        if pc['control_bam']:
+            (gchrom, gstart, gend, gstrand) = gene_regions[gi]
+            od_stats = overdispersion_stats(read_pos_weights, control_read_pos_weights, gstart, gend, pc['window_sizes'][0], pc['norm_factor'])
+
+        gene_results[gi] = (scale_peak_tuples, windows_offset, windows_bytes, time.time()-gene_t0, od_stats)
+        gene_t0 = time.time()
+
+        if journal_out:
+            journal_gene(journal_out, gene_ids[gi], gene_results[gi])
+
+    if clip_in:
+        clip_in.close()
+    if control_in:
+        control_in.close()
+    if journal_out:
+        journal_out.close()
+    if windows_out:
+        windows_out.close()
+
+    return gene_results
+
+
+################################################################################
+# call_peaks_gene
+#
+# Call peaks in a single merged gene cluster at each window size and p-value
+# set by init_peak_calling, scanning the reads and coverage once positioned.
+#
+# Input
+#  clip_in:           Open pysam BAM file for clip-seq alignments.
+#  gene_id:           Merged gene_id to process.
+#  windows_out:       Open file if we should save window stats for the first
+#                      scale, or None.
+#  read_pos_weights:  Positioned reads for the gene, if already fetched.
+#
+# Output
+#  scale_peak_tuples: List for each (window size, p-value) scale, in order, of
+#                      lists of (chrom,start,end,strand,gene_id,frags,mm_frac,
+#                      scan_p) tuples for peaks.
+################################################################################
+def call_peaks_gene(clip_in, gene_id, windows_out, read_pos_weights=None):
+    pc = peak_calling
+
+    if verbose:
+        print >> sys.stderr, 'Processing %s...' % gene_id
+
+    # make a more focused transcript hash for this gene
+    gene_transcripts = {}
+    for tid in pc['g2t'][gene_id]:
+        gene_transcripts[tid] = pc['transcripts'][tid]
+
+    # obtain basic gene attributes
+    (gchrom, gstrand, gstart, gend) = gene_attrs(gene_transcripts)
+
+    if read_pos_weights is None:
+        if verbose:
+            print >> sys.stderr, '\tFetching alignments...'
+
+        # choose a single event position and weight the reads
+        read_pos_weights = position_reads(clip_in, gchrom, gstart, gend, gstrand, mapq_zero=True)
+
+    # share the read and coverage tracks across scales
+    tracks = gene_tracks(read_pos_weights, gene_transcripts, gstart, gend)
+
+    scale_peak_tuples = []
+    for window_size in pc['window_sizes']:
+        for sig_p in pc['sig_ps']:
+            if verbose:
+                print >> sys.stderr, '\tCounting and computing in %d bp windows...' % window_size
+
+            # save window stats for the first scale
+            scale_windows_out = None
+            if not scale_peak_tuples:
+                scale_windows_out = windows_out
+
+            # count reads and compute p-values in windows
+            window_stats = count_windows(clip_in, window_size, read_pos_weights, gene_transcripts, gstart, gend, pc['clip_reads'], pc['txome_sizes'][window_size], sig_p, scale_windows_out, tracks)
+
+            if verbose:
+                print >> sys.stderr, '\tRefining peaks...'
+
+            # post-process windows to peaks
+            peaks = windows2peaks(read_pos_weights, gene_transcripts, gstart, window_stats, window_size, sig_p, pc['clip_reads'], pc['txome_sizes'][window_size])
+
+            # save peaks
+            peak_tuples = []
+            for pstart, pend, pfrags, pmmfrac, ppval in peaks:
+                peak_tuples.append((gchrom, pstart, pend, gstrand, gene_id, pfrags, pmmfrac, ppval))
+            scale_peak_tuples.append(peak_tuples)
+
+    return scale_peak_tuples
+
+
+################################################################################
+# call_peaks_parallel
+#
+# Call peaks on gene clusters across a pool of processes, dispatching the most
+# expensive clusters first and splitting extreme outliers into sub-chunks
+# whose reads are positioned in parallel. Once an outlier's chunks are in, its
+# peak calling goes back to the pool ahead of the remaining tasks. Tasks are
+# fed to the pool a few at a time, so that those go next.
+#
+# Input
+#  gene_ids:       List of merged gene_id's to process.
+#  cluster_costs:  List of (span, isoforms, bam_kb, cost) tuples for each gene.
+#  threads:        Number of processes.
+#  print_windows:  Save window stats to out_dir/window_stats.bin.
+#  init_args:      Arguments to init_peak_calling.
+#
+# Output
+#  gene_results:   List of call_peaks_batch results for each gene in order.
+################################################################################
+def call_peaks_parallel(gene_ids, cluster_costs, threads, print_windows, init_args):
+    # initialize here too, for scheduling and the split genes
+    init_peak_calling(*init_args)
+
+    # splitting changes nothing but which process positions the reads, but
+    # window stats are written gene by gene, so keep genes whole for them,
+    # and cached reads need no positioning
+    split = not print_windows and peak_calling['clip_positions'] is None
+    tasks = schedule_clusters(gene_ids, cluster_costs, threads, split=split)
+
+    # name window output files
+    if print_windows:
+        for ti in range(len(tasks)):
+            tasks[ti] = tasks[ti] + ('%s/window_stats.%d.bin' % (out_dir,ti),)
+
+    gene_results = [None]*len(gene_ids)
+    gene_windows = [None]*len(gene_ids)
+    chunk_reads = {}
+    chunk_seconds = {}
+
+    # journal the split genes, which finish here
+    journal_out = None
+    if peak_calling['journal_dir']:
+        journal_out = open('%s/genes.%d.jsonl' % (peak_calling['journal_dir'],os.getpid()), 'a')
+
+    pool = multiprocessing.Pool(threads, init_peak_calling, init_args)
+    finished = Queue.Queue()
+    pending = collections.deque(tasks)
+    split_tasks = collections.deque()
+    running = []
+    num_running = 0
+
+    while pending or split_tasks or num_running:
+        # keep every process busy, preferring the split genes
+        while num_running < 2*threads and (split_tasks or pending):
+            if split_tasks:
+                task = split_tasks.popleft()
+            else:
+                task = pending.popleft()
+            running.append(pool.apply_async(call_peaks_task, (task,), callback=finished.put))
+            num_running += 1
+
+        try:
+            task, task_result = finished.get(timeout=1)
+        except Queue.Empty:
+            # raise errors from the pool, which skip the callback
+            for async_result in running:
+                if async_result.ready() and not async_result.successful():
+                    async_result.get()
+            running = [async_result for async_result in running if not async_result.ready()]
+            continue
+        num_running -= 1
+
+        if task[0] == 'genes':
+            gis = task[1]
+            for i in range(len(gis)):
+                gene_results[gis[i]] = task_result[i]
+                if print_windows:
+                    gene_windows[gis[i]] = (task[2], task_result[i][1], task_result[i][2])
+
+        elif task[0] == 'chunk':
+            # collect sub-chunk reads
+            gi, ci, num_chunks = task[1:4]
+            chunk_reads.setdefault(gi,[None]*num_chunks)[ci] = task_result[:2]
+            chunk_seconds[gi] = chunk_seconds.get(gi,0) + task_result[2]
+
+            # call the gene's peaks when all of its chunks are in
+            if None not in chunk_reads[gi]:
+                read_pos_weights = []
+                control_read_pos_weights = []
+                for rpw, control_rpw in chunk_reads[gi]:
+                    read_pos_weights += rpw
+                    if control_rpw:
+                        control_read_pos_weights += control_rpw
+                del chunk_reads[gi]
+
+                # chunks own reads by alignment start, so positions interleave
+                read_pos_weights.sort()
+                control_read_pos_weights.sort()
+
+                split_tasks.append(('split', gi, read_pos_weights, control_read_pos_weights))
+
+        else:
+            gi = task[1]
+            scale_peak_tuples, seconds, od_stats = task_result
+            gene_results[gi] = (scale_peak_tuples, 0, 0, chunk_seconds[gi] + seconds, od_stats)
+
+            if verbose:
+                print >> sys.stderr, 'Split %s: predicted %.1f s, took %.1f s positioning reads and %.1f s calling peaks' % (gene_ids[gi], cluster_costs[gi][3], chunk_seconds[gi], seconds)
+
+            if journal_out:
+                journal_gene(journal_out, gene_ids[gi], gene_results[gi])
+
+    pool.close()
+    pool.join()
+
+    if journal_out:
+        journal_out.close()
+
+    # combine window output in gene order
+    if print_windows:
+        combine_window_stats(gene_windows, gene_ids)
+
+    return gene_results
+
+
+################################################################################
+# call_peaks_task
+#
+# Run a task from schedule_clusters in a pool process.
+#
+# Input
+#  task:        One of ('genes', gene indexes, [windows file]), ('chunk',
+#                gene index, chunk index, chunks, own start, own end), or
+#                ('split', gene index, CLIP reads, control reads) to call
+#                peaks on the merged chunks' positioned reads.
+#
+# Output
+#  task:        The same task, to match the result.
+#  task_result: List of call_peaks_batch results for 'genes', a tuple of the
+#                chunk's positioned CLIP reads, positioned control reads (or
+#                None), and seconds for 'chunk', or a tuple of
+#                scale_peak_tuples, seconds, and od_stats for 'split'.
+################################################################################
+def call_peaks_task(task):
+    if task[0] == 'genes':
+        windows_file = None
+        if len(task) > 2:
+            windows_file = task[2]
+        gene_ids = [peak_calling['gene_ids'][gi] for gi in task[1]]
+        task_result = call_peaks_batch((gene_ids, windows_file))
+
+    elif task[0] == 'chunk':
+        chunk_t0 = time.time()
+        gi, ci, num_chunks, own_start, own_end = task[1:]
+        gene_id = peak_calling['gene_ids'][gi]
+        read_pos_weights = position_reads_chunk(peak_calling['clip_bam'], gene_id, own_start, own_end, mapq_zero=True)
+        control_read_pos_weights = None
+        if peak_calling['control_bam']:
+            control_read_pos_weights = position_reads_chunk(peak_calling['control_bam'], gene_id, own_start, own_end)
+        task_result = (read_pos_weights, control_read_pos_weights, time.time()-chunk_t0)
+
+    else:
+        gene_t0 = time.time()
+        gi, read_pos_weights, control_read_pos_weights = task[1:]
+        gene_id = peak_calling['gene_ids'][gi]
+        scale_peak_tuples = call_peaks_gene(None, gene_id, None, read_pos_weights)
+
+        od_stats = None
+        if peak_calling['control_bam']:
+            gene_transcripts = {}
+            for tid in peak_calling['g2t'][gene_id]:
+                gene_transcripts[tid] = peak_calling['transcripts'][tid]
+            (gchrom, gstrand, gstart, gend) = gene_attrs(gene_transcripts)
+            od_stats = overdispersion_stats(read_pos_weights, control_read_pos_weights, gstart, gend, peak_calling['window_sizes'][0], peak_calling['norm_factor'])
+
+        task_result = (scale_peak_tuples, time.time()-gene_t0, od_stats)
+
+        # don't send the reads back
+        task = task[:2]
+
+    return task, task_result
+
+
+################################################################################
+# cigar_blocks
+#
+# Input
+#  aligned_read: pysam AlignedRead object.
+#
+# Output
+#  blocks:       List of (start,end) tuples for the alignment's blocks between
+#                 introns, in 1-based inclusive coordinates. Deletions are
+#                 kept inside blocks.
+################################################################################
+def cigar_blocks(aligned_read):
+    blocks = []
+    block_start = aligned_read.pos+1  # correction for 0-based
+    genome_pos = block_start
+
+    for (operation,length) in aligned_read.cigar:
+        # match or deletion
+        if operation in [0,2,7,8]:
+            genome_pos += length
+
+        # intron
+        elif operation == 3:
+            blocks.append((block_start, genome_pos-1))
+            genome_pos += length
+            block_start = genome_pos
+
+    blocks.append((block_start, genome_pos-1))
+
+    return blocks
+
+
 ################################################################################
 # cigar_endpoint
 # 
@@ -361,23 +1053,164 @@ def cigar_midpoint(aligned_read):
 
 
 ################################################################################
-# convolute_lambda
+# cluster_keys
 #
-# Determine the convoluted poisson lambda for the given window using the
-# transcript's FPKM estimates.
-#
-# Recall that junctions contains the 1st bp of the next exon/intron.
-#
-# TODO: Most of the time is spent in this function. It could be sped up by
-#       keeping better track of the contribution of each bp so that each next
-#       window can be updated by dropping the most distant bp and adding the
-#       next bp's contributions. It could also be sped up by ignoring relevant
-#       isoforms, e.g. by dropping those we've past the 3' end for.
+# Fingerprint each gene cluster by everything its peaks depend on: the
+# cluster's transcripts and FPKMs, the BAM alignments in its region, and the
+# run's global statistics and options. Alignments are read as the
+# decompressed BAM between the index offsets bounding the region, so changes
+# elsewhere in the BAM leave the key unchanged.
 #
 # Input
-#  window_start:     Window start coordinate.
-#  window_end:       Window end coordinate.
-#  gene_transcripts: Hash mapping transcript_id to isoform Gene objects,
+#  gene_ids:    List of merged gene_id's.
+#  g2t:         Hash mapping gene_id's to transcript_id's.
+#  transcripts: Hash mapping transcript_id keys to Gene class instances.
+#  bam_files:   List of indexed BAM files read for peak calling.
+#  run_key:     str describing the global statistics and options.
+#
+# Output
+#  keys:        List of hex digests, in gene order.
+################################################################################
+def cluster_keys(gene_ids, g2t, transcripts, bam_files, run_key):
+    bam_ins = []
+    bams_index_offsets = []
+    for bam_file in bam_files:
+        bam_ins.append(open(bam_file, 'rb'))
+        bams_index_offsets.append(bam_index_offsets(bam_file))
+
+    keys = []
+    for gene_id in gene_ids:
+        key_hash = hashlib.sha1()
+        key_hash.update('clusters_v%d %s\n%s' % (cluster_cache_version, run_key, gene_id))
+
+        # hash the transcripts
+        gene_transcripts = {}
+        for tid in sorted(g2t[gene_id]):
+            tx = transcripts[tid]
+            gene_transcripts[tid] = tx
+            key_hash.update('\n%s %s %s %r %s' % (tid, tx.chrom, tx.strand, tx.fpkm, ' '.join(['%d-%d' % (exon.start,exon.end) for exon in tx.exons])))
+
+        # hash the alignments in the region
+        (gchrom, gstrand, gstart, gend) = gene_attrs(gene_transcripts)
+        for bi in range(len(bam_files)):
+            if not bams_index_offsets[bi]:
+                # without an index, any change to the BAM changes the key
+                key_hash.update('\n%s %d %r' % tuple(file_fingerprint(bam_files[bi])))
+            elif gchrom in bams_index_offsets[bi]:
+                ioffsets = bams_index_offsets[bi][gchrom]
+                v_start = int(ioffsets[min(len(ioffsets)-1, (gstart-1) >> 14)])
+                v_end = int(ioffsets[min(len(ioffsets)-1, ((gend-1) >> 14) + 1)])
+                hash_bam_region(key_hash, bam_ins[bi], v_start, v_end)
+
+        keys.append(key_hash.hexdigest())
+
+    for bam_in in bam_ins:
+        bam_in.close()
+
+    return keys
+
+
+################################################################################
+# combine_window_stats
+#
+# Write out_dir/window_stats.bin from the clusters' chunks in per-batch window
+# stats files, and remove them. Each cluster's chunk is indexed in
+# out_dir/window_stats.index by its gene_id, chromosome, span, and byte range,
+# for read_window_stats.
+#
+# Input
+#  gene_windows: List of (windows_file, offset, bytes) tuples for each gene in
+#                 output order.
+#  gene_ids:     List of merged gene_id's in output order.
+################################################################################
+def combine_window_stats(gene_windows, gene_ids):
+    pc = peak_calling
+
+    windows_out = open('%s/window_stats.bin' % out_dir, 'wb')
+    index_out = open('%s/window_stats.index' % out_dir, 'w')
+    windows_in = {}
+    for gi in range(len(gene_windows)):
+        windows_file, windows_offset, windows_bytes = gene_windows[gi]
+
+        gene_transcripts = {}
+        for tid in pc['g2t'][gene_ids[gi]]:
+            gene_transcripts[tid] = pc['transcripts'][tid]
+        (gchrom, gstrand, gstart, gend) = gene_attrs(gene_transcripts)
+
+        cols = (gene_ids[gi], gchrom, gstart, gend, windows_out.tell(), windows_bytes)
+        print >> index_out, '%s\t%s\t%d\t%d\t%d\t%d' % cols
+
+        if windows_file not in windows_in:
+            windows_in[windows_file] = open(windows_file, 'rb')
+        windows_in[windows_file].seek(windows_offset)
+        windows_out.write(windows_in[windows_file].read(windows_bytes))
+
+    windows_out.close()
+    index_out.close()
+
+    for windows_file in windows_in:
+        windows_in[windows_file].close()
+        os.remove(windows_file)
+
+
+################################################################################
+# compatible_transcripts
+#
+# Find the transcripts whose exons explain an alignment: the first block lies
+# in an exon, and each intron between blocks matches the transcript's intron
+# between consecutive exons. Strand is left to the caller.
+#
+# Input
+#  blocks:      List of (start,end) alignment blocks from cigar_blocks.
+#  chrom_index: exon_index entry for the alignment's chromosome.
+#  tx_exons:    List of each transcript's sorted (start,end) exon tuples.
+#
+# Output
+#  tis:         Sorted tuple of compatible transcript indexes.
+################################################################################
+def compatible_transcripts(blocks, chrom_index, tx_exons):
+    starts, ends, max_ends, exon_tis, exon_xis = chrom_index
+    bstart, bend = blocks[0]
+
+    # scan back over exons starting before the block, until none reach its end
+    tis = []
+    ei = bisect_right(starts, bstart) - 1
+    while ei >= 0 and max_ends[ei] >= bend:
+        if ends[ei] >= bend:
+            exons = tx_exons[exon_tis[ei]]
+            xi = exon_xis[ei]
+
+            # follow the introns through the transcript's exons
+            compatible = True
+            for bi in range(1, len(blocks)):
+                if xi+1 == len(exons) or blocks[bi-1][1] != exons[xi][1] or blocks[bi][0] != exons[xi+1][0] or blocks[bi][1] > exons[xi+1][1]:
+                    compatible = False
+                    break
+                xi += 1
+
+            if compatible:
+                tis.append(exon_tis[ei])
+        ei -= 1
+
+    return tuple(sorted(tis))
+
+
+################################################################################
+# convolute_lambda
+#
+# Determine the convoluted poisson lambda for the given window using the
+# transcript's FPKM estimates.
+#
+# Recall that junctions contains the 1st bp of the next exon/intron.
+#
+# Note: count_windows no longer calls this per window; it reads every window's
+#       lambda off the cumulative coverage track in window_lambdas. This
+#       remains for one-off intervals, e.g. in peak_stats.
+#
+# Input
+#  window_start:     Window start coordinate.
+#  window_end:       Window end coordinate.
+#  gene_transcripts: Hash mapping transcript_id to isoform Gene objects,
 #                     containing only keys for a specific gene.
 #  junctions_i:      Hash mapping transcript_id to the index of the first
 #                     junction ahead of the window start in that transcript's
@@ -395,17 +1228,18 @@ def convolute_lambda(window_start, window_end, gene_transcripts, junctions_i, to
     for tid in gene_transcripts:
         # shortcuts
         tx = gene_transcripts[tid]
+        tjunctions = tx.junctions
         ji = junctions_i[tid]
 
         # determine transcript coefficient
         tcoef = 0.0
 
         # after junctions
-        if ji >= len(tx.junctions):
+        if ji >= len(tjunctions):
             tcoef = 0.0
 
         # next junction out of window
-        elif window_end < tx.junctions[ji]:
+        elif window_end < tjunctions[ji]:
             if ji % 2 == 1: # in an exon
                 tcoef = 1.0
 
@@ -413,15 +1247,15 @@ def convolute_lambda(window_start, window_end, gene_transcripts, junctions_i, to
         else:
             # window start to first junction
             if ji % 2 == 1: # exon
-                tcoef = tx.junctions[ji] - window_start
+                tcoef = tjunctions[ji] - window_start
 
             # advance
             ji += 1
 
             # between junctions
-            while ji < len(tx.junctions) and tx.junctions[ji] <= window_end:
+            while ji < len(tjunctions) and tjunctions[ji] <= window_end:
                 if ji % 2 == 1: # exon
-                    tcoef += tx.junctions[ji] - tx.junctions[ji-1]
+                    tcoef += tjunctions[ji] - tjunctions[ji-1]
                 ji += 1
 
             # back up
@@ -429,7 +1263,7 @@ def convolute_lambda(window_start, window_end, gene_transcripts, junctions_i, to
 
             # last junction to window end
             if ji % 2 == 0: # exon
-                tcoef += window_end - tx.junctions[ji] + 1
+                tcoef += window_end - tjunctions[ji] + 1
 
             # normalize
             tcoef /= float(window_end-window_start+1)
@@ -460,132 +1294,325 @@ def convolute_lambda(window_start, window_end, gene_transcripts, junctions_i, to
 #  gene_end:         End of the gene's span.
 #  total_reads:      Total number of reads aligned to the transcriptome.
 #  txome_size:       Total number of bp in the transcriptome.
-#  windows_out:      Open file if we should print window stats, or None.
+#  sig_p:            P-value at which to call window counts significant.
+#  windows_out:      Open file if we should save window stats, or None.
+#  tracks:           Gene tracks from gene_tracks to share across calls, which
+#                     keep the counts and lambdas at each window size.
 #
 # Output
 #  window_stats:     List of tuples (alignment count, p value) for all windows.
+#                     P-values are only computed for significant windows
+#                     (unless printing window stats); the rest are set to 1.
 ################################################################################
-def count_windows(clip_in, window_size, read_pos_weights, gene_transcripts, gene_start, gene_end, total_reads, txome_size, windows_out):
+def count_windows(clip_in, window_size, read_pos_weights, gene_transcripts, gene_start, gene_end, total_reads, txome_size, sig_p, windows_out, tracks=None):
     # set lambda using whole region (some day, compare this to the cufflinks estimate)
     # poisson_lambda = float(len(read_pos_weights)) / (gene_end - gene_start)
 
-    # get gene info
-    tid0 = gene_transcripts.keys()[0]
-    chrom = gene_transcripts[tid0].chrom
-    gene_id = gene_transcripts[tid0].kv['gene_id']
+    if tracks is None:
+        tracks = gene_tracks(read_pos_weights, gene_transcripts, gene_start, gene_end)
 
-    reads_window_start = 0 # index of the first read position that fits in the window (except I'm allowing 0)
-    reads_window_end = 0 # index of the first read position past the window
+    if window_size not in tracks['windows']:
+        # compute lambda for every window from the FPKM coverage track
+        gene_window_lambdas = window_lambdas(gene_transcripts, gene_start, gene_end, window_size, total_reads, tracks['fpkm_cov'])
 
-    # combine all gene junctions
-    gene_junctions_set = set()
-    for tid in gene_transcripts:
-        gene_junctions_set |= set(gene_transcripts[tid].junctions)
-    gene_junctions = sorted(list(gene_junctions_set))
+        read_positions = tracks['read_positions']
+        read_cumweights = tracks['read_cumweights']
+        rpw_len = len(read_positions)
+
+        # start at either gene_start or the 3rd read (since we need >2 to Poisson test)
+        if rpw_len < 3:
+            first_window_start = gene_end # skip iteration
+        else:
+            first_window_start = max(gene_start, int(read_positions[2])-window_size+1)
 
-    junctions_window_start = 0 # index of the first junction that fits in the window (except I'm allowing 0)
-    junctions_window_end = 0 # index of the first junction past the window
+        # stop after the window starting at the last read
+        last_window_start = gene_end-window_size
+        if rpw_len > 0:
+            last_window_start = min(last_window_start, int(math.floor(read_positions[-1])))
 
-    # initialize index of the first junction ahead of the window start for each transcript
-    junctions_i = {}
-    for tid in gene_transcripts:
-        junctions_i[tid] = 0
+        # count reads in all windows
+        window_starts = np.arange(first_window_start, last_window_start+1)
+        reads_start_i = np.searchsorted(read_positions, window_starts, side='left')
+        reads_end_i = np.searchsorted(read_positions, window_starts+window_size-1, side='right')
+        window_counts_float = read_cumweights[reads_end_i] - read_cumweights[reads_start_i]
 
-    # to avoid redundant computation
-    precomputed_pvals = {}
-    rpw_len = len(read_pos_weights)
-    gj_len = len(gene_junctions)
+        # round counts
+        window_counts = round_counts(window_counts_float, tracks['read_weights'], reads_start_i, reads_end_i)
+
+        # look up lambdas
+        lambdas = gene_window_lambdas[window_starts-gene_start]
+
+        tracks['windows'][window_size] = (first_window_start, window_starts, window_counts, lambdas)
+
+    first_window_start, window_starts, window_counts, lambdas = tracks['windows'][window_size]
 
     window_stats = []
-    window_lambda = None
+    if len(tracks['read_positions']) >= 3:
+        window_stats += [(0,1)]*(first_window_start-gene_start)
 
-    # start at either gene_start or the 3rd read (since we need >2 to Poisson test)
-    if rpw_len < 3:
-        first_window_start = gene_end # skip iteration
+    # compare counts to the critical counts (we need >2 to Poisson test)
+    k_crit, k_lone = scan_stat_critical(window_size, txome_size, lambdas, sig_p)
+    significant = (window_counts > 2) & ((window_counts >= k_crit) | (window_counts == k_lone))
+
+    # compute p-values for significant windows, or all tested windows for debugging
+    if windows_out:
+        tested = (window_counts > 2)
     else:
-        first_window_start = max(gene_start, int(read_pos_weights[2][0])-window_size+1)
-        window_stats += [(0,1)]*(first_window_start-gene_start)
+        tested = significant
+    window_pvals = np.ones(len(window_counts))
+    window_pvals[tested] = scan_stat_pvals(window_counts[tested], window_size, txome_size, lambdas[tested])
+
+    window_stats += zip(window_counts.tolist(), window_pvals.tolist())
+
+    # for debugging
+    if windows_out:
+        write_window_stats(windows_out, window_starts, window_counts, window_pvals, lambdas)
+
+    return window_stats
+
+
+################################################################################
+# cufflinks_cache_key
+#
+# Hash the inputs that determine the estimated abundances, to name their
+# entry in the shared Cufflinks cache. The abundance BAM is identified by its
+# size, modification time, and header, rather than read in full; the read
+# stats passed to Cufflinks are sampled from it deterministically, so they
+# follow from the BAM.
+#
+# Input
+#  bam_file:  Abundance BAM file.
+#  ref_gtf:   Reference GTF file.
+#  em:        Abundances from the built-in EM, rather than Cufflinks.
+#  stranded:  The built-in EM respected read strands.
+#  hits_norm: Cufflinks hits normalization option.
+#
+# Output
+#  key:       Hex digest identifying the run.
+################################################################################
+def cufflinks_cache_key(bam_file, ref_gtf, em, stranded, hits_norm):
+    bam_stat = os.stat(bam_file)
+    bam_in = pysam.Samfile(bam_file, 'rb')
+    header_sha1 = hashlib.sha1(bam_in.text).hexdigest()
+    bam_in.close()
+
+    key_hash = hashlib.sha1()
+    key_hash.update('cufflinks_v%d bam_size=%d bam_mtime=%r bam_header=%s em=%d stranded=%d %s\n' % (cufflinks_cache_version, bam_stat.st_size, bam_stat.st_mtime, header_sha1, em, stranded, hits_norm))
+    hash_file(key_hash, ref_gtf)
+
+    return key_hash.hexdigest()[:16]
+
+
+################################################################################
+# dump_gene_result
+#
+# Input
+#  labels:      List of str's identifying the result, such as its gene_id.
+#  gene_result: (scale_peak_tuples, windows_offset, windows_bytes, seconds,
+#                od_stats) tuple from call_peaks_batch.
+#
+# Output
+#  line:        JSON list of the labels, peaks, seconds, and od_stats, to be
+#                read by parse_gene_result.
+################################################################################
+def dump_gene_result(labels, gene_result):
+    scale_peak_tuples, windows_offset, windows_bytes, seconds, od_stats = gene_result
+
+    if od_stats is not None:
+        od_stats = list(od_stats)
+        for oi in [3,4]:
+            if od_stats[oi] is not None:
+                od_stats[oi] = np.asarray(od_stats[oi]).tolist()
+
+    return json.dumps(labels + [scale_peak_tuples, seconds, od_stats], default=lambda x: x.item())
+
+
+################################################################################
+# em_abundances
+#
+# Estimate transcript fragment counts by EM over equivalence classes of
+# fragments compatible with the same transcripts, assigning each class's
+# fragments in proportion to the transcripts' abundances per effective bp.
+#
+# Input
+#  class_tis:    List of tuples of transcript indexes for each class.
+#  class_counts: Array of fragments in each class.
+#  eff_lengths:  Array of transcript effective lengths.
+#
+# Output
+#  tx_counts:    Array of estimated fragments from each transcript.
+#  iterations:   Number of EM iterations run.
+################################################################################
+def em_abundances(class_tis, class_counts, eff_lengths):
+    num_classes = len(class_tis)
+    num_txs = len(eff_lengths)
+
+    # sparse class membership
+    member_tis = np.array(list(itertools.chain(*class_tis)), dtype='int64')
+    member_classes = np.repeat(np.arange(num_classes), [len(tis) for tis in class_tis])
+    member_counts = np.asarray(class_counts, dtype='float64')[member_classes]
+
+    # start with equal abundance per transcript
+    tx_counts = np.ones(num_txs)
+
+    iterations = 0
+    while iterations < em_max_iterations:
+        iterations += 1
+
+        # assign each class's fragments by abundance per effective bp
+        member_weights = (tx_counts / eff_lengths)[member_tis]
+        class_weights = np.bincount(member_classes, weights=member_weights, minlength=num_classes)
+        member_frags = member_counts * member_weights / class_weights[member_classes]
 
-    for window_start in range(first_window_start, gene_end-window_size+1):
-        window_end = window_start + window_size - 1
+        prev_counts = tx_counts
+        tx_counts = np.bincount(member_tis, weights=member_frags, minlength=num_txs)
 
-        # update read_window_start
-        while reads_window_start < rpw_len and read_pos_weights[reads_window_start][0] < window_start:
-            reads_window_start += 1
-        if reads_window_start >= rpw_len:
+        if np.all(np.abs(tx_counts - prev_counts) <= em_tolerance*np.maximum(prev_counts, 1.0)):
             break
 
-        # update read_window_end
-        while reads_window_end < rpw_len and read_pos_weights[reads_window_end][0] <= window_end:
-            reads_window_end += 1
+    return tx_counts, iterations
 
-        # count reads
-        #window_count = reads_window_end - reads_window_start
-        window_count_float = sum([read_pos_weights[i][1] for i in range(reads_window_start,reads_window_end)])
 
-        # round count
-        window_count = int(window_count_float + 0.5)
+################################################################################
+# estimate_abundances
+#
+# Estimate transcript abundances for the reference GTF in place of Cufflinks,
+# and write them as Cufflinks would to transcripts.gtf and
+# isoforms.fpkm_tracking. One pass over the BAM sorts fragments into
+# equivalence classes by their compatible transcripts, and em_abundances
+# divides the classes between transcripts. Fragments weight multimappers by
+# 1/NH and paired reads by 1/2, as in preflight_bam. Effective lengths use the
+# median insert size of proper pairs, or the read length without them. For
+# stranded libraries, reads only count toward transcripts on their strand, as
+# in position_read.
+#
+# Input
+#  bam_file:             BAM file.
+#  ref_gtf:              Reference GTF file.
+#  read_length:          Mean read length, the fragment length for unpaired
+#                         reads.
+#  stranded:             Sequencing is stranded.
+#  compatible_hits_norm: Normalize FPKMs by transcriptome-compatible fragments,
+#                         rather than all mapped fragments.
+#  cuff_dir:             Directory to write the Cufflinks files to.
+################################################################################
+def estimate_abundances(bam_file, ref_gtf, read_length, stranded, compatible_hits_norm, cuff_dir):
+    if verbose:
+        print >> sys.stderr, 'Estimating abundances with EM...'
+        t0 = time.time()
 
-        # update junctions_window_start
-        while junctions_window_start < gj_len and gene_junctions[junctions_window_start] < window_start:
-            junctions_window_start += 1
-        
-        # update junctions_window_end
-        while junctions_window_end < gj_len and gene_junctions[junctions_window_end] <= window_end:
-            junctions_window_end += 1
-
-        # update junction indexes and convolute lambda only if there are junctions in the window
-        if window_lambda == None or junctions_window_start < junctions_window_end:
-            # update junctions indexes (<= comparison because junctions holds the 1st bp of next exon/intron)
-            for tid in gene_transcripts:
-                tjunctions = gene_transcripts[tid].junctions
-                while junctions_i[tid] < len(tjunctions) and tjunctions[junctions_i[tid]] <= window_start:
-                    junctions_i[tid] += 1
-
-            # set lambda
-            window_lambda = convolute_lambda(window_start, window_end, gene_transcripts, junctions_i, total_reads)
-
-        # compute p-value
-        if window_count > 2:
-            if (window_count,window_lambda) in precomputed_pvals:
-                p_val = precomputed_pvals[(window_count,window_lambda)]
-            else:
-                p_val = scan_stat_approx3(window_count, window_size, txome_size, window_lambda)
-                precomputed_pvals[(window_count,window_lambda)] = p_val
-            window_stats.append((window_count,p_val))
+    transcripts = read_genes(ref_gtf, key_id='transcript_id')
+    tids = sorted(transcripts.keys())
+    tx_exons = [sorted([(exon.start,exon.end) for exon in transcripts[tid].exons]) for tid in tids]
+    tx_strands = [transcripts[tid].strand for tid in tids]
+    chrom_indexes = exon_index([transcripts[tid].chrom for tid in tids], tx_exons)
+
+    # sort fragments into equivalence classes
+    bam_in = pysam.Samfile(bam_file, 'rb')
+    tid_indexes = [chrom_indexes.get(chrom) for chrom in bam_in.references]
+
+    fragments = 0.0
+    classes = {}
+    insert_counts = {}
+    for aligned_read in bam_in.fetch(until_eof=True):
+        if aligned_read.is_unmapped:
+            continue
+
+        # count each proper pair's insert size once
+        if aligned_read.is_proper_pair and aligned_read.is_read1 and aligned_read.tlen != 0:
+            insert_size = abs(aligned_read.tlen)
+            insert_counts[insert_size] = insert_counts.get(insert_size,0) + 1
+
+        if aligned_read.is_paired:
+            read_fragments = 0.5/aligned_read.opt('NH')
         else:
-            window_stats.append((window_count,1))
+            read_fragments = 1.0/aligned_read.opt('NH')
+        fragments += read_fragments
+
+        chrom_index = tid_indexes[aligned_read.tid]
+        if chrom_index is not None:
+            tis = compatible_transcripts(cigar_blocks(aligned_read), chrom_index, tx_exons)
+
+            if tis and stranded:
+                # keep transcripts on the read's strand, if it has one
+                try:
+                    ar_strand = aligned_read.opt('XS')
+                except:
+                    ar_strand = None
+                if ar_strand != None:
+                    tis = tuple([ti for ti in tis if tx_strands[ti] == ar_strand])
+
+            if tis:
+                classes[tis] = classes.get(tis,0) + read_fragments
+
+    bam_in.close()
+
+    class_tis = classes.keys()
+    class_counts = np.array([classes[tis] for tis in class_tis])
+    compatible_fragments = class_counts.sum()
+
+    # take the median insert size as the fragment length
+    frag_length = read_length
+    num_inserts = sum(insert_counts.values())
+    if num_inserts > 0:
+        insert_sum = 0
+        for insert_size in sorted(insert_counts):
+            insert_sum += insert_counts[insert_size]
+            if 2*insert_sum >= num_inserts:
+                frag_length = insert_size
+                break
 
-        # for debugging
-        if windows_out:
-            cols = (chrom, window_start, gene_id, window_count, window_stats[-1][1], window_lambda)
-            print >> windows_out, '%-5s %9d %18s %5d %8.1e %8.2e' % cols
+    # estimate fragments from each transcript
+    tx_lengths = np.array([sum([xend-xstart+1 for xstart, xend in exons]) for exons in tx_exons], dtype='float64')
+    eff_lengths = np.maximum(tx_lengths - frag_length + 1, 1)
+    tx_counts, iterations = em_abundances(class_tis, class_counts, eff_lengths)
 
-    return window_stats
+    if compatible_hits_norm:
+        norm_fragments = compatible_fragments
+    else:
+        norm_fragments = fragments
+    tx_fpkms = 1e9 * tx_counts / eff_lengths / max(norm_fragments, 1)
+
+    if verbose:
+        print >> sys.stderr, '\t%.1f of %.1f fragments compatible with %d transcripts, in %d classes' % (compatible_fragments, fragments, len(tids), len(class_tis))
+        print >> sys.stderr, '\tFragment length %d, from %d proper pairs' % (frag_length, num_inserts)
+        print >> sys.stderr, '\tEM finished in %d iterations, %.1f seconds in all' % (iterations, time.time()-t0)
+
+    # write the reference transcripts
+    write_exons_gtf(ref_gtf, '%s/transcripts.gtf' % cuff_dir)
+
+    # write the abundances
+    fpkm_out = open('%s/isoforms.fpkm_tracking' % cuff_dir, 'w')
+    print >> fpkm_out, '\t'.join(['tracking_id', 'class_code', 'nearest_ref_id', 'gene_id', 'gene_short_name', 'tss_id', 'locus', 'length', 'coverage', 'FPKM', 'FPKM_conf_lo', 'FPKM_conf_hi', 'FPKM_status'])
+    for ti in range(len(tids)):
+        tx = transcripts[tids[ti]]
+        locus = '%s:%d-%d' % (tx.chrom, tx.start-1, tx.end)
+        coverage = tx_counts[ti] * frag_length / tx_lengths[ti]
+        cols = (tids[ti], tx.gene_id, locus, tx_lengths[ti], coverage, tx_fpkms[ti])
+        print >> fpkm_out, '%s\t-\t-\t%s\t-\t-\t%s\t%d\t%g\t%g\t0\t0\tOK' % cols
+    fpkm_out.close()
 
 
 ################################################################################
-# estimate_overdispersion
+# estimate_cluster_costs
 #
-# Inputs:
-#  clip_bam:      CLIP sequencing BAM
-#  control_bam:   Control sequencing BAM
+# Predict the peak calling time for each gene cluster from its span, isoform
+# count, and the amount of BAM in its region according to the index. The
+# coefficients cost_per_bp, cost_per_isoform, and cost_per_bam_kb can be
+# tuned against the predicted and actual times logged to cluster_costs.txt.
+#
+# Input
+#  gene_ids:      List of merged gene_id's.
 #  g2t:           Hash mapping gene_id's to transcript_id's
 #  transcripts:   Hash mapping transcript_id keys to Gene class instances.
-#  window_size:   Scan statistic window size.
-#  norm_factor:   Ratio of total transcriptome CLIP to control reads
+#  index_offsets: Linear index offsets from bam_index_offsets.
 #
-# Outputs:
-#  overdisperion: Estimated overdispersion parameter.
+# Output
+#  cluster_costs: List of (span, isoforms, bam_kb, cost) tuples for each gene.
 ################################################################################
-def estimate_overdispersion(clip_bam, control_bam, g2t, transcripts, window_size, norm_factor):
-    clip_in = pysam.Samfile(clip_bam)
-    control_in = pysam.Samfile(control_bam)
-
-    window_means = []
-    window_variances = []
-
-    for gene_id in g2t:
+def estimate_cluster_costs(gene_ids, g2t, transcripts, index_offsets):
+    cluster_costs = []
+    for gene_id in gene_ids:
         # make a more focused transcript hash for this gene
         gene_transcripts = {}
         for tid in g2t[gene_id]:
@@ -593,233 +1620,357 @@ def estimate_overdispersion(clip_bam, control_bam, g2t, transcripts, window_size
 
         # obtain basic gene attributes
         (gchrom, gstrand, gstart, gend) = gene_attrs(gene_transcripts)
+        span = gend - gstart + 1
+        isoforms = len(gene_transcripts)
+
+        # estimate compressed BAM bytes in the region
+        bam_kb = 0.0
+        if gchrom in index_offsets:
+            ioffsets = index_offsets[gchrom]
+            v_start = int(ioffsets[min(len(ioffsets)-1, (gstart-1) >> 14)])
+            v_end = int(ioffsets[min(len(ioffsets)-1, ((gend-1) >> 14) + 1)])
+            if (v_end >> 16) > (v_start >> 16):
+                bam_kb = ((v_end >> 16) - (v_start >> 16)) / 1024.0
+            else:
+                # within a BGZF block, guess ~3x compression
+                bam_kb = max(0, (v_end & 0xffff) - (v_start & 0xffff)) / 3.0 / 1024.0
 
-        # fetch reads
-        clip_read_pos_weights = position_reads(clip_in, gchrom, gstart, gend, gstrand)
-        control_read_pos_weights = position_reads(control_in, gchrom, gstart, gend, gstrand)
-
-        clip_rpw_len = len(clip_read_pos_weights)
-        control_rpw_len = len(control_read_pos_weights)
+        cost = cost_per_bp*span + cost_per_isoform*isoforms + cost_per_bam_kb*bam_kb
 
-        # initialize
-        clip_reads_start_i = 0
-        clip_reads_end_i = 0
-        control_reads_start_i = 0
-        control_reads_end_i = 0
+        cluster_costs.append((span, isoforms, bam_kb, cost))
 
-        window_start = gstart
+    return cluster_costs
 
-        while window_start + window_size < gend:
-            # update reads_start_i
-            while clip_reads_start_i < clip_rpw_len and clip_read_pos_weights[clip_reads_start_i][0] < window_start:
-                clip_reads_start_i += 1
 
-            while control_reads_start_i < control_rpw_len and control_read_pos_weights[control_reads_start_i][0] < window_start:
-                control_reads_start_i += 1
+################################################################################
+# estimate_overdispersion
+#
+# Regress the negative binomial overdispersion from the CLIP and control
+# window comparisons accumulated by overdispersion_stats for each gene.
+#
+# Inputs:
+#  gene_od_stats: List of overdispersion_stats results, in gene order.
+#
+# Outputs:
+#  overdisperion: Estimated overdispersion parameter.
+################################################################################
+def estimate_overdispersion(gene_od_stats):
+    sum_uvar = 0.0
+    sum_u2 = 0.0
+    sum_u3 = 0.0
+    for od_stats in gene_od_stats:
+        sum_uvar += od_stats[0]
+        sum_u2 += od_stats[1]
+        sum_u3 += od_stats[2]
 
-            # update reads_end_i
-            while clip_reads_end_i < clip_rpw_len and clip_read_pos_weights[clip_reads_end_i][0] <= window_start+window_size:
-                clip_reads_end_i += 1
+    if verbose:
+        mv_out = open('%s/overdispersion.txt' % out_dir, 'w')
+        for od_stats in gene_od_stats:
+            u, var = od_stats[3:]
+            for i in range(len(u)):
+                print >> mv_out, '%f\t%f' % (u[i],var[i])
+        mv_out.close()
 
-            while control_reads_end_i < control_rpw_len and control_read_pos_weights[control_reads_end_i][0] <= window_start+window_size:
-                control_reads_end_i += 1
+    if sum_u3 == 0:
+        return 0
 
-            # count clip fragments
-            if clip_reads_start_i >= clip_rpw_len:
-                clip_frags = 0.0
-            else:
-                clip_frags = sum([clip_read_pos_weights[i][1] for i in range(clip_reads_start_i,clip_reads_end_i)])
-            
-            # count control fragments
-            if control_reads_start_i >= control_rpw_len:
-                control_frags = 0.0
-            else:
-                control_frags = sum([control_read_pos_weights[i][1] for i in range(control_reads_start_i,control_reads_end_i)])
+    return max(0, (sum_uvar - sum_u2) / sum_u3)
 
-            # normalize control fragments
-            control_frags *= norm_factor
 
-            # save mean and variance
-            window_means.append(0.5*clip_frags + 0.5*control_frags)
-            window_variances.append((clip_frags - window_means[-1])**2 + (control_frags - window_means[-1])**2)
+################################################################################
+# evict_cufflinks_cache
+#
+# Remove the least recently used runs from the shared Cufflinks cache until
+# it fits in the maximum size.
+#
+# Input
+#  cache_dir: Shared Cufflinks cache directory.
+#  max_bytes: Maximum total size of the cached runs.
+#  keep_key:  Key of a run to keep regardless.
+################################################################################
+def evict_cufflinks_cache(cache_dir, max_bytes, keep_key):
+    # collect (last use, bytes, key) for each run
+    runs = []
+    total_bytes = 0
+    for key in os.listdir(cache_dir):
+        run_dir = '%s/%s' % (cache_dir, key)
+        if '.' in key or not os.path.isdir(run_dir):
+            continue
+        try:
+            run_bytes = sum([os.path.getsize('%s/%s' % (run_dir,cuff_file)) for cuff_file in os.listdir(run_dir)])
+            runs.append((os.path.getmtime(run_dir), run_bytes, key))
+        except OSError:
+            continue
+        total_bytes += run_bytes
+
+    for run_mtime, run_bytes, key in sorted(runs):
+        if total_bytes <= max_bytes:
+            break
+        if key != keep_key:
+            if verbose:
+                print >> sys.stderr, 'Evicting %s/%s from the Cufflinks cache' % (cache_dir, key)
+            shutil.rmtree('%s/%s' % (cache_dir,key), ignore_errors=True)
+            total_bytes -= run_bytes
 
-            # update indexes
-            window_start += window_size
 
-    clip_in.close()
-    control_in.close()
+################################################################################
+# exon_index
+#
+# Index exons by chromosome for compatible_transcripts.
+#
+# Input
+#  tx_chroms:     List of each transcript's chromosome.
+#  tx_exons:      List of each transcript's sorted (start,end) exon tuples.
+#
+# Output
+#  chrom_indexes: Hash mapping chromosomes to (starts, ends, max_ends,
+#                  exon_tis, exon_xis) lists for exons sorted by start, where
+#                  max_ends holds the running maximum end, and exon_tis and
+#                  exon_xis locate each exon in tx_exons.
+################################################################################
+def exon_index(tx_chroms, tx_exons):
+    chrom_exons = {}
+    for ti in range(len(tx_exons)):
+        for xi in range(len(tx_exons[ti])):
+            xstart, xend = tx_exons[ti][xi]
+            chrom_exons.setdefault(tx_chroms[ti],[]).append((xstart, xend, ti, xi))
 
-    # regress overdispersion
-    u = array(window_means)
-    var = array(window_variances)
+    chrom_indexes = {}
+    for chrom in chrom_exons:
+        exons = sorted(chrom_exons[chrom])
+        ends = [exon[1] for exon in exons]
+        max_ends = []
+        for xend in ends:
+            max_ends.append(max(xend, max_ends[-1] if max_ends else xend))
+        chrom_indexes[chrom] = ([exon[0] for exon in exons], ends, max_ends, [exon[2] for exon in exons], [exon[3] for exon in exons])
 
-    if verbose:
-        mv_out = open('%s/overdispersion.txt' % out_dir, 'w')
-        for i in range(len(u)):
-            print >> mv_out, '%f\t%f' % (u[i],var[i])
-        mv_out.close()    
+    return chrom_indexes
 
-    return max(0, sum(u*var - u**2) / sum(u**3))
-    
 
 ################################################################################
-# estimate_read_stats
-#
-# Compute mean read length by sampling the first N reads.
+# file_fingerprint
 #
 # Input
-#  bam_file:    BAM.
+#  file_name:   File.
 #
-# Output:
-#  read_length: Mean read length.
-#  read_sd:     Read length standard deviation.
-################################################################################
-def estimate_read_stats(bam_file):
-    samples = 2000000
-    s = 0
-    read_lengths = []
-    for aligned_read in pysam.Samfile(bam_file, 'rb'):
-        if aligned_read.mapq > 0:
-            read_lengths.append(aligned_read.rlen)
-            s += 1
-            if s >= samples:
-                break
-            
-    mean_f, sd_f = stats.mean_sd(read_lengths)
-
-    return int(mean_f+0.5), int(sd_f+0.5)
+# Output
+#  fingerprint: List of the file's absolute path, size, and modification time.
+################################################################################
+def file_fingerprint(file_name):
+    file_stat = os.stat(file_name)
+    return [os.path.abspath(file_name), file_stat.st_size, file_stat.st_mtime]
 
 
 ################################################################################
 # filter_peaks_control
 #
 # Input
-#  putative_peaks: List of Peak objects w/o attribute control_p.
+#  putative_peaks: PeakTable of peaks w/o control_p set.
 #  p_val:          P-value to use for filtering.
 #  overdispersion: Negative binomial overdispersion parameter.
 #  control_bam:    BAM file to inform control filtering.
 #  norm_factor:    Ratio of total transcriptome CLIP to control reads
+#  out_suffix:     Suffix for the filtered peaks file name.
 #
 # Output
-#  filtered_peaks: List of filtered Peak objects w/ attribute control_p set.
+#  filtered_peaks: PeakTable of filtered peaks w/ control_frags and control_p
+#                   set.
 ################################################################################
-def filter_peaks_control(putative_peaks, p_val, overdispersion, control_bam, norm_factor):
+def filter_peaks_control(putative_peaks, p_val, overdispersion, control_bam, norm_factor, out_suffix=''):
     # number of bp to expand each peak by to check the control
     fuzz = 5
 
     # open control BAM for fetching
     control_in = pysam.Samfile(control_bam, 'rb')
 
-    # initialize p-value list for later FDR correction
-    control_p_values = []
-
-    if verbose or print_filtered_peaks:
-        # open file to print filtered peaks
-        control_filter_out = open('%s/filtered_peaks_control.gff' % out_dir, 'w')
-
-    # for each peak
-    for peak in putative_peaks:
-        peak_length = peak.end - peak.start + 1
-
-        # fetch reads 
-        read_pos_weights = position_reads(control_in, peak.chrom, peak.start-fuzz, peak.end+fuzz, peak.strand)
-
-        # sum weights
-        read_positions = [pos for (pos,w,mm) in read_pos_weights] 
-        reads_start_i = bisect_left(read_positions, peak.start-fuzz)
-        reads_end_i = bisect_right(read_positions, peak.end+fuzz)
-        control_frags = sum([read_pos_weights[i][1] for i in range(reads_start_i,reads_end_i)])
-
-        # if there are fragments
-        if control_frags > 0:
-            # refactor for fuzz
-            control_frags *= float(peak_length) / (peak_length + 2*fuzz)
-
-            # normalize for read counts
-            peak.control_frags = max(0.1, control_frags * norm_factor)
-
-        # if there are no fragments
+    peaks = putative_peaks.peaks
+    fuzz_starts = peaks['start'] - fuzz
+    fuzz_ends = peaks['end'] + fuzz
+
+    # group peaks into blocks of nearby peaks on each chromosome, capping each
+    # block's span so dense peaks don't chain across the chromosome
+    blocks = []
+    for pi in np.lexsort((fuzz_starts, peaks['chrom'])).tolist():
+        if blocks and blocks[-1][0] == peaks['chrom'][pi] and fuzz_starts[pi] <= blocks[-1][2] + sweep_gap and fuzz_ends[pi] - blocks[-1][1] < control_block_span:
+            blocks[-1][2] = max(blocks[-1][2], fuzz_ends[pi])
+            blocks[-1][3].append(pi)
         else:
-            # assume a small value that will pass
-            peak.control_frags = 0.1
+            blocks.append([peaks['chrom'][pi], fuzz_starts[pi], fuzz_ends[pi], [pi]])
+
+    # sum the control read weights in each fuzzed peak
+    control_frags = np.zeros(len(peaks))
+    for bchrom, bstart, bend, block_pi in blocks:
+        chrom = putative_peaks.chroms[bchrom]
+        if chrom not in control_in.references:
+            continue
+
+        block_pi = np.array(block_pi)
+        block_strands = sorted(set(peaks['strand'][block_pi].tolist()))
+
+        # position the block's reads once for each strand, noting where each
+        # alignment starts and ends
+        strand_reads = dict([(sc,[]) for sc in block_strands])
+        for aligned_read in control_in.fetch(chrom, bstart, bend-1):
+            for sc in block_strands:
+                read_pos_weight = position_read(aligned_read, putative_peaks.strands[sc])
+                if read_pos_weight:
+                    strand_reads[sc].append((read_pos_weight[0], read_pos_weight[1], aligned_read.pos+1, aligned_read.aend))
+
+        for sc in block_strands:
+            strand_pi = block_pi[peaks['strand'][block_pi] == sc]
+            strand_reads[sc].sort()
+
+            read_positions = np.array([rp[0] for rp in strand_reads[sc]], dtype='float64')
+            read_weights = np.array([rp[1] for rp in strand_reads[sc]], dtype='float64')
+            read_starts = np.array([rp[2] for rp in strand_reads[sc]], dtype='int64')
+            read_ends = np.array([rp[3] for rp in strand_reads[sc]], dtype='int64')
+
+            # sum reads positioned in each fuzzed peak
+            read_cumweights = np.concatenate(([0.0], np.cumsum(read_weights)))
+            reads_start_i = np.searchsorted(read_positions, fuzz_starts[strand_pi], side='left')
+            reads_end_i = np.searchsorted(read_positions, fuzz_ends[strand_pi], side='right')
+            strand_frags = read_cumweights[reads_end_i] - read_cumweights[reads_start_i]
+
+            # a peak's own fetch would miss reads whose alignments end by its
+            # fuzzed start or begin at its fuzzed end, so drop those; reads
+            # positioned at their alignment's ends are common, and the rest
+            # (positioned past the end by insertions) are handled one by one
+            end_cumweights = np.concatenate(([0.0], np.cumsum(read_weights*(read_ends == read_positions))))
+            reads_edge_i = np.searchsorted(read_positions, fuzz_starts[strand_pi], side='right')
+            strand_frags -= end_cumweights[reads_edge_i] - end_cumweights[reads_start_i]
+
+            start_cumweights = np.concatenate(([0.0], np.cumsum(read_weights*(read_starts == read_positions))))
+            reads_edge_i = np.searchsorted(read_positions, fuzz_ends[strand_pi], side='left')
+            strand_frags -= start_cumweights[reads_end_i] - start_cumweights[reads_edge_i]
+
+            for ri in np.nonzero(read_ends < read_positions)[0]:
+                missed = (read_ends[ri] <= fuzz_starts[strand_pi]) & (fuzz_starts[strand_pi] <= read_positions[ri]) & (read_positions[ri] <= fuzz_ends[strand_pi])
+                strand_frags[missed] -= read_weights[ri]
+
+            control_frags[strand_pi] = strand_frags
 
-        if overdispersion == 0:
-            # perform poisson test
-            control_p_values.append( poisson.sf(peak.frags-1, peak.control_frags) )
-        else:
-            # perform negative binomial test
-            nb_p = 1.0 / (1.0 + peak.control_frags*overdispersion)
-            nb_n = 1.0 / overdispersion
-            control_p_values.append( nbinom.sf(peak.frags-1, nb_n, nb_p) )
+    control_in.close()
+
+    # if there are fragments, refactor for fuzz and normalize for read counts,
+    # and otherwise assume a small value that will pass
+    peak_lengths = peaks['end'] - peaks['start'] + 1
+    has_frags = (control_frags > 0)
+    control_frags[has_frags] *= peak_lengths[has_frags].astype('float64') / (peak_lengths[has_frags] + 2*fuzz)
+    peaks['control_frags'] = 0.1
+    peaks['control_frags'][has_frags] = np.maximum(0.1, control_frags[has_frags] * norm_factor)
+
+    # test all peaks at once
+    if overdispersion == 0:
+        # perform poisson test
+        control_p_values = poisson.sf(peaks['frags']-1, peaks['control_frags'])
+    else:
+        # perform negative binomial test
+        nb_p = 1.0 / (1.0 + peaks['control_frags']*overdispersion)
+        nb_n = 1.0 / overdispersion
+        control_p_values = nbinom.sf(peaks['frags']-1, nb_n, nb_p)
 
     # correct for multiple hypotheses
-    control_q_values = fdr.ben_hoch(control_p_values)
+    control_q_values = fdr.ben_hoch(control_p_values.tolist())
 
     # attach q-values to peaks and filter
-    filtered_peaks = []
-    for i in range(len(putative_peaks)):
-        peak = putative_peaks[i]
-        peak.control_p = control_q_values[i]
-        if control_q_values[i] <= p_val:
-            filtered_peaks.append(peak)
-        elif verbose or print_filtered_peaks:
-            print >> control_filter_out, peak.gff_str()
+    peaks['control_p'] = control_q_values
+    control_pass = (peaks['control_p'] <= p_val)
 
     if verbose or print_filtered_peaks:
+        # print filtered peaks
+        control_filter_out = open('%s/filtered_peaks_control%s.gff' % (out_dir,out_suffix), 'w')
+        write_lines(control_filter_out, putative_peaks.subset(~control_pass).gff_lines())
         control_filter_out.close()
 
-    return filtered_peaks
+    return putative_peaks.subset(control_pass)
 
 
 ################################################################################
 # filter_peaks_ignore
 #
 # Input
-#  putative_peaks: List of Peak objects.
+#  putative_peaks: PeakTable of peaks.
 #  ignore_bed:     BED file specifying troublesome regions to ignore.
+#  out_suffix:     Suffix for the filtered peaks file name.
 #
 # Output
-#  filtered_peaks: List of filtered Peak objects.
+#  filtered_peaks: PeakTable of filtered peaks.
 ################################################################################
-def filter_peaks_ignore(putative_peaks, ignore_bed):
-    # temporarily print to file
-    peaks_out = open('%s/putative.gff' % out_dir, 'w')
-    for peak in putative_peaks:
-        print >> peaks_out, peak.gff_str()
-    peaks_out.close()
+def filter_peaks_ignore(putative_peaks, ignore_bed, out_suffix=''):
+    # index fuzzed ignore regions
+    keep_lines = verbose or print_filtered_peaks
+    ignore_regions = ignore_index(ignore_bed, fuzz=3, keep_lines=keep_lines)
+
+    peaks = putative_peaks.peaks
+    ignored = np.zeros(len(peaks), dtype='bool')
+    ignored_first = np.zeros(len(peaks), dtype='int64')
+    ignored_last = np.zeros(len(peaks), dtype='int64')
+
+    # query each chromosome's peaks at once
+    for ci in range(len(putative_peaks.chroms)):
+        chrom = putative_peaks.chroms[ci]
+        if chrom in ignore_regions:
+            starts, ends, max_ends, orders, lines = ignore_regions[chrom]
+            chrom_pi = np.nonzero(peaks['chrom'] == ci)[0]
+
+            # regions starting by the peak end, and reaching the peak start
+            ignored_last[chrom_pi] = np.searchsorted(starts, peaks['end'][chrom_pi], side='right')
+            ignored_first[chrom_pi] = np.searchsorted(max_ends, peaks['start'][chrom_pi], side='left')
+            ignored[chrom_pi] = (ignored_first[chrom_pi] < ignored_last[chrom_pi])
+
+    if keep_lines:
+        # print overlaps in ignore_bed order, like intersectBed -wo
+        ignore_filter_out = open('%s/filtered_peaks_ignore%s.gff' % (out_dir,out_suffix), 'w')
+
+        ignored_pi = np.nonzero(ignored)[0]
+        ignored_gff = putative_peaks.subset(ignored_pi).gff_lines()
+        for pi, peak_gff in zip(ignored_pi, ignored_gff):
+            starts, ends, max_ends, orders, lines = ignore_regions[putative_peaks.chroms[peaks['chrom'][pi]]]
+            pstart = peaks['start'][pi]
+            pend = peaks['end'][pi]
+
+            lo = ignored_first[pi]
+            hi = ignored_last[pi]
+            overlap_i = np.arange(lo,hi)[ends[lo:hi] >= pstart]
+            overlap_i = overlap_i[np.argsort(orders[overlap_i], kind='mergesort')]
+            for oi in overlap_i:
+                overlap = min(pend,ends[oi]) - max(pstart,starts[oi]) + 1
+                print >> ignore_filter_out, '%s\t%s\t%d' % (peak_gff, lines[oi], overlap)
+
+        ignore_filter_out.close()
+
+    return putative_peaks.subset(~ignored)
 
-    # add fuzz to ignore_bed
-    fuzz = 3
-    ignorez_out = open('%s/ignore_fuzz.bed' % out_dir, 'w')
-    for line in open(ignore_bed):
-        a = line.split('\t')
-        a[1] = str(max(1,int(a[1])-fuzz))
-        a[2] = str(int(a[2])+fuzz)
-        print >> ignorez_out, '\t'.join(a),
-    ignorez_out.close()
-    
-    # intersect with ignore regions
-    subprocess.call('intersectBed -wo -a %s/putative.gff -b %s/ignore_fuzz.bed > %s/filtered_peaks_ignore.gff' % (out_dir,out_dir,out_dir), shell=True)
-
-    # hash ignored peaks
-    ignored_peaks = set()
-    for line in open('%s/filtered_peaks_ignore.gff' % out_dir):
-        a = line.split('\t')
-        peak_tuple = (a[0], int(a[3]), int(a[4]), a[6])
-        ignored_peaks.add(peak_tuple)
 
-    # filter putative_peaks
-    filtered_peaks = []
-    for peak in putative_peaks:
-        peak_tuple = (peak.chrom, peak.start, peak.end, peak.strand)
-        if peak_tuple not in ignored_peaks:
-            filtered_peaks.append(peak)
+################################################################################
+# fpkm_coverage
+#
+# Build the FPKM-weighted exonic coverage track for a gene by adding each
+# exon's FPKM at its start and dropping it after its end.
+#
+# Recall that junctions contains the 1st bp of the next exon/intron, so even
+# indexes begin exons and odd indexes begin introns.
+#
+# Input
+#  gene_transcripts: Hash mapping transcript_id to isoform Gene objects,
+#                     containing only keys for a specific gene.
+#  gene_start:       Start of the gene's span.
+#  gene_end:         End of the gene's span.
+#
+# Output
+#  fpkm_cov:         Array of isoform FPKMs summed at each bp from gene_start
+#                     to gene_end.
+################################################################################
+def fpkm_coverage(gene_transcripts, gene_start, gene_end):
+    gene_len = gene_end - gene_start + 1
 
-    # clean
-    os.remove('%s/ignore_fuzz.bed' % out_dir)
-    os.remove('%s/putative.gff' % out_dir)
+    fpkm_events = np.zeros(gene_len+1)
+    for tx in gene_transcripts.values():
+        tjunctions = np.clip(np.array(tx.junctions, dtype='int64'), gene_start, gene_end+1) - gene_start
+        np.add.at(fpkm_events, tjunctions[0:-1:2], tx.fpkm)
+        np.add.at(fpkm_events, tjunctions[1::2], -tx.fpkm)
 
-    return filtered_peaks
+    return np.cumsum(fpkm_events[:-1])
 
 
 ################################################################################
@@ -842,17 +1993,43 @@ def gene_attrs(gene_transcripts):
         gene_chrom = tx.chrom
         gene_strand = tx.strand
         if gene_start == None:
-            gene_start = tx.exons[0].start
+            gene_start = tx.start
         else:
-            gene_start = min(gene_start, tx.exons[0].start)
+            gene_start = min(gene_start, tx.start)
         if gene_end == None:
-            gene_end = tx.exons[-1].end
+            gene_end = tx.end
         else:
-            gene_end = max(gene_end, tx.exons[-1].end)
+            gene_end = max(gene_end, tx.end)
 
     return gene_chrom, gene_strand, gene_start, gene_end
 
 
+################################################################################
+# gene_tracks
+#
+# Build the read and coverage tracks that count_windows scans, so that they
+# can be shared across window sizes and p-values.
+#
+# Input
+#  read_pos_weights: Sorted list of read alignment positions and weights.
+#  gene_transcripts: Hash mapping transcript_id to isoform Gene objects,
+#                     containing only keys for a specific gene.
+#  gene_start:       Start of the gene's span.
+#  gene_end:         End of the gene's span.
+#
+# Output
+#  tracks:           Hash of read positions, weights, and cumulative weights,
+#                     the FPKM coverage track, and an empty hash for
+#                     count_windows to keep each window size's windows.
+################################################################################
+def gene_tracks(read_pos_weights, gene_transcripts, gene_start, gene_end):
+    read_positions, read_weights, read_mm = read_arrays(read_pos_weights)
+    read_cumweights = np.concatenate(([0.0], np.cumsum(read_weights)))
+
+    return {'read_positions':read_positions, 'read_weights':read_weights, 'read_cumweights':read_cumweights,
+            'fpkm_cov':fpkm_coverage(gene_transcripts, gene_start, gene_end), 'windows':{}}
+
+
 ################################################################################
 # get_gene_regions
 #
@@ -870,86 +2047,404 @@ def get_gene_regions(transcripts):
 
     for tid in transcripts:
         tx = transcripts[tid]
-        gid = tx.kv['gene_id']
+        gid = tx.gene_id
 
         if not gid in gene_regions:
-            gene_regions[gid] = [tx.chrom, tx.exons[0].start, tx.exons[-1].end, tx.strand]
+            gene_regions[gid] = [tx.chrom, tx.start, tx.end, tx.strand]
         else:
-            gene_regions[gid][1] = min(gene_regions[gid][1], tx.exons[0].start)
-            gene_regions[gid][2] = max(gene_regions[gid][2], tx.exons[-1].end)
+            gene_regions[gid][1] = min(gene_regions[gid][1], tx.start)
+            gene_regions[gid][2] = max(gene_regions[gid][2], tx.end)
 
     return gene_regions
 
 
 ################################################################################
-# merged_g2t
+# gtf_regions
 #
-# Merge overlapping genes and return the resulting gene_id to transcript_id
-# mapping.
+# Merge the intervals of all GTF entries into sorted, non-overlapping regions
+# for each chromosome.
 #
 # Input
-#  ref_gtf:            GTF file
-#  unstranded:         Sequencing is unstranded, so handle antisense overlapping
+#  ref_gtf:   GTF file.
 #
 # Output
-#  g2t:                Hash mapping gene_id's to transcript_id's
-#  antisense_clusters: Set of gene_id's describing clusters with antisense overlap
+#  regions:   Hash mapping chromosomes to (starts, ends) lists of 1-based,
+#              inclusive region coordinates.
 ################################################################################
-def merged_g2t(ref_gtf, unstranded):
-    # make gene span file
-    span_gtf(ref_gtf, level='gene_id')
-
-    un_str = '-s'
-    if unstranded:
-        un_str = ''
-
-    # intersect spans
-    p = subprocess.Popen('intersectBed -wo %s -a %s/span.gtf -b %s/span.gtf' % (un_str,out_dir,out_dir), shell=True, stdout=subprocess.PIPE)
-
-    # map gene_id's to sets of overlapping genes
-    id_map = {}
-    antisense_genes = set()
-    for line in p.stdout:
+def gtf_regions(ref_gtf):
+    # collect intervals
+    chrom_intervals = {}
+    for line in open(ref_gtf):
+        if line.startswith('#'):
+            continue
         a = line.split('\t')
+        chrom_intervals.setdefault(a[0],[]).append((int(a[3]), int(a[4])))
+
+    # merge
+    regions = {}
+    for chrom in chrom_intervals:
+        starts = []
+        ends = []
+        for istart, iend in sorted(chrom_intervals[chrom]):
+            if ends and istart <= ends[-1]:
+                ends[-1] = max(ends[-1], iend)
+            else:
+                starts.append(istart)
+                ends.append(iend)
+        regions[chrom] = (starts, ends)
 
-        gid1 = gff.gtf_kv(a[8])['gene_id']
-        gid2 = gff.gtf_kv(a[17])['gene_id']
+    return regions
 
-        gene_cluster = set([gid1,gid2]) | id_map.get(gid1,set()) | id_map.get(gid2,set())
-        for gid in gene_cluster:
-            id_map[gid] = gene_cluster
 
-        strand1 = a[6]
-        strand2 = a[15]
-        if strand1 != strand2:
-            antisense_genes.add(gid1)
-            antisense_genes.add(gid2)
+################################################################################
+# hash_bam_region
+#
+# Decompress the BGZF blocks of a BAM between two virtual offsets, and add
+# the bytes to a hash.
+#
+# Input
+#  key_hash: hashlib hash to update.
+#  bam_in:   BAM file opened in binary mode.
+#  v_start:  Virtual offset to start at.
+#  v_end:    Virtual offset to stop before.
+################################################################################
+def hash_bam_region(key_hash, bam_in, v_start, v_end):
+    block_offset = v_start >> 16
+    while block_offset <= (v_end >> 16):
+        bam_in.seek(block_offset)
+        header = bam_in.read(18)
+        if len(header) < 18:
+            break
 
-    # clean
-    p.communicate()
-    os.remove('%s/span.gtf' % out_dir)
+        # BSIZE is the block size minus one
+        block_size = struct.unpack_from('<H', header, 16)[0] + 1
+        block = zlib.decompress(bam_in.read(block_size-18)[:-8], -15)
 
-    # set cluster gene_id's and map genes to transcripts
-    g2t = {}
-    for line in open(ref_gtf):
-        a = line.split('\t')
-        kv = gff.gtf_kv(a[8])
+        # trim to the region
+        block_end = len(block)
+        if block_offset == (v_end >> 16):
+            block_end = v_end & 0xffff
+        block_start = 0
+        if block_offset == (v_start >> 16):
+            block_start = v_start & 0xffff
+        key_hash.update(block[block_start:block_end])
 
-        if kv['gene_id'] in id_map:
-            gene_id = ','.join(sorted(list(id_map[kv['gene_id']])))
-        else:
-            gene_id = kv['gene_id']
+        block_offset += block_size
 
-        g2t.setdefault(gene_id,set()).add(kv['transcript_id'])
 
-    # determine antisense clusters
-    antisense_clusters = set()
-    for gene_ids in g2t:
-        for gene_id in gene_ids.split(','):
-            if gene_id in antisense_genes:
-                antisense_clusters.add(gene_ids)
+################################################################################
+# hash_file
+#
+# Input
+#  key_hash:  hashlib hash to update.
+#  file_name: File whose contents to add to the hash.
+################################################################################
+def hash_file(key_hash, file_name):
+    file_in = open(file_name, 'rb')
+    block = file_in.read(1<<20)
+    while block:
+        key_hash.update(block)
+        block = file_in.read(1<<20)
+    file_in.close()
 
-    return g2t, antisense_clusters
+
+################################################################################
+# ignore_index
+#
+# Index the regions of a BED file by chromosome for overlap queries, expanding
+# each by fuzz bp. The file is streamed, and each chromosome's regions are kept
+# as arrays sorted by start, alongside the running maximum end, so the regions
+# overlapping [start,end] are those from the first whose running maximum end
+# reaches start to the last that starts by end.
+#
+# Input
+#  ignore_bed:     BED file specifying troublesome regions to ignore.
+#  fuzz:           Number of bp to expand each region by.
+#  keep_lines:     Keep the fuzzed BED lines for printing.
+#
+# Output
+#  ignore_regions: Hash mapping chromosomes to (starts, ends, max_ends, orders,
+#                   lines) tuples, with 1-based inclusive starts and ends, and
+#                   orders giving each region's line in ignore_bed.
+################################################################################
+def ignore_index(ignore_bed, fuzz=3, keep_lines=False):
+    # stream regions
+    chrom_regions = {}
+    chrom_lines = {}
+    for line in open(ignore_bed):
+        a = line.rstrip('\n').split('\t')
+        a[1] = str(max(1,int(a[1])-fuzz))
+        a[2] = str(int(a[2])+fuzz)
+
+        order = len(chrom_regions.setdefault(a[0],[]))
+        chrom_regions[a[0]].append((int(a[1])+1, int(a[2]), order))
+        if keep_lines:
+            chrom_lines.setdefault(a[0],[]).append('\t'.join(a))
+
+    # index each chromosome
+    ignore_regions = {}
+    for chrom in chrom_regions:
+        regions = sorted(chrom_regions[chrom])
+        starts = np.array([r[0] for r in regions], dtype='int64')
+        ends = np.array([r[1] for r in regions], dtype='int64')
+        orders = np.array([r[2] for r in regions], dtype='int64')
+        if keep_lines:
+            lines = [chrom_lines[chrom][r[2]] for r in regions]
+        else:
+            lines = None
+        ignore_regions[chrom] = (starts, ends, np.maximum.accumulate(ends), orders, lines)
+
+    return ignore_regions
+
+
+################################################################################
+# index_bam
+#
+# Index a BAM file with samtools, unless its index is at least as new as it.
+#
+# Input
+#  bam_file: BAM file.
+################################################################################
+def index_bam(bam_file):
+    bai_file = '%s.bai' % bam_file
+    if not os.path.isfile(bai_file) or os.path.getmtime(bai_file) < os.path.getmtime(bam_file):
+        subprocess.call('samtools index %s' % bam_file, shell=True)
+
+
+################################################################################
+# init_peak_calling
+#
+# Set the inputs shared by all genes for call_peaks_batch in this process.
+# Used directly when serial and as the pool initializer when parallel.
+#
+# Input
+#  clip_bam:              CLIP sequencing BAM.
+#  transcripts:           Hash mapping transcript_id keys to Gene class
+#                          instances.
+#  g2t:                   Hash mapping gene_id's to transcript_id's
+#  gene_ids:              List of merged gene_id's to process.
+#  window_sizes:          Scan statistic window sizes.
+#  sig_ps:                P-values at which to call window counts significant.
+#  clip_reads:            Total number of reads aligned to the transcriptome.
+#  txome_sizes:           Hash mapping window sizes to the number of
+#                          transcriptome windows.
+#  control_bam:           Control sequencing BAM, or None.
+#  norm_factor:           Ratio of total transcriptome CLIP to control reads, or
+#                          None.
+#  clip_positions_dir:    Cached CLIP read positions from save_positions, or
+#                          None.
+#  control_positions_dir: Cached control read positions, or None.
+#  journal_dir:           Journal directory from start_journal, or None.
+################################################################################
+def init_peak_calling(clip_bam, transcripts, g2t, gene_ids, window_sizes, sig_ps, clip_reads, txome_sizes, control_bam=None, norm_factor=None, clip_positions_dir=None, control_positions_dir=None, journal_dir=None):
+    global peak_calling
+    peak_calling = {'clip_bam':clip_bam, 'transcripts':transcripts, 'g2t':g2t, 'gene_ids':gene_ids, 'window_sizes':window_sizes, 'sig_ps':sig_ps, 'clip_reads':clip_reads, 'txome_sizes':txome_sizes, 'control_bam':control_bam, 'norm_factor':norm_factor, 'journal_dir':journal_dir}
+
+    # memory-map cached read positions
+    peak_calling['clip_positions'] = None
+    if clip_positions_dir:
+        peak_calling['clip_positions'] = load_positions(clip_positions_dir)
+    peak_calling['control_positions'] = None
+    if control_positions_dir:
+        peak_calling['control_positions'] = load_positions(control_positions_dir)
+
+
+################################################################################
+# journal_gene
+#
+# Append a gene's call_peaks_batch result to a journal as a JSON line, and
+# sync it to disk.
+#
+# Input
+#  journal_out: Open journal file.
+#  gene_id:     Merged gene_id.
+#  gene_result: (scale_peak_tuples, windows_offset, windows_bytes, seconds,
+#                od_stats) tuple.
+################################################################################
+def journal_gene(journal_out, gene_id, gene_result):
+    journal_out.write(dump_gene_result([gene_id], gene_result) + '\n')
+    journal_out.flush()
+    os.fsync(journal_out.fileno())
+
+
+################################################################################
+# load_annotation
+#
+# Load an annotation compiled by save_annotation, memory-mapping its arrays.
+#
+# The transcripts are views onto one TranscriptTable whose kv hashes hold only
+# gene_id and transcript_id, and g2t is ordered and maps to lists so that
+# iterating them matches the compiled run.
+#
+# Input
+#  annotation_dir: Compiled annotation directory.
+#
+# Output
+#  transcripts:    Hash mapping transcript_id keys to Gene class instances.
+#  g2t:            Hash mapping gene_id's to transcript_id's
+#  txome_sizes:    Hash mapping window sizes to the number of transcriptome
+#                   windows.
+################################################################################
+def load_annotation(annotation_dir):
+    arrays = {}
+    for name in annotation_arrays:
+        arrays[name] = np.load('%s/%s.npy' % (annotation_dir,name), mmap_mode='r')
+
+    # build transcripts, copying the arrays that may be modified
+    tx_ids = arrays['tx_ids'].tolist()
+    table = TranscriptTable(tx_ids, arrays['chroms'].tolist(), arrays['tx_chroms'], arrays['strands'].tolist(), np.array(arrays['tx_strands']), arrays['tx_gene_ids'].tolist(), None, np.array(arrays['tx_fpkms']), arrays['exon_offsets'], arrays['exon_starts'], arrays['exon_ends'], arrays['junction_offsets'], arrays['junctions'])
+    transcripts = table.genes()
+
+    # build clusters
+    cluster_ids = arrays['cluster_ids'].tolist()
+    cluster_offsets = arrays['cluster_offsets'].tolist()
+    cluster_txs = arrays['cluster_txs'].tolist()
+
+    g2t = collections.OrderedDict()
+    for ci in range(len(cluster_ids)):
+        g2t[cluster_ids[ci]] = [tx_ids[ti] for ti in cluster_txs[cluster_offsets[ci]:cluster_offsets[ci+1]]]
+
+    txome_sizes = dict(zip(arrays['window_sizes'].tolist(), arrays['txome_sizes'].tolist()))
+
+    return transcripts, g2t, txome_sizes
+
+
+################################################################################
+# load_cluster_cache
+#
+# Input
+#  cache_file:    Cluster cache from save_cluster_cache.
+#
+# Output
+#  cluster_cache: Hash mapping cluster_keys keys to (gene_id, gene_result)
+#                  tuples. Empty if there's no cache.
+################################################################################
+def load_cluster_cache(cache_file):
+    cluster_cache = {}
+    if os.path.isfile(cache_file):
+        for line in open(cache_file):
+            try:
+                (key, gene_id), gene_result = parse_gene_result(line, 2)
+            except ValueError:
+                continue
+            cluster_cache[key] = (gene_id, gene_result)
+
+    return cluster_cache
+
+
+################################################################################
+# load_cufflinks_cache
+#
+# Copy a cached run's Cufflinks files into the Cufflinks output directory,
+# and mark the run as recently used.
+#
+# Input
+#  cache_dir: Shared Cufflinks cache directory.
+#  key:       Run key from cufflinks_cache_key.
+#  cuff_dir:  Cufflinks output directory.
+#
+# Output
+#  hit:       True if the run was cached.
+################################################################################
+def load_cufflinks_cache(cache_dir, key, cuff_dir):
+    run_dir = '%s/%s' % (cache_dir, key)
+    try:
+        for cuff_file in cufflinks_cache_files:
+            shutil.copy('%s/%s' % (run_dir,cuff_file), '%s/%s' % (cuff_dir,cuff_file))
+        os.utime(run_dir, None)
+    except (IOError, OSError):
+        return False
+
+    return True
+
+
+################################################################################
+# load_journal
+#
+# Load the genes finished by an earlier run from its journal, if the run's
+# manifest matches. A line cut off by the run's interruption is skipped.
+#
+# Input
+#  journal_dir:     Journal directory.
+#  manifest:        Hash describing this run's inputs and options.
+#
+# Output
+#  journal_results: Hash mapping gene_id's to call_peaks_batch results, or
+#                    None if the journal is missing or doesn't match.
+################################################################################
+def load_journal(journal_dir, manifest):
+    try:
+        journal_manifest = json.load(open('%s/manifest.json' % journal_dir))
+    except (IOError, ValueError):
+        return None
+
+    if journal_manifest != json.loads(json.dumps(manifest)):
+        return None
+
+    journal_results = {}
+    for journal_file in sorted(os.listdir(journal_dir)):
+        if journal_file.startswith('genes.'):
+            for line in open('%s/%s' % (journal_dir,journal_file)):
+                try:
+                    (gene_id,), gene_result = parse_gene_result(line, 1)
+                except ValueError:
+                    continue
+                journal_results[gene_id] = gene_result
+
+    return journal_results
+
+
+################################################################################
+# load_positions
+#
+# Memory-map read positions cached by save_positions.
+#
+# Input
+#  positions_dir: Cached read positions directory.
+#
+# Output
+#  positions:     Hash with an index mapping gene_id's to (start, end) slices
+#                  of the positions, weights, and multimap arrays.
+################################################################################
+def load_positions(positions_dir):
+    gene_ids = np.load('%s/gene_ids.npy' % positions_dir).tolist()
+    starts = np.load('%s/starts.npy' % positions_dir).tolist()
+    ends = np.load('%s/ends.npy' % positions_dir).tolist()
+
+    positions = {'index':dict(zip(gene_ids, zip(starts, ends)))}
+    for name, dtype in positions_columns:
+        column_file = '%s/%s.bin' % (positions_dir,name)
+        if os.path.getsize(column_file) > 0:
+            positions[name] = np.memmap(column_file, dtype=dtype, mode='r')
+        else:
+            positions[name] = np.zeros(0, dtype=dtype)
+
+    return positions
+
+
+################################################################################
+# load_preflight
+#
+# Load the preflight sidecar saved next to a BAM file by preflight_bam, if
+# the BAM's size and modification time still match it.
+#
+# Input
+#  bam_file:  BAM file.
+#
+# Output
+#  preflight: Hash of the saved preflight stats, or None.
+################################################################################
+def load_preflight(bam_file):
+    try:
+        preflight = json.load(open('%s.preflight.json' % bam_file))
+    except (IOError, ValueError):
+        return None
+
+    bam_stat = os.stat(bam_file)
+    if preflight.get('version') != preflight_version or preflight.get('bam_size') != bam_stat.st_size or preflight.get('bam_mtime') != bam_stat.st_mtime:
+        return None
+
+    return preflight
 
 
 ################################################################################
@@ -1058,6 +2553,193 @@ def merge_windows(window_stats, window_size, sig_p, gene_start, allowed_sig_gap
     return merged_windows    
 
 
+################################################################################
+# merged_g2t
+#
+# Merge overlapping genes and return the resulting gene_id to transcript_id
+# mapping. Gene spans are clustered by a sweep over spans sorted by start, and
+# antisense overlaps found by bisecting the other strands' sorted starts.
+#
+# Input
+#  ref_gtf:            GTF file
+#  unstranded:         Sequencing is unstranded, so handle antisense overlapping
+#
+# Output
+#  g2t:                Hash mapping gene_id's to transcript_id's
+#  antisense_clusters: Set of gene_id's describing clusters with antisense overlap
+################################################################################
+def merged_g2t(ref_gtf, unstranded):
+    # obtain gene spans
+    gene_regions = get_gene_regions(read_genes(ref_gtf, key_id='transcript_id'))
+
+    # group spans to sweep, ignoring strand if unstranded
+    sweep_spans = {}
+    for gid in gene_regions:
+        gchrom, gstart, gend, gstrand = gene_regions[gid]
+        if unstranded:
+            sweep_key = gchrom
+        else:
+            sweep_key = (gchrom, gstrand)
+        sweep_spans.setdefault(sweep_key,[]).append((gstart, gend, gstrand, gid))
+
+    # map gene_id's to sets of overlapping genes
+    id_map = {}
+    antisense_genes = set()
+    for sweep_key in sweep_spans:
+        spans = sorted(sweep_spans[sweep_key])
+
+        # cluster spans overlapping the running cluster end
+        gene_cluster = set()
+        cluster_end = None
+        for gstart, gend, gstrand, gid in spans:
+            if cluster_end == None or gstart > cluster_end:
+                gene_cluster = set()
+                cluster_end = gend
+            else:
+                cluster_end = max(cluster_end, gend)
+            gene_cluster.add(gid)
+            id_map[gid] = gene_cluster
+
+        if unstranded:
+            # sorted starts and running max ends per strand
+            strand_starts = {}
+            strand_max_ends = {}
+            for gstart, gend, gstrand, gid in spans:
+                strand_starts.setdefault(gstrand,[]).append(gstart)
+                max_ends = strand_max_ends.setdefault(gstrand,[])
+                max_ends.append(max(gend, max_ends[-1]) if max_ends else gend)
+
+            # find genes overlapping a gene on another strand
+            for gstart, gend, gstrand, gid in spans:
+                for ostrand in strand_starts:
+                    if ostrand != gstrand:
+                        # another strand gene starts within this gene
+                        si = bisect_left(strand_starts[ostrand], gstart)
+                        if si < len(strand_starts[ostrand]) and strand_starts[ostrand][si] <= gend:
+                            antisense_genes.add(gid)
+
+                        # or an earlier another strand gene reaches it
+                        elif si > 0 and strand_max_ends[ostrand][si-1] >= gstart:
+                            antisense_genes.add(gid)
+
+    # set cluster gene_id's and map genes to transcripts
+    g2t = {}
+    for line in open(ref_gtf):
+        a = line.split('\t')
+        kv = gff.gtf_kv(a[8])
+
+        if kv['gene_id'] in id_map:
+            gene_id = ','.join(sorted(list(id_map[kv['gene_id']])))
+        else:
+            gene_id = kv['gene_id']
+
+        g2t.setdefault(gene_id,set()).add(kv['transcript_id'])
+
+    # determine antisense clusters
+    antisense_clusters = set()
+    for gene_ids in g2t:
+        for gene_id in gene_ids.split(','):
+            if gene_id in antisense_genes:
+                antisense_clusters.add(gene_ids)
+
+    return g2t, antisense_clusters
+
+
+################################################################################
+# multimap_fraction
+#
+# Input
+#  preflight: Hash of BAM stats from preflight_bam.
+#
+# Output
+#  mm_frac:   Fraction of the mapped alignments with NH > 1.
+################################################################################
+def multimap_fraction(preflight):
+    alignments = sum(preflight['nh_counts'].values())
+    if alignments == 0:
+        return 0.0
+    return 1.0 - preflight['nh_counts'].get('1',0) / float(alignments)
+
+
+################################################################################
+# overdispersion_stats
+#
+# Compare CLIP and normalized control fragments in consecutive windows across
+# a gene, and sum the terms of the overdispersion regression.
+#
+# Input
+#  clip_read_pos_weights:    Sorted list of CLIP read (position, weight,
+#                             multimap) tuples.
+#  control_read_pos_weights: Sorted list of control read (position, weight,
+#                             multimap) tuples.
+#  gene_start:               Start of the gene's span.
+#  gene_end:                 End of the gene's span.
+#  window_size:              Scan statistic window size.
+#  norm_factor:              Ratio of total transcriptome CLIP to control reads
+#
+# Output
+#  od_stats:                 Tuple of the sums of mean*variance, mean^2, and
+#                             mean^3 over windows, followed by the window means
+#                             and variances when verbose (or None's).
+################################################################################
+def overdispersion_stats(clip_read_pos_weights, control_read_pos_weights, gene_start, gene_end, window_size, norm_factor):
+    # windows start every window_size bp, while they end before the gene does
+    window_starts = np.arange(gene_start, gene_end-window_size, window_size)
+
+    # sum fragments in each window, including its end
+    window_frags = []
+    for read_pos_weights in [clip_read_pos_weights, control_read_pos_weights]:
+        read_positions, read_weights, read_mm = read_arrays(read_pos_weights)
+        read_cumweights = np.concatenate(([0.0], np.cumsum(read_weights)))
+        reads_start_i = np.searchsorted(read_positions, window_starts, side='left')
+        reads_end_i = np.searchsorted(read_positions, window_starts+window_size, side='right')
+        window_frags.append(read_cumweights[reads_end_i] - read_cumweights[reads_start_i])
+    clip_frags, control_frags = window_frags
+
+    # normalize control fragments
+    control_frags *= norm_factor
+
+    # mean and variance
+    u = 0.5*clip_frags + 0.5*control_frags
+    var = (clip_frags - u)**2 + (control_frags - u)**2
+
+    if verbose:
+        return (float((u*var).sum()), float((u**2).sum()), float((u**3).sum()), u, var)
+    else:
+        return (float((u*var).sum()), float((u**2).sum()), float((u**3).sum()), None, None)
+
+
+################################################################################
+# parse_gene_result
+#
+# Input
+#  line:        JSON line from dump_gene_result.
+#  num_labels:  Number of labels preceding the result.
+#
+# Output
+#  labels:      List of str labels.
+#  gene_result: (scale_peak_tuples, 0, 0, seconds, od_stats) tuple, without
+#                window stats.
+#
+# Raises ValueError for a malformed line, such as one cut off mid-write.
+################################################################################
+def parse_gene_result(line, num_labels):
+    fields = json.loads(line)
+    if not isinstance(fields, list) or len(fields) != num_labels+3:
+        raise ValueError('Malformed gene result')
+
+    labels = [str(label) for label in fields[:num_labels]]
+    scale_peak_tuples, seconds, od_stats = fields[num_labels:]
+
+    # restore peak tuples, with str's
+    for si in range(len(scale_peak_tuples)):
+        for pi in range(len(scale_peak_tuples[si])):
+            pt = scale_peak_tuples[si][pi]
+            scale_peak_tuples[si][pi] = (str(pt[0]), pt[1], pt[2], str(pt[3]), str(pt[4])) + tuple(pt[5:])
+
+    return labels, (scale_peak_tuples, 0, 0, seconds, od_stats)
+
+
 ################################################################################
 # peak_stats
 #
@@ -1080,7 +2762,7 @@ def peak_stats(windows_counts, gene_transcripts, total_reads, txome_size):
         # set index of the first junction ahead of the window start for each transcript
         junctions_i = {}
         for tid in gene_transcripts:
-            junctions_i[tid] = bisect_left(gene_transcripts[tid].junctions, wstart)
+            junctions_i[tid] = int(np.searchsorted(gene_transcripts[tid].junctions, wstart, side='left'))
 
         peak_lambda = convolute_lambda(wstart, wend, gene_transcripts, junctions_i, total_reads)
 
@@ -1090,6 +2772,50 @@ def peak_stats(windows_counts, gene_transcripts, total_reads, txome_size):
     return peaks
 
 
+################################################################################
+# position_read
+#
+# Map a read alignment to a single genomic position, filtering for strand and
+# quality, and assign a weight.
+#
+# Input
+#  aligned_read:    pysam AlignedRead object.
+#  gene_strand:     Strand of the gene of interest.
+#  mapq_zero:       Return reads with zero mapq.
+#
+# Output
+#  read_pos_weight: Tuple of (position, weight, multimap), or None if filtered.
+################################################################################
+def position_read(aligned_read, gene_strand, mapq_zero=False):
+    # assign strand
+    try:
+        ar_strand = aligned_read.opt('XS')
+    except:
+        # just allow it
+        ar_strand = gene_strand
+
+    # downweight multimappers
+    if aligned_read.mapq > 0:
+        mm_weight = 1.0/aligned_read.opt('NH')
+    else:
+        mm_weight = 0.0
+
+    # check strand and quality
+    if gene_strand == '*' or gene_strand == ar_strand:
+        if mapq_zero or aligned_read.mapq > 0:
+            if aligned_read.is_paired:
+                # map read to endpoint (closer to fragment center)
+                if aligned_read.is_reverse:
+                    return (aligned_read.pos+1, 0.5*mm_weight, mm_weight<1)
+                else:
+                    return (cigar_endpoint(aligned_read), 0.5*mm_weight, mm_weight<1)
+            else:
+                # map read to midpoint
+                return (cigar_midpoint(aligned_read), 1.0*mm_weight, mm_weight<1)
+
+    return None
+
+
 ################################################################################
 # position_reads
 #
@@ -1105,216 +2831,1082 @@ def peak_stats(windows_counts, gene_transcripts, total_reads, txome_size):
 #  mapq_zero:        Return reads with zero mapq.
 #
 # Output
-#  read_pos_weights: Sorted list of read alignment (position, weight, multimap)
+#  read_pos_weights: Sorted list of read alignment (position, weight, multimap)
+################################################################################
+def position_reads(clip_in, gene_chrom, gene_start, gene_end, gene_strand, mapq_zero=False):
+    read_pos_weights = []
+
+    if gene_chrom in clip_in.references:
+        # Note: fetch is dumb. it says it's 0-based, but my experiments suggsted the 
+        #       adjustment below.
+
+        # for each read in span
+        for aligned_read in clip_in.fetch(gene_chrom, gene_start, gene_end-1):
+            read_pos_weight = position_read(aligned_read, gene_strand, mapq_zero)
+            if read_pos_weight:
+                read_pos_weights.append(read_pos_weight)
+
+        # in case of differing read alignment lengths
+        read_pos_weights.sort()
+
+    return read_pos_weights
+
+
+################################################################################
+# position_reads_chunk
+#
+# Position the reads for one sub-chunk of a gene cluster, using the inputs set
+# by init_peak_calling. Each read belongs to the chunk containing its
+# alignment start, since insertions can position a read past the end of its
+# alignment, and so past what a fetch of the chunk would return. Sorting the
+# chunks' reads together then gives position_reads for the whole gene.
+#
+# Input
+#  bam_file:         BAM file to position reads from.
+#  gene_id:          Merged gene_id.
+#  own_start:        First position owned by the chunk, or None for the start.
+#  own_end:          First position past the chunk, or None for the end.
+#  mapq_zero:        Return reads with zero mapq.
+#
+# Output
+#  read_pos_weights: Sorted list of read alignment (position, weight, multimap)
+################################################################################
+def position_reads_chunk(bam_file, gene_id, own_start, own_end, mapq_zero=False):
+    pc = peak_calling
+
+    # make a more focused transcript hash for this gene
+    gene_transcripts = {}
+    for tid in pc['g2t'][gene_id]:
+        gene_transcripts[tid] = pc['transcripts'][tid]
+
+    # obtain basic gene attributes
+    (gchrom, gstrand, gstart, gend) = gene_attrs(gene_transcripts)
+
+    # fetch within the gene
+    fetch_start = gstart
+    if own_start != None:
+        fetch_start = max(gstart, own_start-1)
+    fetch_end = gend
+    if own_end != None:
+        fetch_end = min(gend, own_end)
+
+    bam_in = pysam.Samfile(bam_file, 'rb')
+    read_pos_weights = []
+    if gchrom in bam_in.references:
+        for aligned_read in bam_in.fetch(gchrom, fetch_start, fetch_end-1):
+            # keep the chunk's own reads
+            if own_start != None and aligned_read.pos+1 < own_start:
+                continue
+            if own_end != None and aligned_read.pos+1 >= own_end:
+                continue
+
+            read_pos_weight = position_read(aligned_read, gstrand, mapq_zero)
+            if read_pos_weight:
+                read_pos_weights.append(read_pos_weight)
+
+        read_pos_weights.sort()
+    bam_in.close()
+
+    return read_pos_weights
+
+
+################################################################################
+# positions_key
+#
+# Hash the BAM file and the gene cluster regions whose read positions are
+# cached, to name the cache.
+#
+# Input
+#  bam_file:  BAM file.
+#  gene_ids:  List of merged gene_id's.
+#  regions:   List of (chrom, start, end, strand) tuples for gene_ids.
+#  mapq_zero: Reads with zero mapq are positioned.
+#
+# Output
+#  key:       Hex digest identifying the cached read positions.
+################################################################################
+def positions_key(bam_file, gene_ids, regions, mapq_zero):
+    bam_stat = os.stat(bam_file)
+
+    key_hash = hashlib.sha1()
+    key_hash.update('positions_v%d %s size=%d mtime=%r mapq_zero=%d' % (positions_version, os.path.abspath(bam_file), bam_stat.st_size, bam_stat.st_mtime, mapq_zero))
+    for gi in range(len(gene_ids)):
+        key_hash.update('\n%s %s %d %d %s' % ((gene_ids[gi],) + regions[gi]))
+
+    return key_hash.hexdigest()[:16]
+
+
+################################################################################
+# preflight_bam
+#
+# Index a BAM file if needed and stream it once to collect the mean and SD of
+# the read length (as Cufflinks' -m and -s), the total and
+# transcriptome-compatible fragment counts, and the NH distribution.
+# Fragments weight multimappers by 1/NH and paired reads by 1/2, and are
+# compatible if their alignment spans overlap a region of ref_gtf. The stats
+# are saved to <bam_file>.preflight.json and reused while the BAM is
+# unchanged, with the compatible counts kept for each GTF's content, so that
+# rewriting an identical transcripts.gtf still hits. Counts are dropped once
+# the GTF they were taken from is gone or holds different content.
+#
+# Input
+#  bam_file:  BAM file.
+#  ref_gtf:   GTF file defining the transcriptome, or None to skip the
+#              compatible count.
+#
+# Output
+#  preflight: Hash of the BAM stats, with compatible_fragments for ref_gtf.
+################################################################################
+def preflight_bam(bam_file, ref_gtf=None):
+    index_bam(bam_file)
+
+    gtf_key = None
+    regions = {}
+    if ref_gtf:
+        key_hash = hashlib.sha1()
+        hash_file(key_hash, ref_gtf)
+        gtf_key = key_hash.hexdigest()[:16]
+
+    preflight = load_preflight(bam_file)
+    if preflight and (gtf_key == None or gtf_key in preflight['compatible_gtfs']):
+        if gtf_key:
+            preflight['compatible_fragments'] = preflight['compatible_gtfs'][gtf_key]['fragments']
+        return preflight
+
+    if ref_gtf:
+        regions = gtf_regions(ref_gtf)
+
+    bam_in = pysam.Samfile(bam_file, 'rb')
+
+    fragments = 0.0
+    compatible_fragments = 0.0
+    length_n = 0
+    length_sum = 0.0
+    length_sum2 = 0.0
+    nh_counts = {}
+
+    for aligned_read in bam_in.fetch(until_eof=True):
+        if aligned_read.is_unmapped:
+            continue
+
+        nh = aligned_read.opt('NH')
+        nh_counts[nh] = nh_counts.get(nh,0) + 1
+
+        # read length of uniquely placed reads
+        if aligned_read.mapq > 0:
+            length_n += 1
+            length_sum += aligned_read.rlen
+            length_sum2 += aligned_read.rlen**2
+
+        if aligned_read.is_paired:
+            read_fragments = 0.5/nh
+        else:
+            read_fragments = 1.0/nh
+        fragments += read_fragments
+
+        if aligned_read.aend == None:
+            continue
+
+        chrom = bam_in.getrname(aligned_read.tid)
+        if chrom not in regions:
+            continue
+        starts, ends = regions[chrom]
+
+        # last region starting before the read ends
+        ri = bisect_right(starts, aligned_read.aend) - 1
+        if ri >= 0 and ends[ri] > aligned_read.pos:
+            compatible_fragments += read_fragments
+
+    bam_in.close()
+
+    # read length mean and SD
+    read_mean = 0.0
+    read_sd = 0.0
+    if length_n > 0:
+        read_mean = length_sum / length_n
+        read_sd = math.sqrt(max(0, length_sum2/length_n - read_mean**2))
+
+    # keep the other GTFs' counts
+    compatible_gtfs = {}
+    if preflight:
+        # keep the other GTFs' counts, while their files still exist and
+        # aren't ref_gtf, whose content has changed
+        for key, compatible in preflight['compatible_gtfs'].items():
+            if os.path.isfile(compatible['gtf']) and (ref_gtf == None or compatible['gtf'] != os.path.abspath(ref_gtf)):
+                compatible_gtfs[key] = compatible
+    if gtf_key:
+        compatible_gtfs[gtf_key] = {'gtf':os.path.abspath(ref_gtf), 'fragments':compatible_fragments}
+
+    bam_stat = os.stat(bam_file)
+    preflight = {'version':preflight_version, 'bam_size':bam_stat.st_size, 'bam_mtime':bam_stat.st_mtime,
+                 'read_length':int(read_mean+0.5), 'read_sd':int(read_sd+0.5),
+                 'fragments':fragments, 'compatible_gtfs':compatible_gtfs,
+                 'nh_counts':dict([(str(nh),nh_counts[nh]) for nh in nh_counts])}
+
+    # write to a temporary file and move it into place
+    preflight_file = '%s.preflight.json' % bam_file
+    tmp_file = '%s.%d.tmp' % (preflight_file, os.getpid())
+    try:
+        preflight_out = open(tmp_file, 'w')
+        json.dump(preflight, preflight_out, sort_keys=True)
+        preflight_out.close()
+        os.rename(tmp_file, preflight_file)
+    except (IOError, OSError):
+        print >> sys.stderr, 'WARNING: Could not save BAM preflight to %s' % preflight_file
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+
+    if gtf_key:
+        preflight['compatible_fragments'] = compatible_fragments
+    return preflight
+
+
+################################################################################
+# preflight_bams
+#
+# Run preflight_bam on each BAM, in parallel if threads allow.
+#
+# Input
+#  bam_files:  List of BAM files.
+#  ref_gtf:    GTF file defining the transcriptome.
+#  threads:    Number of processes to use.
+#
+# Output
+#  preflights: List of preflight_bam results for bam_files.
+################################################################################
+def preflight_bams(bam_files, ref_gtf, threads):
+    preflight_tasks = [(bam_file, ref_gtf) for bam_file in bam_files]
+
+    if threads <= 1 or len(bam_files) <= 1:
+        return [preflight_task(task) for task in preflight_tasks]
+    else:
+        pool = multiprocessing.Pool(min(threads, len(bam_files)))
+        preflights = pool.map(preflight_task, preflight_tasks)
+        pool.close()
+        pool.join()
+        return preflights
+
+
+################################################################################
+# preflight_task
+#
+# Run preflight_bam on a (bam_file, ref_gtf) tuple in a pool process.
+################################################################################
+def preflight_task(task):
+    return preflight_bam(*task)
+
+
+################################################################################
+# prerna_gtf
+#
+# Remove promiscuously overlapping genes, add unspliced preRNAs to the gtf file,
+# focus on exons, and remove redundancies.
+#
+# Input
+#  ref_gtf:     Reference GTF file to expand with unspliced preRNAs.
+#
+# Output
+#  prerna.gtf:  Expanded GTF file.
+#  pre_ref_gtf: The filename of the expanded GTF file.
+################################################################################
+def prerna_gtf(ref_gtf):
+    # make transcript span file
+    span_gtf(ref_gtf, level='transcript_id')
+
+    # intersect spans
+    p = subprocess.Popen('intersectBed -wo -s -a %s/span.gtf -b %s/span.gtf' % (out_dir,out_dir), shell=True, stdout=subprocess.PIPE)
+
+    # count genes overlapped by each transcript
+    tx_overlaps = {}
+    for line in p.stdout:
+        a = line.split('\t')
+
+        kv1 = gff.gtf_kv(a[8])
+        tid1 = kv1['transcript_id']
+        gid1 = kv1['gene_id']
+        gid2 = gff.gtf_kv(a[17])['gene_id']
+
+        if gid1 != gid2:
+            tx_overlaps.setdefault(tid1,set()).add(gid2)
+
+    p.communicate()
+    os.remove('%s/span.gtf' % out_dir)
+
+    # read transcripts for filtering/processing
+    transcripts = read_genes(ref_gtf, key_id='transcript_id')
+
+    # delete transcripts from promiscuously overlapping genes
+    for tid in transcripts.keys():
+        if len(tx_overlaps.get(tid,[])) > 5:
+            del transcripts[tid]
+    
+    # open prerna output gtf
+    pre_ref_gtf = '%s/prerna.gtf' % out_dir
+    pre_ref_open = open(pre_ref_gtf, 'w')
+
+    # add unspliced single exon transcripts to hash
+    unspliced_hash = set()
+    for tid in transcripts:
+        tx = transcripts[tid]
+        if len(tx.exons) == 1:
+            tx_key = (tx.chrom, tx.exons[0].start, tx.exons[0].end, tx.strand)
+            unspliced_hash.add(tx_key)
+
+    # process transcripts
+    unspliced_index = 0
+    for tid in transcripts:
+        tx = transcripts[tid]
+        pre_start = tx.exons[0].start
+        pre_end = tx.exons[-1].end
+        pre_key = (tx.chrom, pre_start, pre_end, tx.strand)
+
+        for i in range(len(tx.exons)):
+            cols = (tx.chrom, 'clip_peaks', 'exon', str(tx.exons[i].start), str(tx.exons[i].end), '.', tx.strand, '.', gff.kv_gtf(tx.kv))
+            print >> pre_ref_open, '\t'.join(cols)
+
+        if not pre_key in unspliced_hash:
+            unspliced_hash.add(pre_key)
+            pre_kv = copy.copy(tx.kv)
+            pre_kv['transcript_id'] = 'UNSPLICED%d' % unspliced_index
+            unspliced_index += 1
+            cols = (tx.chrom, 'clip_peaks', 'exon', str(pre_start), str(pre_end), '.', tx.strand, '.', gff.kv_gtf(pre_kv))
+            print >> pre_ref_open, '\t'.join(cols)
+
+    pre_ref_open.close()
+
+    return pre_ref_gtf
+
+
+################################################################################
+# quantize_lambdas
+#
+# Round lambdas to 40 mantissa bits (~1e-12 relative) so that values differing
+# only by floating point error share cache entries.
+#
+# Input
+#  lambdas:   Array of reads/nt.
+#
+# Output
+#  lambdas_q: Array of quantized reads/nt.
+################################################################################
+def quantize_lambdas(lambdas):
+    lambda_mant, lambda_exp = np.frexp(np.asarray(lambdas, dtype='float64'))
+    return np.ldexp(np.round(lambda_mant*2**40)/2**40, lambda_exp)
+
+
+################################################################################
+# read_abundances
+#
+# Read transcript FPKMs from an abundance table, recognizing its format in
+# abundance_formats by the header. Tables without FPKMs are converted from
+# fragment counts and effective lengths, normalizing by the total count.
+#
+# Input
+#  abundance_file:   Abundance table.
+#
+# Output
+#  abundance_format: Name of the table's format.
+#  tx_fpkms:         Hash mapping transcript_id's to FPKMs, or None for
+#                     failed transcripts.
+################################################################################
+def read_abundances(abundance_file):
+    abundance_in = open(abundance_file)
+    header = abundance_in.readline().rstrip('\n').split('\t')
+
+    abundance_format = None
+    for format_columns in abundance_formats:
+        if header[0] == format_columns[1] and set([col for col in format_columns[1:] if col]) <= set(header):
+            abundance_format, id_col, fpkm_col, count_col, length_col, status_col = format_columns
+    if abundance_format == None:
+        print >> sys.stderr, 'Unrecognized abundance table %s, with columns %s' % (abundance_file, ' '.join(header))
+        exit(1)
+
+    tids = []
+    values = []
+    failed = set()
+    for line in abundance_in:
+        a = dict(zip(header, line.rstrip('\n').split('\t')))
+        tids.append(a[id_col])
+        if fpkm_col:
+            values.append(float(a[fpkm_col]))
+        else:
+            values.append((float(a[count_col]), float(a[length_col])))
+        if status_col and a[status_col] == 'FAIL':
+            failed.add(a[id_col])
+    abundance_in.close()
+
+    if not fpkm_col:
+        # FPKM per effective kb and million fragments
+        total_count = max(sum([count for count, eff_length in values]), 1)
+        for ti in range(len(values)):
+            count, eff_length = values[ti]
+            if eff_length > 0:
+                values[ti] = 1e9 * count / eff_length / total_count
+            else:
+                values[ti] = 0.0
+
+    tx_fpkms = {}
+    for ti in range(len(tids)):
+        if tids[ti] in failed:
+            tx_fpkms[tids[ti]] = None
+        else:
+            tx_fpkms[tids[ti]] = values[ti]
+
+    return abundance_format, tx_fpkms
+
+
+################################################################################
+# read_arrays
+#
+# Split position_reads output into parallel arrays for vectorized counting.
+#
+# Input
+#  read_pos_weights: Sorted list of read alignment (position, weight, multimap)
+#
+# Output
+#  read_positions:   Array of read alignment positions.
+#  read_weights:     Array of read weights.
+#  read_mm:          Boolean array marking multimapping reads.
+################################################################################
+def read_arrays(read_pos_weights):
+    read_positions = np.array([pos for (pos,w,mm) in read_pos_weights], dtype='float64')
+    read_weights = np.array([w for (pos,w,mm) in read_pos_weights], dtype='float64')
+    read_mm = np.array([mm for (pos,w,mm) in read_pos_weights], dtype='bool')
+    return read_positions, read_weights, read_mm
+
+
+################################################################################
+# read_genes
+#
+# Parse a gtf file and return a set of Gene objects in a hash keyed by the
+# id given. The Genes are views onto one TranscriptTable.
+#
+# Input
+#  gtf_file: GTF file from which to read genes.
+#  key_id:   GTF key with which to hash the genes (transcript_id or gene_id)
+#
+# Output
+#  genes:    Hash mapping key_id to Gene objects.
+################################################################################
+def read_genes(gtf_file, key_id='transcript_id'):
+    # collect rows in order of appearance
+    rows = []
+    key_rows = {}
+    for line in open(gtf_file):
+        a = line.split('\t')
+
+        kv = gff.gtf_kv(a[8])
+        if not kv[key_id] in key_rows:
+            key_rows[kv[key_id]] = (kv[key_id], a[0], a[6], intern(kv['gene_id']), a[8].rstrip('\n'), [], [])
+            rows.append(key_rows[kv[key_id]])
+
+        if a[2] == 'exon':
+            key_rows[kv[key_id]][5].append(int(a[3]))
+            key_rows[kv[key_id]][6].append(int(a[4]))
+
+    return TranscriptTable.build(rows).genes()
+
+
+################################################################################
+# read_window_stats
+#
+# Read the window stats saved by --print_windows in a region.
+#
+# Input
+#  stats_prefix:  Window stats path without the .bin/.index extension, e.g.
+#                  <out_dir>/window_stats.
+#  chrom:         Chromosome of the region.
+#  start:         First window start in the region.
+#  end:           Last window start in the region.
+#
+# Output
+#  gene_windows:  List of (gene_id, windows) tuples for the clusters with
+#                  windows in the region, where windows is a structured array
+#                  with window_stats_dtype fields.
+################################################################################
+def read_window_stats(stats_prefix, chrom, start, end):
+    gene_windows = []
+
+    windows_in = open('%s.bin' % stats_prefix, 'rb')
+    for line in open('%s.index' % stats_prefix):
+        a = line.split('\t')
+        if a[1] == chrom and int(a[2]) <= end and int(a[3]) >= start:
+            windows_in.seek(int(a[4]))
+            windows = np.frombuffer(zlib.decompress(windows_in.read(int(a[5]))), dtype=window_stats_dtype)
+
+            # slice out the region
+            wstart_i = np.searchsorted(windows['start'], start, side='left')
+            wend_i = np.searchsorted(windows['start'], end, side='right')
+            if wstart_i < wend_i:
+                gene_windows.append((a[0], windows[wstart_i:wend_i]))
+    windows_in.close()
+
+    return gene_windows
+
+
+################################################################################
+# round_counts
+#
+# Round summed read weights to integer counts with int(x+0.5).
+#
+# Sums that land within floating point error of a half (e.g. built from
+# thirds and sixths) round differently depending on the order of addition, so
+# those are re-summed read by read to match counting the window directly.
+#
+# Input
+#  frags:         Array of summed read weights.
+#  read_weights:  Array of read weights.
+#  reads_start_i: Array of the first read index in each sum.
+#  reads_end_i:   Array of the first read index past each sum.
+#
+# Output
+#  counts:        Array of rounded counts.
+################################################################################
+def round_counts(frags, read_weights, reads_start_i, reads_end_i):
+    frags = np.array(frags, dtype='float64')
+
+    for i in np.nonzero(np.abs(frags - np.floor(frags) - 0.5) < 1e-6)[0]:
+        frags[i] = sum(read_weights[reads_start_i[i]:reads_end_i[i]].tolist())
+
+    return np.floor(frags + 0.5).astype('int64')
+
+
+################################################################################
+# save_annotation
+#
+# Compile the prepared transcripts and gene clusters into NumPy arrays in
+# annotation_dir, for load_annotation in later runs. Transcripts are stored in
+# the order of g2t, and clusters in g2t's iteration order, so loading
+# reproduces the order in which genes are processed.
+#
+# Input
+#  annotation_dir: Compiled annotation directory to write.
+#  transcripts:    Hash mapping transcript_id keys to Gene class instances,
+#                   with junctions and FPKMs set.
+#  g2t:            Hash mapping gene_id's to transcript_id's
+#  txome_sizes:    Hash mapping window sizes to the number of transcriptome
+#                   windows.
+################################################################################
+def save_annotation(annotation_dir, transcripts, g2t, txome_sizes):
+    chrom_codes = {}
+    strand_codes = {}
+    tx_ids = []
+    tx_gene_ids = []
+    tx_chroms = []
+    tx_strands = []
+    tx_fpkms = []
+    exon_offsets = [0]
+    exon_starts = []
+    exon_ends = []
+    junction_offsets = [0]
+    junctions = []
+    cluster_ids = []
+    cluster_offsets = [0]
+    cluster_txs = []
+
+    for gene_id in g2t:
+        cluster_ids.append(gene_id)
+        for tid in g2t[gene_id]:
+            tx = transcripts[tid]
+            cluster_txs.append(len(tx_ids))
+
+            tx_ids.append(tid)
+            tx_gene_ids.append(tx.gene_id)
+            tx_chroms.append(chrom_codes.setdefault(tx.chrom, len(chrom_codes)))
+            tx_strands.append(strand_codes.setdefault(tx.strand, len(strand_codes)))
+            tx_fpkms.append(tx.fpkm)
+
+            exons = tx.exons
+            exon_starts += [ex.start for ex in exons]
+            exon_ends += [ex.end for ex in exons]
+            exon_offsets.append(len(exon_starts))
+
+            junctions += list(tx.junctions)
+            junction_offsets.append(len(junctions))
+
+        cluster_offsets.append(len(cluster_txs))
+
+    chroms = [None]*len(chrom_codes)
+    for chrom in chrom_codes:
+        chroms[chrom_codes[chrom]] = chrom
+    strands = [None]*len(strand_codes)
+    for strand in strand_codes:
+        strands[strand_codes[strand]] = strand
+
+    window_sizes = sorted(txome_sizes.keys())
+
+    arrays = {'chroms':np.array(chroms, dtype='S'),
+              'strands':np.array(strands, dtype='S'),
+              'tx_ids':np.array(tx_ids, dtype='S'),
+              'tx_gene_ids':np.array(tx_gene_ids, dtype='S'),
+              'tx_chroms':np.array(tx_chroms, dtype='int32'),
+              'tx_strands':np.array(tx_strands, dtype='int8'),
+              'tx_fpkms':np.array(tx_fpkms, dtype='float64'),
+              'exon_offsets':np.array(exon_offsets, dtype='int64'),
+              'exon_starts':np.array(exon_starts, dtype='int32'),
+              'exon_ends':np.array(exon_ends, dtype='int32'),
+              'junction_offsets':np.array(junction_offsets, dtype='int64'),
+              'junctions':np.array(junctions, dtype='int32'),
+              'cluster_ids':np.array(cluster_ids, dtype='S'),
+              'cluster_offsets':np.array(cluster_offsets, dtype='int64'),
+              'cluster_txs':np.array(cluster_txs, dtype='int64'),
+              'window_sizes':np.array(window_sizes, dtype='int64'),
+              'txome_sizes':np.array([txome_sizes[window_size] for window_size in window_sizes], dtype='int64')}
+
+    # write to a temporary directory and move it into place, so a partial
+    # annotation is never loaded
+    tmp_dir = '%s.%d.tmp' % (annotation_dir, os.getpid())
+    try:
+        os.mkdir(tmp_dir)
+        for name in annotation_arrays:
+            np.save('%s/%s.npy' % (tmp_dir,name), arrays[name])
+        os.rename(tmp_dir, annotation_dir)
+    except (IOError, OSError):
+        print >> sys.stderr, 'WARNING: Could not save compiled annotation to %s' % annotation_dir
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+################################################################################
+# save_cluster_cache
+#
+# Save this run's results for each gene cluster under its key, keeping the
+# cached results for clusters outside this run, e.g. with --gene.
+#
+# Input
+#  cache_file:    Cluster cache file to write.
+#  cluster_cache: Previous cache from load_cluster_cache.
+#  gene_ids:      List of merged gene_id's.
+#  keys:          List of cluster_keys keys, in gene order.
+#  gene_results:  List of call_peaks_batch results, in gene order.
+################################################################################
+def save_cluster_cache(cache_file, cluster_cache, gene_ids, keys, gene_results):
+    run_gene_ids = set(gene_ids)
+
+    cache_out = open('%s.tmp' % cache_file, 'w')
+    for key in cluster_cache:
+        gene_id, gene_result = cluster_cache[key]
+        if gene_id not in run_gene_ids:
+            print >> cache_out, dump_gene_result([key, gene_id], gene_result)
+    for gi in range(len(gene_ids)):
+        print >> cache_out, dump_gene_result([keys[gi], gene_ids[gi]], gene_results[gi])
+    cache_out.close()
+
+    os.rename('%s.tmp' % cache_file, cache_file)
+
+
+################################################################################
+# save_cufflinks_cache
+#
+# Save the Cufflinks files from a finished run to the shared cache, and evict
+# old runs beyond the maximum size. The files are copied to a temporary
+# directory and moved into place, so concurrent runs only see complete
+# entries.
+#
+# Input
+#  cache_dir: Shared Cufflinks cache directory.
+#  key:       Run key from cufflinks_cache_key.
+#  cuff_dir:  Cufflinks output directory.
+#  max_bytes: Maximum total size of the cache.
+################################################################################
+def save_cufflinks_cache(cache_dir, key, cuff_dir, max_bytes):
+    for cuff_file in cufflinks_cache_files:
+        if not os.path.isfile('%s/%s' % (cuff_dir,cuff_file)):
+            print >> sys.stderr, 'WARNING: Cufflinks did not write %s; not caching the run' % cuff_file
+            return
+
+    run_dir = '%s/%s' % (cache_dir, key)
+    tmp_dir = '%s.%d.tmp' % (run_dir, os.getpid())
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        os.mkdir(tmp_dir)
+        for cuff_file in cufflinks_cache_files:
+            shutil.copy('%s/%s' % (cuff_dir,cuff_file), '%s/%s' % (tmp_dir,cuff_file))
+        if not os.path.isdir(run_dir):
+            os.rename(tmp_dir, run_dir)
+    except (IOError, OSError):
+        print >> sys.stderr, 'WARNING: Could not save the Cufflinks run to %s' % run_dir
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    evict_cufflinks_cache(cache_dir, max_bytes, key)
+
+
+################################################################################
+# save_positions
+#
+# Position the reads for each gene cluster and save them as columns of raw
+# arrays that load_positions memory-maps, with each cluster's reads in one
+# slice. Coordinate-ordered batches of clusters are swept in parallel into
+# part files, which are then concatenated.
+#
+# Input
+#  positions_dir: Cached read positions directory to create.
+#  bam_file:      BAM file.
+#  gene_ids:      List of merged gene_id's.
+#  regions:       List of (chrom, start, end, strand) tuples for gene_ids.
+#  mapq_zero:     Position reads with zero mapq.
+#  threads:       Number of processes to use.
+################################################################################
+def save_positions(positions_dir, bam_file, gene_ids, regions, mapq_zero, threads):
+    # divide the regions into batches in coordinate order
+    region_order = sorted(range(len(regions)), key=lambda ri: (regions[ri][0], regions[ri][1], ri))
+    num_batches = max(1, min(len(regions), 4*threads))
+    batches = [region_order[bi*len(regions)/num_batches:(bi+1)*len(regions)/num_batches] for bi in range(num_batches)]
+
+    # write to a temporary directory and move it into place, so a partial
+    # cache is never loaded
+    tmp_dir = '%s.%d.tmp' % (positions_dir, os.getpid())
+    try:
+        os.mkdir(tmp_dir)
+
+        position_tasks = []
+        for bi in range(num_batches):
+            position_tasks.append((bam_file, [regions[ri] for ri in batches[bi]], mapq_zero, '%s/part%d' % (tmp_dir,bi)))
+
+        if threads <= 1:
+            batch_slices = [save_positions_task(task) for task in position_tasks]
+        else:
+            pool = multiprocessing.Pool(threads)
+            batch_slices = pool.map(save_positions_task, position_tasks)
+            pool.close()
+            pool.join()
+
+        # offset each batch's slices by the reads before it
+        starts = np.zeros(len(regions), dtype='int64')
+        ends = np.zeros(len(regions), dtype='int64')
+        part_offset = 0
+        for bi in range(num_batches):
+            for bri, pstart, pend in batch_slices[bi]:
+                starts[batches[bi][bri]] = part_offset + pstart
+                ends[batches[bi][bri]] = part_offset + pend
+            part_offset += sum([pend-pstart for bri, pstart, pend in batch_slices[bi]])
+
+        # concatenate the parts
+        for name, dtype in positions_columns:
+            column_out = open('%s/%s.bin' % (tmp_dir,name), 'wb')
+            for bi in range(num_batches):
+                part_file = '%s/part%d.%s.bin' % (tmp_dir,bi,name)
+                part_in = open(part_file, 'rb')
+                shutil.copyfileobj(part_in, column_out)
+                part_in.close()
+                os.remove(part_file)
+            column_out.close()
+
+        np.save('%s/gene_ids.npy' % tmp_dir, np.array(gene_ids, dtype='S'))
+        np.save('%s/starts.npy' % tmp_dir, starts)
+        np.save('%s/ends.npy' % tmp_dir, ends)
+
+        os.rename(tmp_dir, positions_dir)
+
+    except (IOError, OSError):
+        print >> sys.stderr, 'WARNING: Could not save read positions to %s' % positions_dir
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+################################################################################
+# save_positions_task
+#
+# Position the reads for a batch of regions in a pool process, writing each
+# column to a part file.
+#
+# Input
+#  task:         Tuple of (bam_file, regions, mapq_zero, part_prefix).
+#
+# Output
+#  part_slices:  List of (region index, start, end) tuples locating each
+#                 region's reads in the part.
 ################################################################################
-def position_reads(clip_in, gene_chrom, gene_start, gene_end, gene_strand, mapq_zero=False):
-    read_pos_weights = []
+def save_positions_task(task):
+    bam_file, regions, mapq_zero, part_prefix = task
 
-    if gene_chrom in clip_in.references:
-        # Note: fetch is dumb. it says it's 0-based, but my experiments suggsted the 
-        #       adjustment below.
+    column_outs = []
+    for name, dtype in positions_columns:
+        column_outs.append(open('%s.%s.bin' % (part_prefix,name), 'wb'))
 
-        # for each read in span
-        for aligned_read in clip_in.fetch(gene_chrom, gene_start, gene_end-1):
-            # assign strand
-            try:
-                ar_strand = aligned_read.opt('XS')
-            except:
-                # just allow it
-                ar_strand = gene_strand
-
-            # downweight multimappers
-            if aligned_read.mapq > 0:
-                mm_weight = 1.0/aligned_read.opt('NH')
-            else:
-                mm_weight = 0.0
-
-            # check strand and quality
-            if gene_strand == '*' or gene_strand == ar_strand:
-                if mapq_zero or aligned_read.mapq > 0:
-                    if aligned_read.is_paired:
-                        # map read to endpoint (closer to fragment center)
-                        if aligned_read.is_reverse:
-                            read_pos_weights.append((aligned_read.pos+1, 0.5*mm_weight, mm_weight<1))
-                        else:
-                            read_pos_weights.append((cigar_endpoint(aligned_read), 0.5*mm_weight, mm_weight<1))
-                    else:
-                        # map read to midpoint
-                        read_pos_weights.append((cigar_midpoint(aligned_read), 1.0*mm_weight, mm_weight<1))
+    bam_in = pysam.Samfile(bam_file, 'rb')
+    part_slices = []
+    part_length = 0
+    for ri, read_pos_weights in sweep_reads(bam_in, regions, mapq_zero):
+        for column_out, column in zip(column_outs, read_arrays(read_pos_weights)):
+            column.tofile(column_out)
+        part_slices.append((ri, part_length, part_length+len(read_pos_weights)))
+        part_length += len(read_pos_weights)
+    bam_in.close()
 
-        # in case of differing read alignment lengths
-        read_pos_weights.sort()
+    for column_out in column_outs:
+        column_out.close()
 
-    return read_pos_weights
+    return part_slices
 
 
 ################################################################################
-# prerna_gtf
+# scan_stat_approx3
 #
-# Remove promiscuously overlapping genes, add unspliced preRNAs to the gtf file,
-# focus on exons, and remove redundancies.
+# Approximation 3.3 to the unconditional, poisson distributed scan statistic
+# defined on p.28 of Glaz, Naus, Wallenstein book.
+#
+# k is the # of reads
+# w is the window size
+# T is the transcriptome size
+# lambd is the reads/nt
+#
+# It seems to breakdown on the very low end, so I'm adding a check that
+# that k is greater than psi.
+#
+# Single tests go through scan_stat_pvals to share its cache.
+################################################################################
+def scan_stat_approx3(k, w, T, lambd):
+    return float(scan_stat_pvals(np.array([k]), w, T, np.array([lambd]))[0])
+
+
+################################################################################
+# scan_stat_critical
+#
+# Determine the critical read counts at which windows become significant, so
+# that windows can be tested by integer comparison without their p-values.
+#
+# For k >= psi+1 the p-value strictly decreases with k, so above the first
+# testable count the significant counts are exactly those >= k_crit. The first
+# testable count itself can sit just below a local rise in the p-value, so it
+# is returned separately as k_lone when it is significant on its own.
 #
 # Input
-#  ref_gtf:     Reference GTF file to expand with unspliced preRNAs.
+#  w:       Window size.
+#  T:       Transcriptome size.
+#  lambdas: Array of reads/nt.
+#  sig_p:   P-value at which to call window counts significant.
 #
 # Output
-#  prerna.gtf:  Expanded GTF file.
-#  pre_ref_gtf: The filename of the expanded GTF file.
+#  k_crit:  Array of minimum significant counts.
+#  k_lone:  Array of isolated significant counts below k_crit, or -1.
 ################################################################################
-def prerna_gtf(ref_gtf):
-    # make transcript span file
-    span_gtf(ref_gtf, level='transcript_id')
+def scan_stat_critical(w, T, lambdas, sig_p):
+    lambdas_q = quantize_lambdas(lambdas)
+    unique_lambdas, lambda_i = np.unique(lambdas_q, return_inverse=True)
+
+    # check the cache
+    unique_crit = np.zeros(len(unique_lambdas), dtype='int64')
+    unique_lone = np.zeros(len(unique_lambdas), dtype='int64')
+    uncached = []
+    for ui in range(len(unique_lambdas)):
+        cache_key = (w, T, sig_p, float(unique_lambdas[ui]))
+        if cache_key in scan_crit_cache:
+            unique_crit[ui], unique_lone[ui] = scan_crit_cache[cache_key]
+        else:
+            uncached.append(ui)
 
-    # intersect spans
-    p = subprocess.Popen('intersectBed -wo -s -a %s/span.gtf -b %s/span.gtf' % (out_dir,out_dir), shell=True, stdout=subprocess.PIPE)
+    if uncached:
+        ulambdas = unique_lambdas[uncached]
 
-    # count genes overlapped by each transcript
-    tx_overlaps = {}
-    for line in p.stdout:
-        a = line.split('\t')
+        # first testable count (we need >2 to Poisson test, and k >= psi)
+        k_lo = np.maximum(3, np.ceil(ulambdas*w)).astype('int64')
 
-        kv1 = gff.gtf_kv(a[8])
-        tid1 = kv1['transcript_id']
-        gid1 = kv1['gene_id']
-        gid2 = gff.gtf_kv(a[17])['gene_id']
+        # bracket the critical count in (k_lo, k_hi] by doubling
+        k_hi = k_lo + 1
+        insig = scan_stat_kernel(k_hi, w, T, ulambdas) >= sig_p
+        while insig.any() and k_hi.max() < 2**40:
+            k_hi[insig] *= 2
+            insig[insig] = scan_stat_kernel(k_hi[insig], w, T, ulambdas[insig]) >= sig_p
 
-        if gid1 != gid2:
-            tx_overlaps.setdefault(tid1,set()).add(gid2)
+        # bisect
+        k_bot = k_lo.copy()
+        while ((k_hi - k_bot > 1) & ~insig).any():
+            bisecting = (k_hi - k_bot > 1) & ~insig
+            k_mid = (k_bot + k_hi) // 2
+            mid_sig = scan_stat_kernel(k_mid, w, T, ulambdas) < sig_p
+            k_hi = np.where(bisecting & mid_sig, k_mid, k_hi)
+            k_bot = np.where(bisecting & ~mid_sig, k_mid, k_bot)
 
-    p.communicate()
-    os.remove('%s/span.gtf' % out_dir)
+        # never significant
+        k_crit = np.where(insig, np.iinfo('int64').max, k_hi)
 
-    # read transcripts for filtering/processing
-    transcripts = read_genes(ref_gtf, key_id='transcript_id')
+        # fold in the first testable count
+        lo_sig = scan_stat_kernel(k_lo, w, T, ulambdas) < sig_p
+        k_lone = np.where(lo_sig & (k_crit != k_lo+1), k_lo, -1)
+        k_crit = np.where(lo_sig & (k_crit == k_lo+1), k_lo, k_crit)
 
-    # delete transcripts from promiscuously overlapping genes
-    for tid in transcripts.keys():
-        if len(tx_overlaps.get(tid,[])) > 5:
-            del transcripts[tid]
-    
-    # open prerna output gtf
-    pre_ref_gtf = '%s/prerna.gtf' % out_dir
-    pre_ref_open = open(pre_ref_gtf, 'w')
+        unique_crit[uncached] = k_crit
+        unique_lone[uncached] = k_lone
 
-    # add unspliced single exon transcripts to hash
-    unspliced_hash = set()
-    for tid in transcripts:
-        tx = transcripts[tid]
-        if len(tx.exons) == 1:
-            tx_key = (tx.chrom, tx.exons[0].start, tx.exons[0].end, tx.strand)
-            unspliced_hash.add(tx_key)
+        if len(scan_crit_cache) + len(uncached) > scan_pval_cache_max:
+            scan_crit_cache.clear()
+        for ci in range(len(uncached)):
+            cache_key = (w, T, sig_p, float(ulambdas[ci]))
+            scan_crit_cache[cache_key] = (int(k_crit[ci]), int(k_lone[ci]))
 
-    # process transcripts
-    unspliced_index = 0
-    for tid in transcripts:
-        tx = transcripts[tid]
-        pre_start = tx.exons[0].start
-        pre_end = tx.exons[-1].end
-        pre_key = (tx.chrom, pre_start, pre_end, tx.strand)
+    return unique_crit[lambda_i], unique_lone[lambda_i]
 
-        for i in range(len(tx.exons)):
-            cols = (tx.chrom, 'clip_peaks', 'exon', str(tx.exons[i].start), str(tx.exons[i].end), '.', tx.strand, '.', gff.kv_gtf(tx.kv))
-            print >> pre_ref_open, '\t'.join(cols)
 
-        if not pre_key in unspliced_hash:
-            unspliced_hash.add(pre_key)
-            pre_kv = copy.copy(tx.kv)
-            pre_kv['transcript_id'] = 'UNSPLICED%d' % unspliced_index
-            unspliced_index += 1
-            cols = (tx.chrom, 'clip_peaks', 'exon', str(pre_start), str(pre_end), '.', tx.strand, '.', gff.kv_gtf(pre_kv))
-            print >> pre_ref_open, '\t'.join(cols)
+################################################################################
+# scan_stat_kernel
+#
+# Vectorized scan_stat_approx3 over arrays of read counts and lambdas, with the
+# Poisson pmf computed in log space.
+#
+# Input
+#  ks:      Array of read counts.
+#  w:       Window size.
+#  T:       Transcriptome size.
+#  lambdas: Array of reads/nt.
+#
+# Output
+#  p_vals:  Array of scan statistic p-values.
+################################################################################
+def scan_stat_kernel(ks, w, T, lambdas):
+    ks = np.asarray(ks, dtype='float64')
+    L = float(T)/w
+    psi = np.asarray(lambdas, dtype='float64')*w
 
-    pre_ref_open.close()
+    log_pmf = ks*np.log(psi) - psi - gammaln(ks+1)
+    sigma = (ks-1.0)*(L-1.0)*np.exp(log_pmf)
+    p_vals = 1.0 - np.exp(-sigma)
 
-    return pre_ref_gtf
+    p_vals[ks < psi] = 1.0
+
+    return p_vals
 
 
 ################################################################################
-# read_genes
+# scan_stat_pvals
 #
-# Parse a gtf file and return a set of Gene objects in a hash keyed by the
-# id given.
+# Compute scan statistic p-values for arrays of read counts and lambdas,
+# reusing those computed earlier in the process.
+#
+# Lambdas are quantized so that values differing only by rounding share a cache
+# entry. The cache is cleared when it grows past scan_pval_cache_max entries.
 #
 # Input
-#  gtf_file: GTF file from which to read genes.
-#  key_id:   GTF key with which to hash the genes (transcript_id or gene_id)
+#  ks:      Array of read counts.
+#  w:       Window size.
+#  T:       Transcriptome size.
+#  lambdas: Array of reads/nt.
 #
 # Output
-#  genes:    Hash mapping key_id to Gene objects.
+#  p_vals:  Array of scan statistic p-values.
 ################################################################################
-def read_genes(gtf_file, key_id='transcript_id'):
-    genes = {}
-    for line in open(gtf_file):
-        a = line.split('\t')
+def scan_stat_pvals(ks, w, T, lambdas):
+    ks = np.asarray(ks, dtype='int64')
+    p_vals = np.ones(len(ks))
+    if len(ks) == 0:
+        return p_vals
+
+    # quantize lambdas
+    lambdas_q = quantize_lambdas(lambdas)
+
+    # find unique tests
+    unique_lambdas, lambda_i = np.unique(lambdas_q, return_inverse=True)
+    test_codes = lambda_i*(ks.max()+1) + ks
+    unique_codes, test_i = np.unique(test_codes, return_inverse=True)
+    unique_ks = unique_codes % (ks.max()+1)
+    unique_lambdas = unique_lambdas[unique_codes // (ks.max()+1)]
+
+    # check the cache
+    unique_pvals = np.zeros(len(unique_codes))
+    uncached = []
+    for ui in range(len(unique_codes)):
+        cache_key = (int(unique_ks[ui]), w, T, float(unique_lambdas[ui]))
+        if cache_key in scan_pval_cache:
+            unique_pvals[ui] = scan_pval_cache[cache_key]
+        else:
+            uncached.append(ui)
 
-        kv = gff.gtf_kv(a[8])
-        if not kv[key_id] in genes:
-            genes[kv[key_id]] = Gene(a[0], a[6], kv)
+    # compute the rest
+    if uncached:
+        unique_pvals[uncached] = scan_stat_kernel(unique_ks[uncached], w, T, unique_lambdas[uncached])
 
-        if a[2] == 'exon':
-            genes[kv[key_id]].add_exon(int(a[3]), int(a[4]))
+        if len(scan_pval_cache) + len(uncached) > scan_pval_cache_max:
+            scan_pval_cache.clear()
+        for ui in uncached:
+            cache_key = (int(unique_ks[ui]), w, T, float(unique_lambdas[ui]))
+            scan_pval_cache[cache_key] = unique_pvals[ui]
 
-    return genes
+    return unique_pvals[test_i]
 
 
 ################################################################################
-# scan_stat_approx3
+# schedule_clusters
 #
-# Approximation 3.3 to the unconditional, poisson distributed scan statistic
-# defined on p.28 of Glaz, Naus, Wallenstein book.
+# Split gene clusters into tasks for the process pool, most expensive first.
+# Cheap clusters are grouped so that each task costs about 1/16 of a process'
+# share, and clusters that would cost more than half of a process' share have
+# their reads positioned in sub-chunks.
 #
-# k is the # of reads
-# w is the window size
-# T is the transcriptome size
-# lambd is the reads/nt
+# Input
+#  gene_ids:      List of merged gene_id's.
+#  cluster_costs: List of (span, isoforms, bam_kb, cost) tuples for each gene.
+#  threads:       Number of processes.
+#  split:         Split outlier clusters into sub-chunks.
 #
-# It seems to breakdown on the very low end, so I'm adding a check that
-# that k is greater than psi.
+# Output
+#  tasks:         List of ('genes', gene indexes) and ('chunk', gene index,
+#                  chunk index, chunks, own start, own end) tuples.
 ################################################################################
-def scan_stat_approx3(k, w, T, lambd):
-    L = float(T)/w
-    psi = float(lambd)*w
-    if k < psi:
-        p_val = 1.0
-    else:
-        sigma = (k-1.0)*(L-1.0)*poisson.pmf(k, psi)
-        p_val = 1.0 - math.exp(-sigma)
-    return p_val
+def schedule_clusters(gene_ids, cluster_costs, threads, split=True):
+    total_cost = sum([cc[3] for cc in cluster_costs])
+    task_cost = total_cost / (16.0*threads)
+    outlier_cost = total_cost / (2.0*threads)
+
+    # sort by decreasing cost
+    gene_order = sorted(range(len(gene_ids)), key=lambda gi: -cluster_costs[gi][3])
+
+    tasks = []
+    batch = []
+    batch_cost = 0
+    for gi in gene_order:
+        gcost = cluster_costs[gi][3]
+
+        num_chunks = min(4*threads, int(math.ceil(gcost / task_cost)), cluster_costs[gi][0])
+
+        if split and gcost > outlier_cost and num_chunks > 1:
+            # divide the gene span evenly
+            gene_transcripts = {}
+            for tid in peak_calling['g2t'][gene_ids[gi]]:
+                gene_transcripts[tid] = peak_calling['transcripts'][tid]
+            (gchrom, gstrand, gstart, gend) = gene_attrs(gene_transcripts)
+            bounds = [None] + [gstart + ci*(gend-gstart+1)/num_chunks for ci in range(1,num_chunks)] + [None]
+
+            for ci in range(num_chunks):
+                tasks.append(('chunk', gi, ci, num_chunks, bounds[ci], bounds[ci+1]))
+
+        else:
+            batch.append(gi)
+            batch_cost += gcost
+            if batch_cost >= task_cost:
+                tasks.append(('genes', batch))
+                batch = []
+                batch_cost = 0
+
+    if batch:
+        tasks.append(('genes', batch))
+
+    return tasks
 
 
 ################################################################################
 # set_transcript_fpkms
 #
 # Input
-#  transcripts: Hash mapping transcript_id to isoform Gene objects.
+#  transcripts:    Hash mapping transcript_id to isoform Gene objects.
+#  abundance_file: Abundance table in one of the abundance_formats.
+#  missing_fpkm:   FPKM for failed or missing transcripts.
 # 
 # Output
-#  transcripts: Same hash, FPKM attribute set.
+#  transcripts:    Same hash, FPKM attribute set.
 ################################################################################
-def set_transcript_fpkms(transcripts, cuff_dir, missing_fpkm=1000000):
-    # read from isoforms.fpkm_tracking
-    fpkm_in = open('%s/isoforms.fpkm_tracking' % cuff_dir)
-
-    line = fpkm_in.readline()
-    for line in fpkm_in:
-        a = line.split('\t')
-        a[-1] = a[-1].rstrip()
-
-        tid = a[0]
-        fpkm = float(a[9])
+def set_transcript_fpkms(transcripts, abundance_file, missing_fpkm=1000000):
+    abundance_format, tx_fpkms = read_abundances(abundance_file)
 
+    for tid in tx_fpkms:
         if tid not in transcripts:
             if verbose:
                 print >> sys.stderr, 'WARNING: %s quantified but missing from transcripts.gtf' % tid
         else:
-            if a[12] != 'FAIL':
-                transcripts[tid].fpkm = fpkm
+            if tx_fpkms[tid] != None:
+                transcripts[tid].fpkm = tx_fpkms[tid]
             else:
                 transcripts[tid].fpkm = missing_fpkm
                 if verbose:
-                    print >> sys.stderr, 'WARNING: Cufflinks failed for %s' % tid
-
-    fpkm_in.close()
+                    print >> sys.stderr, 'WARNING: %s failed for %s' % (abundance_format, tid)
 
     # fill in those that go missing
     fpkms_missing = 0
@@ -1336,26 +3928,16 @@ def set_transcript_fpkms(transcripts, cuff_dir, missing_fpkm=1000000):
 # 
 # Output
 #  transcripts:  Same hash, junctions attribute set.
-#  tx.junctions: Sorted list of junction coordinates. For each junction, save
+#  tx.junctions: Sorted array of junction coordinates. For each junction, save
 #                 the first bp of the next exon/intron.
 ################################################################################
 def set_transcript_junctions(transcripts):
-    for tid in transcripts:
-        tx = transcripts[tid]
-
-        # start
-        tx.junctions.append(tx.exons[0].start)
-
-        # splice junctions
-        if len(tx.exons) > 1:
-            tx.junctions.append(tx.exons[0].end+1)
-            for i in range(1,len(tx.exons)-1):
-                tx.junctions.append(tx.exons[i].start)
-                tx.junctions.append(tx.exons[i].end+1)
-            tx.junctions.append(tx.exons[-1].start)
-
-        # end
-        tx.junctions.append(tx.exons[-1].end+1)
+    # derive each table's junctions from its exons
+    tables = {}
+    for tx in transcripts.values():
+        tables[id(tx.table)] = tx.table
+    for table in tables.values():
+        table.set_junctions()
 
 
 ################################################################################
@@ -1398,6 +3980,127 @@ def span_gtf(ref_gtf, level='gene_id'):
     return span_ref_gtf
 
 
+################################################################################
+# start_journal
+#
+# Clear the journal directory and write the manifest describing this run.
+#
+# Input
+#  journal_dir: Journal directory.
+#  manifest:    Hash describing this run's inputs and options.
+################################################################################
+def start_journal(journal_dir, manifest):
+    shutil.rmtree(journal_dir, ignore_errors=True)
+    os.mkdir(journal_dir)
+
+    manifest_out = open('%s/manifest.json' % journal_dir, 'w')
+    json.dump(manifest, manifest_out, sort_keys=True)
+    manifest_out.close()
+
+
+################################################################################
+# sweep_order
+#
+# Input
+#  regions: List of (chrom, start, end, strand) tuples.
+#
+# Output
+#  order:   List of region indexes in (chrom, start) order, in which
+#            sweep_reads and cached_sweep yield them.
+################################################################################
+def sweep_order(regions):
+    return sorted(range(len(regions)), key=lambda ri: (regions[ri][0], regions[ri][1], ri))
+
+
+################################################################################
+# sweep_reads
+#
+# Position the reads for many regions in one coordinate-sorted pass over the
+# BAM, rather than fetching each region. Regions within sweep_gap bp of each
+# other are fetched together as a block, and each read is handed to every
+# active region it overlaps, using the same overlap test as fetch. Each BGZF
+# block is then decompressed once.
+#
+# Input
+#  bam_in:           Open, indexed pysam BAM file.
+#  regions:          List of (chrom, start, end, strand) tuples, with start and
+#                     end as passed to position_reads.
+#  mapq_zero:        Return reads with zero mapq.
+#
+# Output
+#  (ri, read_pos_weights) tuples, yielded region by region in sweep_order,
+#  with read_pos_weights matching position_reads for regions[ri].
+################################################################################
+def sweep_reads(bam_in, regions, mapq_zero=False):
+    # group regions into fetch blocks
+    blocks = []
+    for ri in sweep_order(regions):
+        rchrom, rstart, rend, rstrand = regions[ri]
+        if blocks and blocks[-1][0] == rchrom and rstart <= blocks[-1][2] + sweep_gap:
+            blocks[-1][2] = max(blocks[-1][2], rend)
+            blocks[-1][3].append(ri)
+        else:
+            blocks.append([rchrom, rstart, rend, [ri]])
+
+    for bchrom, bstart, bend, block_regions in blocks:
+        read_pos_weights = {}
+        finished = {}
+        for ri in block_regions:
+            read_pos_weights[ri] = []
+            finished[ri] = False
+
+        active = [] # regions the reads have reached
+        next_i = 0  # index of the next region to activate
+        yield_i = 0 # index of the next region to yield
+
+        if bchrom in bam_in.references:
+            for aligned_read in bam_in.fetch(bchrom, bstart, bend-1):
+                read_start = aligned_read.pos
+                read_end = aligned_read.aend
+                if read_end == None or read_end <= read_start:
+                    read_end = read_start + 1
+
+                # activate regions starting before the read ends (fetch
+                # returns nothing for empty regions)
+                while next_i < len(block_regions) and regions[block_regions[next_i]][1] < read_end:
+                    ri = block_regions[next_i]
+                    if regions[ri][1] < regions[ri][2]-1:
+                        active.append(ri)
+                    else:
+                        finished[ri] = True
+                    next_i += 1
+
+                # finish regions ending before the read starts
+                still_active = []
+                for ri in active:
+                    if read_start < regions[ri][2]-1:
+                        still_active.append(ri)
+                    else:
+                        finished[ri] = True
+                active = still_active
+
+                # position the read for each overlapping region
+                for ri in active:
+                    if read_end > regions[ri][1]:
+                        read_pos_weight = position_read(aligned_read, regions[ri][3], mapq_zero)
+                        if read_pos_weight:
+                            read_pos_weights[ri].append(read_pos_weight)
+
+                # yield finished regions in order
+                while yield_i < len(block_regions) and finished[block_regions[yield_i]]:
+                    ri = block_regions[yield_i]
+                    read_pos_weights[ri].sort()
+                    yield ri, read_pos_weights.pop(ri)
+                    yield_i += 1
+
+        # yield the rest
+        while yield_i < len(block_regions):
+            ri = block_regions[yield_i]
+            read_pos_weights[ri].sort()
+            yield ri, read_pos_weights.pop(ri)
+            yield_i += 1
+
+
 ################################################################################
 # transcriptome_size
 #
@@ -1452,6 +4155,59 @@ def trim_windows(windows, read_pos_weights):
     return trimmed_windows
 
 
+################################################################################
+# window_lambdas
+#
+# Determine the convoluted poisson lambda for every window in the gene at once,
+# matching convolute_lambda window by window.
+#
+# The coverage track is summed with prefix sums that restart every window_size
+# bp, so each window is the tail of one block plus the head of the next. This
+# keeps each window O(1) without the rounding error that a single prefix sum
+# across a megabase cluster of large FPKMs would pick up.
+#
+# Input
+#  gene_transcripts: Hash mapping transcript_id to isoform Gene objects,
+#                     containing only keys for a specific gene.
+#  gene_start:       Start of the gene's span.
+#  gene_end:         End of the gene's span.
+#  window_size:      Scan statistic window size.
+#  total_reads:      Total number of reads aligned to the transcriptome.
+#  fpkm_cov:         FPKM coverage track from fpkm_coverage, if already built.
+#
+# Output
+#  lambdas:          Array of Poisson lambdas for the windows starting at
+#                     gene_start through gene_end-window_size+1.
+################################################################################
+def window_lambdas(gene_transcripts, gene_start, gene_end, window_size, total_reads, fpkm_cov=None):
+    if fpkm_cov is None:
+        fpkm_cov = fpkm_coverage(gene_transcripts, gene_start, gene_end)
+    num_windows = max(0, len(fpkm_cov) - window_size + 1)
+
+    # block prefix sums, padded with an extra block for the last window's head
+    num_blocks = len(fpkm_cov) // window_size + 2
+    fpkm_blocks = np.zeros(num_blocks*window_size)
+    fpkm_blocks[:len(fpkm_cov)] = fpkm_cov
+    fpkm_blocks = np.cumsum(fpkm_blocks.reshape((num_blocks,window_size)), axis=1)
+
+    # window sums
+    wi = np.arange(num_windows)
+    block_i = wi // window_size
+    block_off = wi % window_size
+    fpkm_sum = fpkm_blocks[block_i,-1] - fpkm_blocks[block_i,block_off-1] + fpkm_blocks[block_i+1,block_off-1]
+    aligned = (block_off == 0)
+    fpkm_sum[aligned] = fpkm_blocks[block_i[aligned],-1]
+
+    # average FPKM over each window
+    fpkm_conv = fpkm_sum / float(window_size)
+
+    # bump to min fpkm
+    fpkm_conv = np.maximum(fpkm_conv, 0.1)
+
+    # convert from fpkm to lambda
+    return fpkm_conv / 1000.0*(total_reads/1000000.0)
+
+
 ################################################################################
 # windows2peaks
 #
@@ -1480,10 +4236,69 @@ def windows2peaks(read_pos_weights, gene_transcripts, gene_start, window_stats,
     return peaks
 
 
+################################################################################
+# write_exons_gtf
+#
+# Write the exons of a reference GTF, as Cufflinks' transcripts.gtf holds the
+# reference transcripts. An existing file with the same exons is left alone.
+#
+# Input
+#  ref_gtf:  Reference GTF file.
+#  gtf_file: GTF file to write.
+################################################################################
+def write_exons_gtf(ref_gtf, gtf_file):
+    tmp_file = '%s.%d.tmp' % (gtf_file, os.getpid())
+    gtf_out = open(tmp_file, 'w')
+    for line in open(ref_gtf):
+        a = line.split('\t')
+        if len(a) > 8 and a[2] == 'exon':
+            gtf_out.write(line)
+    gtf_out.close()
+
+    if os.path.isfile(gtf_file) and filecmp.cmp(tmp_file, gtf_file, shallow=False):
+        os.remove(tmp_file)
+    else:
+        os.rename(tmp_file, gtf_file)
+
+
+################################################################################
+# write_lines
+#
+# Write lines to an open file in one call.
+################################################################################
+def write_lines(out_open, lines):
+    if lines:
+        out_open.write('\n'.join(lines) + '\n')
+
+
+################################################################################
+# write_window_stats
+#
+# Write a cluster's window stats as one zlib-compressed chunk of
+# window_stats_dtype records.
+#
+# Input
+#  windows_out:   Open binary file.
+#  window_starts: Array of window starts.
+#  window_counts: Array of window read counts.
+#  window_pvals:  Array of window p-values.
+#  lambdas:       Array of window Poisson lambdas.
+################################################################################
+def write_window_stats(windows_out, window_starts, window_counts, window_pvals, lambdas):
+    windows = np.zeros(len(window_starts), dtype=window_stats_dtype)
+    windows['start'] = window_starts
+    windows['count'] = window_counts
+    windows['p'] = window_pvals
+    windows['lambda'] = lambdas
+    windows_out.write(zlib.compress(windows.tostring(), window_stats_level))
+
+
 ################################################################################
 # Exon class
 ################################################################################
-class Exon:
+class Exon(object):
+    __slots__ = ('start', 'end')
+
     def __init__(self, start, end):
         self.start = start
         self.end = end
@@ -1502,65 +4317,339 @@ class Exon:
 
 ################################################################################
 # Gene class
+#
+# A view onto one transcript's row of a TranscriptTable. Constructing a Gene
+# directly gives it a table of its own.
+#
+# exons and kv are built from the table on each access, so they're snapshots:
+# change a Gene through add_exon and its setters instead.
 ################################################################################
-class Gene:
-    def __init__(self, chrom, strand, kv):
-        self.chrom = chrom
-        self.strand = strand
-        self.kv = kv
-        self.exons = []
+class Gene(object):
+    __slots__ = ('table', 'ti')
 
-        self.fpkm = None
-        self.junctions = []
+    def __init__(self, chrom, strand, kv, table=None, ti=0):
+        if table == None:
+            table = TranscriptTable.build([(kv.get('transcript_id'), chrom, strand, kv.get('gene_id'), kv, [], [])])
+        self.table = table
+        self.ti = ti
 
     def add_exon(self, start, end):
-        self.exons.append(Exon(start,end))
-        if len(self.exons) > 1 and self.exons[-2].end > start:
-            self.exons.sort()
+        self.table.add_exon(self.ti, start, end)
+
+    @property
+    def chrom(self):
+        return self.table.chroms[self.table.tx_chroms[self.ti]]
+
+    @property
+    def end(self):
+        return int(self.table.exon_ends[self.table.exon_offsets[self.ti+1]-1])
+
+    @property
+    def exons(self):
+        ei = self.table.exon_offsets[self.ti]
+        ej = self.table.exon_offsets[self.ti+1]
+        return tuple([Exon(start,end) for start, end in zip(self.table.exon_starts[ei:ej].tolist(), self.table.exon_ends[ei:ej].tolist())])
+
+    def get_fpkm(self):
+        fpkm = self.table.tx_fpkms[self.ti]
+        if np.isnan(fpkm):
+            return None
+        else:
+            return float(fpkm)
 
-    def __str__(self):
-        return '%s %s %s %s' % (self.chrom, self.strand, kv_gtf(self.kv), ','.join([ex.__str__() for ex in self.exons]))
+    def set_fpkm(self, fpkm):
+        if fpkm == None:
+            fpkm = np.nan
+        self.table.tx_fpkms[self.ti] = fpkm
 
+    fpkm = property(get_fpkm, set_fpkm)
 
-################################################################################
-# Peak class
-################################################################################
-class Peak:
-    def __init__(self, chrom, start, end, strand, gene_id, frags, mm_frac, scan_p):
-        self.chrom = chrom
-        self.start = start
-        self.end = end
-        self.strand = strand
-        self.gene_id = gene_id
-        self.id = None
-        self.frags = frags
-        self.mm_frac = mm_frac
-        self.control_frags = None
-        self.scan_p = scan_p
-        self.control_p = None
-
-    def gff_str(self):
-        if self.control_p != None:
-            if self.control_p > 0:
-                peak_score = int(2000/math.pi*math.atan(-math.log(self.control_p,1000)))
-            else:
-                peak_score = 1000
-        elif self.scan_p > 0:
-            peak_score = int(2000/math.pi*math.atan(-math.log(self.scan_p,1000)))
+    @property
+    def gene_id(self):
+        return self.table.tx_gene_ids[self.ti]
+
+    def get_junctions(self):
+        if self.table.junctions is None:
+            return []
         else:
-            peak_score = 1000
+            return self.table.junctions[self.table.junction_offsets[self.ti]:self.table.junction_offsets[self.ti+1]]
 
-        if self.id:
-            cols = [self.chrom, 'clip_peaks', 'peak', str(self.start), str(self.end), str(peak_score), self.strand, '.', 'id "PEAK%d"; gene_id "%s"; fragments "%.1f"; scan_p "%.2e"; multimap_fraction "%.3f"' % (self.id,self.gene_id,self.frags,self.scan_p,self.mm_frac)]
+    def set_junctions(self, junctions):
+        self.table.set_tx_junctions(self.ti, junctions)
+
+    junctions = property(get_junctions, set_junctions)
+
+    @property
+    def kv(self):
+        if self.table.tx_attrs == None:
+            return {'gene_id':self.gene_id, 'transcript_id':self.table.tids[self.ti]}
+
+        kv = self.table.tx_attrs[self.ti]
+        if isinstance(kv, str):
+            return gff.gtf_kv(kv)
         else:
-            cols = [self.chrom, 'clip_peaks', 'peak', str(self.start), str(self.end), str(peak_score), self.strand, '.', 'gene_id "%s"; fragments "%.1f"; scan_p "%.2e"; multimap_fraction "%.3f"' % (self.gene_id,self.frags,self.scan_p,self.mm_frac)]
+            return dict(kv)
+
+    @property
+    def start(self):
+        return int(self.table.exon_starts[self.table.exon_offsets[self.ti]])
 
-        if self.control_frags != None:
-            cols[-1] += '; control_fragments "%.1f"' % self.control_frags
-        if self.control_p != None:
-            cols[-1] += '; control_p "%.2e"' % self.control_p
+    def get_strand(self):
+        return self.table.strands[self.table.tx_strands[self.ti]]
 
-        return '\t'.join(cols)
+    def set_strand(self, strand):
+        self.table.tx_strands[self.ti] = self.table.strand_code(strand)
+
+    strand = property(get_strand, set_strand)
+
+    def __str__(self):
+        return '%s %s %s %s' % (self.chrom, self.strand, gff.kv_gtf(self.kv), ','.join([ex.__str__() for ex in self.exons]))
+
+
+################################################################################
+# PeakTable class
+#
+# Peaks stored as a structured array, with chromosomes, strands and gene
+# cluster ids interned as codes. Unset control fields are NaN. Scores are
+# computed for the whole table at once, and GFF lines formatted in bulk.
+################################################################################
+class PeakTable(object):
+    dtype = [('chrom','int32'), ('start','int64'), ('end','int64'), ('strand','int8'), ('gene','int32'), ('frags','float64'), ('mm_frac','float64'), ('scan_p','float64'), ('control_frags','float64'), ('control_p','float64')]
+
+    def __init__(self, peaks, chroms, strands, gene_ids):
+        self.peaks = peaks
+        self.chroms = chroms
+        self.strands = strands
+        self.gene_ids = gene_ids
+
+    @staticmethod
+    def build(peak_tuples):
+        # peak_tuples are (chrom,start,end,strand,gene_id,frags,mm_frac,scan_p)
+        codes = [{}, {}, {}]
+        rows = []
+        for chrom, start, end, strand, gene_id, frags, mm_frac, scan_p in peak_tuples:
+            chrom_code = codes[0].setdefault(chrom, len(codes[0]))
+            strand_code = codes[1].setdefault(strand, len(codes[1]))
+            gene_code = codes[2].setdefault(gene_id, len(codes[2]))
+            rows.append((chrom_code, start, end, strand_code, gene_code, frags, mm_frac, scan_p, np.nan, np.nan))
+
+        names = []
+        for code_hash in codes:
+            code_names = [None]*len(code_hash)
+            for name in code_hash:
+                code_names[code_hash[name]] = name
+            names.append(code_names)
+
+        return PeakTable(np.array(rows, dtype=PeakTable.dtype), *names)
+
+    def __len__(self):
+        return len(self.peaks)
+
+    def gff_lines(self, ids=None):
+        scores = self.scores().tolist()
+
+        chroms = [self.chroms[c] for c in self.peaks['chrom'].tolist()]
+        strands = [self.strands[c] for c in self.peaks['strand'].tolist()]
+        gene_ids = [self.gene_ids[c] for c in self.peaks['gene'].tolist()]
+        cols = [chroms, self.peaks['start'].tolist(), self.peaks['end'].tolist(), scores, strands]
+        fmt = '%s\tclip_peaks\tpeak\t%d\t%d\t%d\t%s\t.\t'
+
+        if ids is not None:
+            cols.append(list(ids))
+            fmt += 'id "PEAK%d"; '
+
+        cols += [gene_ids, self.peaks['frags'].tolist(), self.peaks['scan_p'].tolist(), self.peaks['mm_frac'].tolist()]
+        fmt += 'gene_id "%s"; fragments "%.1f"; scan_p "%.2e"; multimap_fraction "%.3f"'
+
+        # control fields, which are set for all peaks or none
+        if len(self.peaks) > 0 and not np.isnan(self.peaks['control_frags'][0]):
+            cols.append(self.peaks['control_frags'].tolist())
+            fmt += '; control_fragments "%.1f"'
+        if len(self.peaks) > 0 and not np.isnan(self.peaks['control_p'][0]):
+            cols.append(self.peaks['control_p'].tolist())
+            fmt += '; control_p "%.2e"'
+
+        return [fmt % row for row in zip(*cols)]
+
+    def regions(self, fuzz=0):
+        # (chrom,start,end,strand) tuples expanded by fuzz
+        return [(self.chroms[c], start-fuzz, end+fuzz, self.strands[s]) for c, start, end, s in zip(self.peaks['chrom'].tolist(), self.peaks['start'].tolist(), self.peaks['end'].tolist(), self.peaks['strand'].tolist())]
+
+    def scores(self):
+        # score the control p-value if set, and otherwise the scan p-value
+        p = self.peaks['control_p'].copy()
+        scan_only = np.isnan(p)
+        p[scan_only] = self.peaks['scan_p'][scan_only]
+
+        scores = np.zeros(len(p), dtype='int64') + 1000
+        pos = (p > 0)
+        scores[pos] = (2000/math.pi*np.arctan(-(np.log(p[pos])/np.log(1000)))).astype('int64')
+        return scores
+
+    def subset(self, peak_indexes):
+        # peaks selected by index or boolean mask, sharing codes
+        return PeakTable(self.peaks[peak_indexes], self.chroms, self.strands, self.gene_ids)
+
+
+################################################################################
+# TranscriptTable class
+#
+# Columnar storage for a set of transcripts. Exon coordinates are int32 arrays
+# sliced by per-transcript offsets, chromosomes and strands are interned as
+# codes, and GTF attributes are kept aside, as strings parsed on access. Each
+# transcript is then a few array entries rather than objects per exon and
+# junction, which matters for whole-genome annotations and forked workers.
+#
+# Junctions are unset until set_junctions derives them from the exons, or
+# they're set for a transcript directly.
+#
+# Exons added and junctions set one transcript at a time are collected, and
+# merged into the arrays in one pass the next time they're read.
+################################################################################
+class TranscriptTable(object):
+    def __init__(self, tids, chroms, tx_chroms, strands, tx_strands, tx_gene_ids, tx_attrs, tx_fpkms, exon_offsets, exon_starts, exon_ends, junction_offsets=None, junctions=None):
+        self.tids = tids
+        self.chroms = chroms
+        self.tx_chroms = tx_chroms
+        self.strands = strands
+        self.tx_strands = tx_strands
+        self.tx_gene_ids = tx_gene_ids
+        self.tx_attrs = tx_attrs
+        self.tx_fpkms = tx_fpkms
+        self._exon_offsets = exon_offsets
+        self._exon_starts = exon_starts
+        self._exon_ends = exon_ends
+        self._junction_offsets = junction_offsets
+        self._junctions = junctions
+
+        # (ti, start, end) exons to add, and ti's junctions to set
+        self.new_exons = []
+        self.new_junctions = {}
+
+    @property
+    def exon_offsets(self):
+        if self.new_exons:
+            self.merge_exons()
+        return self._exon_offsets
+
+    @property
+    def exon_starts(self):
+        if self.new_exons:
+            self.merge_exons()
+        return self._exon_starts
+
+    @property
+    def exon_ends(self):
+        if self.new_exons:
+            self.merge_exons()
+        return self._exon_ends
+
+    @property
+    def junction_offsets(self):
+        if self.new_junctions:
+            self.merge_junctions()
+        return self._junction_offsets
+
+    @property
+    def junctions(self):
+        if self.new_junctions:
+            self.merge_junctions()
+        return self._junctions
+
+    @staticmethod
+    def build(rows):
+        # rows are (transcript_id, chrom, strand, gene_id, attrs, exon_starts,
+        # exon_ends) tuples, with attrs a kv hash or GTF attribute string
+        table = TranscriptTable([], [], None, [], None, [], [], None, None, None, None)
+        chrom_codes = {}
+
+        tx_chroms = []
+        tx_strands = []
+        exon_counts = []
+        for tid, chrom, strand, gene_id, attrs, exon_starts, exon_ends in rows:
+            table.tids.append(tid)
+            tx_chroms.append(chrom_codes.setdefault(chrom, len(chrom_codes)))
+            tx_strands.append(table.strand_code(strand))
+            table.tx_gene_ids.append(gene_id)
+            table.tx_attrs.append(attrs)
+            exon_counts.append(len(exon_starts))
+
+        table.chroms = [None]*len(chrom_codes)
+        for chrom in chrom_codes:
+            table.chroms[chrom_codes[chrom]] = chrom
+
+        table.tx_chroms = np.array(tx_chroms, dtype='int32')
+        table.tx_strands = np.array(tx_strands, dtype='int8')
+        table.tx_fpkms = np.empty(len(table.tids))
+        table.tx_fpkms.fill(np.nan)
+        table._exon_offsets = np.concatenate(([0], np.cumsum(exon_counts, dtype='int64')))
+
+        # sort each transcript's exons by start, keeping the order of ties
+        exon_tis = np.repeat(np.arange(len(table.tids), dtype='int64'), exon_counts)
+        exon_starts = np.concatenate([np.zeros(0,dtype='int32')] + [np.array(row[5],dtype='int32') for row in rows])
+        exon_ends = np.concatenate([np.zeros(0,dtype='int32')] + [np.array(row[6],dtype='int32') for row in rows])
+        exon_order = np.lexsort((exon_starts, exon_tis))
+        table._exon_starts = exon_starts[exon_order]
+        table._exon_ends = exon_ends[exon_order]
+
+        return table
+
+    def add_exon(self, ti, start, end):
+        self.new_exons.append((ti, start, end))
+
+    def genes(self):
+        # hash mapping transcript_id's to Gene views
+        genes = {}
+        for ti in range(len(self.tids)):
+            genes[self.tids[ti]] = Gene(None, None, None, self, ti)
+        return genes
+
+    def merge_exons(self):
+        # sort the new exons in after those starting at or before them, as
+        # the stable sort keeps existing exons first
+        new_tis, new_starts, new_ends = zip(*self.new_exons)
+        self.new_exons = []
+
+        exon_tis = np.repeat(np.arange(len(self.tids), dtype='int64'), np.diff(self._exon_offsets))
+        exon_tis = np.concatenate((exon_tis, np.array(new_tis, dtype='int64')))
+        exon_starts = np.concatenate((self._exon_starts, np.array(new_starts, dtype='int32')))
+        exon_ends = np.concatenate((self._exon_ends, np.array(new_ends, dtype='int32')))
+        exon_order = np.lexsort((exon_starts, exon_tis))
+
+        self._exon_starts = exon_starts[exon_order]
+        self._exon_ends = exon_ends[exon_order]
+        self._exon_offsets = np.concatenate(([0], np.cumsum(np.bincount(exon_tis, minlength=len(self.tids)), dtype='int64')))
+
+    def merge_junctions(self):
+        # take each transcript's new junctions, or else its current ones
+        tx_junctions = []
+        for ti in range(len(self.tids)):
+            if ti in self.new_junctions:
+                tx_junctions.append(np.array(self.new_junctions[ti], dtype='int32'))
+            elif self._junctions is not None:
+                tx_junctions.append(self._junctions[self._junction_offsets[ti]:self._junction_offsets[ti+1]])
+            else:
+                tx_junctions.append(np.zeros(0, dtype='int32'))
+        self.new_junctions = {}
+
+        self._junctions = np.concatenate([np.zeros(0, dtype='int32')] + tx_junctions)
+        self._junction_offsets = np.concatenate(([0], np.cumsum([len(tj) for tj in tx_junctions], dtype='int64')))
+
+    def set_junctions(self):
+        # exon starts and the bp after each exon end
+        self.new_junctions = {}
+        self._junctions = np.empty(2*len(self.exon_starts), dtype='int32')
+        self._junctions[0::2] = self.exon_starts
+        self._junctions[1::2] = self.exon_ends + 1
+        self._junction_offsets = 2*self.exon_offsets
+
+    def set_tx_junctions(self, ti, junctions):
+        self.new_junctions[ti] = list(junctions)
+
+    def strand_code(self, strand):
+        if strand not in self.strands:
+            self.strands.append(strand)
+        return self.strands.index(strand)
 
 
 ################################################################################
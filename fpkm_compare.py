@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+from optparse import OptionParser
+import pdb
+import numpy as np
+from scipy.stats import pearsonr, spearmanr
+
+################################################################################
+# fpkm_compare.py
+#
+# Compare the transcript abundances in two isoforms.fpkm_tracking files, e.g.
+# to benchmark clip_peaks.py --em against Cufflinks on the same BAM and GTF.
+#
+# Prints the correlations of log2(FPKM+1), the median absolute log2 ratio, and
+# the fraction of expressed transcripts within 2-fold.
+################################################################################
+
+
+################################################################################
+# main
+################################################################################
+def main():
+    usage = 'usage: %prog [options] <fpkm_tracking1> <fpkm_tracking2>'
+    parser = OptionParser(usage)
+    parser.add_option('-m', dest='min_fpkm', type='float', default=1.0, help='Minimum FPKM in either file for a transcript to count as expressed [Default: %default]')
+    parser.add_option('-o', dest='output_table', help='Output table of the paired FPKMs')
+    (options,args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error(usage)
+    else:
+        fpkm1_file = args[0]
+        fpkm2_file = args[1]
+
+    fpkms1 = read_fpkms(fpkm1_file)
+    fpkms2 = read_fpkms(fpkm2_file)
+
+    tids = sorted(set(fpkms1) & set(fpkms2))
+    print '%d transcripts in both, %d only in %s, %d only in %s' % (len(tids), len(fpkms1)-len(tids), fpkm1_file, len(fpkms2)-len(tids), fpkm2_file)
+    if len(tids) < 2:
+        return
+
+    fpkm1 = np.array([fpkms1[tid] for tid in tids])
+    fpkm2 = np.array([fpkms2[tid] for tid in tids])
+
+    log1 = np.log2(fpkm1+1)
+    log2 = np.log2(fpkm2+1)
+    print 'Pearson log2(FPKM+1):  %.4f' % pearsonr(log1, log2)[0]
+    print 'Spearman FPKM:         %.4f' % spearmanr(fpkm1, fpkm2)[0]
+
+    expressed = (fpkm1 >= options.min_fpkm) | (fpkm2 >= options.min_fpkm)
+    if expressed.sum() > 0:
+        log_ratios = np.abs(log1[expressed] - log2[expressed])
+        print 'Expressed transcripts: %d' % expressed.sum()
+        print 'Median |log2 ratio|:   %.4f' % np.median(log_ratios)
+        print 'Within 2-fold:         %.4f' % (log_ratios <= 1).mean()
+
+    if options.output_table:
+        table_out = open(options.output_table, 'w')
+        for ti in range(len(tids)):
+            print >> table_out, '%s\t%g\t%g' % (tids[ti], fpkm1[ti], fpkm2[ti])
+        table_out.close()
+
+
+################################################################################
+# read_fpkms
+#
+# Input
+#  fpkm_file: isoforms.fpkm_tracking file.
+#
+# Output
+#  fpkms:     Hash mapping transcript_id's to FPKMs, excluding failures.
+################################################################################
+def read_fpkms(fpkm_file):
+    fpkms = {}
+
+    fpkm_in = open(fpkm_file)
+    line = fpkm_in.readline()
+    for line in fpkm_in:
+        a = line.split('\t')
+        if a[12].rstrip() != 'FAIL':
+            fpkms[a[0]] = float(a[9])
+    fpkm_in.close()
+
+    return fpkms
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+    main()
+    #pdb.runcall(main)
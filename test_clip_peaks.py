@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 from optparse import OptionParser
-import pdb, unittest
+from scipy.stats import poisson
+import json, math, os, pdb, random, shutil, tempfile, unittest
+import pysam
 import clip_peaks
 
 ################################################################################
@@ -10,15 +12,139 @@ import clip_peaks
 ################################################################################
 
 
+################################################################################
+# LabeledGene
+#
+# Gene that can also carry its exon/intron labels.
+################################################################################
+class LabeledGene(clip_peaks.Gene):
+    pass
+
+
+################################################################################
+# FakeRead
+#
+# Stand-in for a pysam AlignedRead with just a position and CIGAR.
+################################################################################
+class FakeRead:
+    def __init__(self, pos, cigar):
+        self.pos = pos
+        self.cigar = cigar
+
+
+################################################################################
+# TempDirTestCase
+#
+# Test case with a temporary directory and seeded random numbers, restoring
+# the clip_peaks globals that tests set after each test.
+################################################################################
+class TempDirTestCase(unittest.TestCase):
+    # clip_peaks globals that tests may set
+    test_globals = ['control_block_span', 'out_dir', 'peak_calling', 'print_filtered_peaks', 'verbose']
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        random.seed(1)
+        self.saved_globals = dict([(name, getattr(clip_peaks, name)) for name in self.test_globals])
+
+    def tearDown(self):
+        for name in self.saved_globals:
+            setattr(clip_peaks, name, self.saved_globals[name])
+        shutil.rmtree(self.tmp_dir)
+
+    ############################################################
+    # random_reads
+    #
+    # Input
+    #  chrom:  Chromosome.
+    #  starts: List of 0-based positions to start reads at.
+    #
+    # Output
+    #  reads:  List of write_bam read tuples with assorted CIGARs, strands,
+    #           and multimapping.
+    ############################################################
+    def random_reads(self, chrom, starts):
+        cigars = [[(0,30)], [(0,10),(3,200),(0,20)], [(0,5),(2,2),(0,20)], [(0,15),(1,1),(0,14)]]
+        reads = []
+        for pos in starts:
+            reads.append((chrom, pos, random.choice(cigars), random.random() < 0.5, random.random() < 0.3, random.choice([0,1,255]), random.choice([1,1,2,3]), random.choice(['+','-',None])))
+        return reads
+
+    ############################################################
+    # write_bam
+    #
+    # Write an indexed BAM of the given alignments to the temporary directory.
+    #
+    # Input
+    #  bam_name:   BAM file name.
+    #  references: List of (chrom, length) tuples.
+    #  reads:      List of (chrom, 0-based position, CIGAR tuples, reverse,
+    #               paired, mapq, NH, XS strand or None) tuples, optionally
+    #               followed by a template length that makes the read the
+    #               first of a proper pair.
+    #
+    # Output
+    #  bam_file:   BAM file path.
+    ############################################################
+    def write_bam(self, bam_name, references, reads):
+        bam_file = '%s/%s' % (self.tmp_dir, bam_name)
+        header = {'HD':{'VN':'1.0', 'SO':'coordinate'}, 'SQ':[{'SN':chrom, 'LN':length} for chrom, length in references]}
+        chrom_tids = dict([(references[ti][0],ti) for ti in range(len(references))])
+
+        bam_out = pysam.Samfile(bam_file, 'wb', header=header)
+        reads = sorted(reads, key=lambda read: (chrom_tids[read[0]], read[1]))
+        for ri in range(len(reads)):
+            chrom, pos, cigar, reverse, paired, mapq, nh, xs = reads[ri][:8]
+            aligned_read = pysam.AlignedRead()
+            aligned_read.qname = 'read%d' % ri
+            aligned_read.flag = 0x10*reverse + 0x41*paired
+            if len(reads[ri]) > 8:
+                aligned_read.flag |= 0x43
+                aligned_read.tlen = reads[ri][8]
+            aligned_read.tid = chrom_tids[chrom]
+            aligned_read.pos = pos
+            aligned_read.mapq = mapq
+            aligned_read.cigar = cigar
+            aligned_read.seq = 'A'*sum([length for op, length in cigar if op in [0,1,4]])
+            tags = [('NH',nh)]
+            if xs:
+                tags.append(('XS',xs))
+            aligned_read.tags = tags
+            bam_out.write(aligned_read)
+        bam_out.close()
+
+        pysam.index(bam_file)
+        return bam_file
+
+
+################################################################################
+# cached_sweep
+################################################################################
+class TestCachedSweep(unittest.TestCase):
+    def test1(self):
+        # cached genes come back in the order sweep_reads yields them
+        positions = {'index':{'g1':(0,1), 'g2':(1,3), 'g3':(3,3)},
+                     'positions':clip_peaks.np.array([150.0, 20.0, 30.0]),
+                     'weights':clip_peaks.np.array([1.0, 0.5, 1.0]),
+                     'multimap':clip_peaks.np.array([False, True, False])}
+        gene_ids = ['g1', 'g2', 'g3']
+        regions = [('chr2', 100, 200, '+'), ('chr1', 10, 40, '-'), ('chr1', 5, 8, '+')]
+
+        cached = list(clip_peaks.cached_sweep(positions, gene_ids, regions))
+        self.assertEqual([gi for gi, rpw in cached], clip_peaks.sweep_order(regions))
+        self.assertEqual([gi for gi, rpw in cached], [2, 1, 0])
+        self.assertEqual(cached[1][1], [(20.0, 0.5, True), (30.0, 1.0, False)])
+
+
 ################################################################################
 # convolute_lambda
 ################################################################################
 class TestConvoluteLambda(unittest.TestCase):
     def setUp(self):
-        self.isoform1 = clip_peaks.Gene('chr1', '+', {})
+        self.isoform1 = LabeledGene('chr1', '+', {})
         self.isoform1.fpkm = 1
 
-        self.pre_isoform1 = clip_peaks.Gene('chr1', '+', {})
+        self.pre_isoform1 = LabeledGene('chr1', '+', {})
         self.pre_isoform1.fpkm = 1
         self.pre_isoform1.junctions = []
 
@@ -157,7 +283,7 @@ class TestConvoluteLambda(unittest.TestCase):
         self.isoform1.labels = 'EEEIIIIIIEEIIIEEEEEE'
         self.isoform1.junctions = self.find_junctions(self.isoform1.labels)
 
-        self.isoform2 = clip_peaks.Gene('chr1', '+', {})
+        self.isoform2 = LabeledGene('chr1', '+', {})
         self.isoform2.fpkm = 3
         self.isoform2.labels = 'EEEIIIIIEEIIIIEEEEEE'
         self.isoform2.junctions = self.find_junctions(self.isoform2.labels)
@@ -180,7 +306,7 @@ class TestConvoluteLambda(unittest.TestCase):
         self.isoform1.labels = 'EEEEEEEEEE'
         self.isoform1.junctions = self.find_junctions(self.isoform1.labels)
 
-        self.isoform2 = clip_peaks.Gene('chr1', '+', {})
+        self.isoform2 = LabeledGene('chr1', '+', {})
         self.isoform2.fpkm = 3
         self.isoform2.labels = 'IIEEEEEEEE'
         self.isoform2.junctions = [3,11]
@@ -203,7 +329,7 @@ class TestConvoluteLambda(unittest.TestCase):
         self.isoform1.labels = 'EEEEEEEEEE'
         self.isoform1.junctions = self.find_junctions(self.isoform1.labels)
 
-        self.isoform2 = clip_peaks.Gene('chr1', '+', {})
+        self.isoform2 = LabeledGene('chr1', '+', {})
         self.isoform2.fpkm = 3
         self.isoform2.labels = 'EEEEEEEEII'
         self.isoform2.junctions = [1,9]
@@ -221,6 +347,732 @@ class TestConvoluteLambda(unittest.TestCase):
             self.assertTrue(abs(true_lambda[i] - code_lambda[i]) < 1e-9)
 
 
+################################################################################
+# count_windows
+################################################################################
+class TestCountWindows(unittest.TestCase):
+    def setUp(self):
+        self.window_size = 4
+        self.total_reads = 100
+        self.txome_size = 1000
+
+        self.tx = clip_peaks.Gene('chr1','+',{'gene_id':'gene1'})
+        self.tx.add_exon(1,20)
+        self.tx.fpkm = 1
+        self.gene_transcripts = {'tx':self.tx}
+        clip_peaks.set_transcript_junctions(self.gene_transcripts)
+
+    ############################################################
+    # compute_true_counts
+    #
+    # Count reads window by window.
+    ############################################################
+    def compute_true_counts(self, read_pos_weights, first_window_start, last_window_start):
+        true_counts = []
+        for window_start in range(first_window_start, last_window_start+1):
+            window_end = window_start + self.window_size - 1
+            window_count_float = sum([w for (pos,w,mm) in read_pos_weights if window_start <= pos <= window_end])
+            true_counts.append(int(window_count_float + 0.5))
+        return true_counts
+
+    def test1(self):
+        # unique, paired, and multimapping weights, including sixths summing to halves
+        read_pos_weights = [(3,1.0,False), (5,1.0/3,True), (5.5,1.0/6,True), (6,0.5,False), (7,1.0/6,True), (7,1.0/6,True), (8,1.0,False), (9,1.0/3,True), (12,0.0,False), (13,1.0,False)]
+
+        window_stats = clip_peaks.count_windows(None, self.window_size, read_pos_weights, self.gene_transcripts, 1, 20, self.total_reads, self.txome_size, 0.05, None)
+
+        # windows start at the 3rd read and stop at the last
+        true_counts = [0]*(5-self.window_size+1-1) + self.compute_true_counts(read_pos_weights, 5-self.window_size+1, 13)
+        code_counts = [c for (c,p) in window_stats]
+
+        self.assertEqual(true_counts, code_counts)
+
+    def test2(self):
+        # too few reads to test
+        read_pos_weights = [(3,1.0,False), (5,1.0,False)]
+        window_stats = clip_peaks.count_windows(None, self.window_size, read_pos_weights, self.gene_transcripts, 1, 20, self.total_reads, self.txome_size, 0.05, None)
+        self.assertEqual(window_stats, [])
+
+    def test3(self):
+        # shared tracks across window sizes and p-values
+        read_pos_weights = [(3,1.0,False), (4,1.0,False), (5,0.5,False), (6,1.0,False), (7,1.0,True), (8,1.0,False), (11,1.0,False), (13,0.5,False), (14,1.0,False)]
+        tracks = clip_peaks.gene_tracks(read_pos_weights, self.gene_transcripts, 1, 20)
+
+        for window_size in [3, 4, 6]:
+            for sig_p in [0.05, 0.5]:
+                true_stats = clip_peaks.count_windows(None, window_size, read_pos_weights, self.gene_transcripts, 1, 20, self.total_reads, self.txome_size, sig_p, None)
+                code_stats = clip_peaks.count_windows(None, window_size, read_pos_weights, self.gene_transcripts, 1, 20, self.total_reads, self.txome_size, sig_p, None, tracks)
+                self.assertEqual(true_stats, code_stats)
+
+
+################################################################################
+# estimate_abundances
+################################################################################
+class TestAbundances(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+
+        # T0 has exons 101-200 and 301-400; T1 extends its first exon to 250
+        self.tx_exons = [[(101,200), (301,400)], [(101,250), (301,400)], [(1001,1100)]]
+        self.chrom_indexes = clip_peaks.exon_index(['chr1','chr1','chr2'], self.tx_exons)
+
+    def test1(self):
+        # 20M 100N 30M with a 2 bp deletion
+        aligned_read = FakeRead(179, [(0,20), (3,100), (0,10), (2,2), (0,18)])
+        self.assertEqual(clip_peaks.cigar_blocks(aligned_read), [(180,199), (300,329)])
+
+    def test2(self):
+        chr1_index = self.chrom_indexes['chr1']
+        self.assertEqual(clip_peaks.compatible_transcripts([(150,180)], chr1_index, self.tx_exons), (0,1))
+        self.assertEqual(clip_peaks.compatible_transcripts([(190,220)], chr1_index, self.tx_exons), (1,))
+        self.assertEqual(clip_peaks.compatible_transcripts([(181,200), (301,330)], chr1_index, self.tx_exons), (0,))
+        self.assertEqual(clip_peaks.compatible_transcripts([(231,250), (301,330)], chr1_index, self.tx_exons), (1,))
+        self.assertEqual(clip_peaks.compatible_transcripts([(181,200), (311,330)], chr1_index, self.tx_exons), ())
+        self.assertEqual(clip_peaks.compatible_transcripts([(381,420)], chr1_index, self.tx_exons), ())
+
+    def test3(self):
+        # shared fragments split 3:1, as the unique fragments
+        tx_counts, iterations = clip_peaks.em_abundances([(0,), (1,), (0,1)], clip_peaks.np.array([30.0, 10.0, 40.0]), clip_peaks.np.array([100.0, 100.0, 50.0]))
+        self.assertAlmostEqual(tx_counts[0], 60.0, places=2)
+        self.assertAlmostEqual(tx_counts[1], 20.0, places=2)
+        self.assertEqual(tx_counts[2], 0)
+
+    def test4(self):
+        tables = {'Cufflinks': ['tracking_id\tclass_code\tnearest_ref_id\tgene_id\tgene_short_name\ttss_id\tlocus\tlength\tcoverage\tFPKM\tFPKM_conf_lo\tFPKM_conf_hi\tFPKM_status',
+                                'T0\t-\t-\tG0\t-\t-\t-\t200\t0\t250\t0\t0\tOK', 'T1\t-\t-\tG0\t-\t-\t-\t300\t0\t750\t0\t0\tFAIL'],
+                  'RSEM': ['transcript_id\tgene_id\tlength\teffective_length\texpected_count\tTPM\tFPKM\tIsoPct',
+                           'T0\tG0\t200\t100\t10\t250000\t250\t25', 'T1\tG0\t300\t200\t60\t750000\t750\t75'],
+                  'Salmon': ['Name\tLength\tEffectiveLength\tTPM\tNumReads', 'T0\t200\t100\t250000\t10', 'T1\t300\t200\t750000\t60', 'T2\t20\t0\t0\t0'],
+                  'kallisto': ['target_id\tlength\teff_length\test_counts\ttpm', 'T0\t200\t100\t10\t250000', 'T1\t300\t200\t60\t750000']}
+
+        for abundance_format in tables:
+            abundance_file = '%s/%s.txt' % (self.tmp_dir, abundance_format)
+            abundance_out = open(abundance_file, 'w')
+            print >> abundance_out, '\n'.join(tables[abundance_format])
+            abundance_out.close()
+
+            table_format, tx_fpkms = clip_peaks.read_abundances(abundance_file)
+            self.assertEqual(table_format, abundance_format)
+            if abundance_format == 'Cufflinks':
+                self.assertEqual(tx_fpkms, {'T0':250, 'T1':None})
+            elif abundance_format == 'RSEM':
+                self.assertEqual(tx_fpkms, {'T0':250, 'T1':750})
+            else:
+                # FPKM from fragments per effective bp, of 70 fragments in all
+                self.assertAlmostEqual(tx_fpkms['T0'], 1e9*10/100/70)
+                self.assertAlmostEqual(tx_fpkms['T1'], 1e9*60/200/70)
+                if abundance_format == 'Salmon':
+                    self.assertEqual(tx_fpkms['T2'], 0)
+
+    def test5(self):
+        # T0 spliced on +, and T1 and T2 sharing a span on - and +
+        ref_gtf = '%s/ref.gtf' % self.tmp_dir
+        gtf_out = open(ref_gtf, 'w')
+        for tid, strand, exons in [('T0','+',[(101,200),(301,400)]), ('T1','-',[(1001,1400)]), ('T2','+',[(1001,1400)])]:
+            for start, end in exons:
+                print >> gtf_out, 'chr1\ttest\texon\t%d\t%d\t.\t%s\t.\tgene_id "G%s"; transcript_id "%s";' % (start,end,strand,tid[1],tid)
+        gtf_out.close()
+
+        # proper pairs in T0 with median insert 220, and unpaired reads in
+        # T1/T2 with 20 on -, 10 on +, and 10 without a strand
+        reads = [('chr1', 109+i, [(0,30)], False, True, 255, 1, None, tlen) for i, tlen in enumerate([200,-210,220,230,400])]
+        for ri, xs in enumerate(['-']*20 + ['+']*10 + [None]*10):
+            reads.append(('chr1', 1050+8*ri, [(0,30)], ri % 2 == 0, False, 255, 1, xs))
+        bam_file = self.write_bam('reads.bam', [('chr1',2000)], reads)
+
+        for stranded, true_ratio in [(True, 2.0), (False, 1.0)]:
+            clip_peaks.estimate_abundances(bam_file, ref_gtf, 30.0, stranded, True, self.tmp_dir)
+            table_format, tx_fpkms = clip_peaks.read_abundances('%s/isoforms.fpkm_tracking' % self.tmp_dir)
+            self.assertAlmostEqual(tx_fpkms['T1']/tx_fpkms['T2'], true_ratio, places=3)
+
+            # 2.5 fragments across T0's 200 bp at the median insert
+            fpkm_lines = open('%s/isoforms.fpkm_tracking' % self.tmp_dir).readlines()[1:]
+            coverage = dict([(line.split('\t')[0], float(line.split('\t')[8])) for line in fpkm_lines])
+            self.assertAlmostEqual(coverage['T0'], 2.5*220/200, places=3)
+
+
+################################################################################
+# estimate_overdispersion
+#
+# Compare the regression over overdispersion_stats to the original, which
+# fetched each gene from both BAMs and walked its windows.
+################################################################################
+class TestEstimateOverdispersion(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.window_size = 50
+        self.norm_factor = 0.7
+
+        # nested, overlapping, short, and distant genes
+        self.regions = [('chr1', 1000, 3000, '+'), ('chr1', 1500, 2200, '-'), ('chr1', 2900, 5000, '*'),
+                        ('chr1', 6000, 6040, '+'), ('chr1', 20000, 24000, '-'), ('chr2', 100, 1500, '+')]
+
+        # control reads spread evenly, and CLIP reads piled in hotspots
+        control_starts = [random.randint(0,25000) for ri in range(3000)]
+        hotspots = [random.randint(1000,24000) for hi in range(30)]
+        clip_starts = [random.randint(0,25000) for ri in range(1000)] + [h+random.randint(-40,40) for h in hotspots for ri in range(50)]
+
+        self.clip_bam = self.write_bam('clip.bam', [('chr1',30000), ('chr2',2000)], self.random_reads('chr1', clip_starts) + self.random_reads('chr2', [random.randint(0,1400) for ri in range(300)]))
+        self.control_bam = self.write_bam('control.bam', [('chr1',30000), ('chr2',2000)], self.random_reads('chr1', control_starts) + self.random_reads('chr2', [random.randint(0,1400) for ri in range(100)]))
+
+        clip_peaks.out_dir = self.tmp_dir
+
+    ############################################################
+    # two_fetch_overdispersion
+    #
+    # Estimate overdispersion as the original did.
+    ############################################################
+    def two_fetch_overdispersion(self):
+        clip_in = pysam.Samfile(self.clip_bam, 'rb')
+        control_in = pysam.Samfile(self.control_bam, 'rb')
+
+        window_means = []
+        window_variances = []
+        for gchrom, gstart, gend, gstrand in self.regions:
+            clip_read_pos_weights = clip_peaks.position_reads(clip_in, gchrom, gstart, gend, gstrand)
+            control_read_pos_weights = clip_peaks.position_reads(control_in, gchrom, gstart, gend, gstrand)
+
+            window_start = gstart
+            while window_start + self.window_size < gend:
+                window_end = window_start + self.window_size
+                clip_frags = sum([w for (pos,w,mm) in clip_read_pos_weights if window_start <= pos <= window_end])
+                control_frags = sum([w for (pos,w,mm) in control_read_pos_weights if window_start <= pos <= window_end])
+                control_frags *= self.norm_factor
+
+                window_means.append(0.5*clip_frags + 0.5*control_frags)
+                window_variances.append((clip_frags - window_means[-1])**2 + (control_frags - window_means[-1])**2)
+
+                window_start += self.window_size
+
+        clip_in.close()
+        control_in.close()
+
+        u = clip_peaks.np.array(window_means)
+        var = clip_peaks.np.array(window_variances)
+        return max(0, sum(u*var - u**2) / sum(u**3)), u, var
+
+    ############################################################
+    # gene_od_stats
+    #
+    # Compute each gene's overdispersion_stats from its own fetches.
+    ############################################################
+    def gene_od_stats(self):
+        clip_in = pysam.Samfile(self.clip_bam, 'rb')
+        control_in = pysam.Samfile(self.control_bam, 'rb')
+        gene_od_stats = []
+        for gchrom, gstart, gend, gstrand in self.regions:
+            clip_read_pos_weights = clip_peaks.position_reads(clip_in, gchrom, gstart, gend, gstrand)
+            control_read_pos_weights = clip_peaks.position_reads(control_in, gchrom, gstart, gend, gstrand)
+            gene_od_stats.append(clip_peaks.overdispersion_stats(clip_read_pos_weights, control_read_pos_weights, gstart, gend, self.window_size, self.norm_factor))
+        clip_in.close()
+        control_in.close()
+        return gene_od_stats
+
+    def test1(self):
+        true_od, true_u, true_var = self.two_fetch_overdispersion()
+        self.assertTrue(true_od > 0)
+        self.assertAlmostEqual(clip_peaks.estimate_overdispersion(self.gene_od_stats()), true_od, places=9)
+
+    def test_verbose(self):
+        # the window means and variances print in the same order
+        clip_peaks.verbose = True
+        true_od, true_u, true_var = self.two_fetch_overdispersion()
+        self.assertAlmostEqual(clip_peaks.estimate_overdispersion(self.gene_od_stats()), true_od, places=9)
+
+        # summing by cumulative weights may round the last printed digit
+        mv_lines = open('%s/overdispersion.txt' % self.tmp_dir).readlines()
+        self.assertEqual(len(mv_lines), len(true_u))
+        for i in range(len(true_u)):
+            u, var = [float(x) for x in mv_lines[i].split('\t')]
+            self.assertAlmostEqual(u, true_u[i], places=5)
+            self.assertAlmostEqual(var, true_var[i], places=5)
+
+
+################################################################################
+# filter_peaks_control
+#
+# Compare the blocked control counts to each peak's own position_reads.
+################################################################################
+class TestFilterPeaksControl(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.fuzz = 5
+
+        # overlapping and distant peaks, and a chromosome the BAM lacks
+        self.peak_tuples = []
+        for pi in range(150):
+            start = random.randint(1000,60000)
+            self.peak_tuples.append(('chr1', start, start+random.randint(0,100), random.choice('+-*'), 'g1', 10.0, 0.0, 0.001))
+        for pi in range(10):
+            start = random.randint(300,800)
+            self.peak_tuples.append(('chr2', start, start+random.randint(0,100), random.choice('+-*'), 'g2', 10.0, 0.0, 0.001))
+        self.peak_tuples.append(('chr3', 100, 200, '+', 'g3', 10.0, 0.0, 0.001))
+
+        # random reads, plus reads ending and starting at each fuzzed edge
+        starts = {'chr1':[random.randint(0,61000) for ri in range(3000)], 'chr2':[random.randint(0,900) for ri in range(200)]}
+        for chrom, start, end, strand, gene_id, frags, mm_frac, scan_p in self.peak_tuples[:-1]:
+            fuzz_start = start - self.fuzz
+            fuzz_end = end + self.fuzz
+            starts[chrom] += [fuzz_start+d for d in [-231,-230,-229,-31,-30,-29,-26,-25,-24,-1,0]]
+            starts[chrom] += [fuzz_end-2, fuzz_end-1, fuzz_end]
+        reads = self.random_reads('chr1', starts['chr1']) + self.random_reads('chr2', starts['chr2'])
+
+        self.bam_file = self.write_bam('control.bam', [('chr1',100000), ('chr2',2000)], reads)
+
+    def test1(self):
+        # each peak's own fetch, as before blocking
+        bam_in = pysam.Samfile(self.bam_file, 'rb')
+        true_frags = []
+        for chrom, start, end, strand, gene_id, frags, mm_frac, scan_p in self.peak_tuples:
+            read_pos_weights = clip_peaks.position_reads(bam_in, chrom, start-self.fuzz, end+self.fuzz, strand)
+            control_frags = sum([w for (pos,w,mm) in read_pos_weights if start-self.fuzz <= pos <= end+self.fuzz])
+            if control_frags > 0:
+                peak_length = end - start + 1
+                true_frags.append(max(0.1, control_frags * float(peak_length) / (peak_length + 2*self.fuzz)))
+            else:
+                true_frags.append(0.1)
+        bam_in.close()
+
+        # with default blocks, and blocks capped below the peak spacing
+        for block_span in [clip_peaks.control_block_span, 150]:
+            clip_peaks.control_block_span = block_span
+            peak_table = clip_peaks.filter_peaks_control(clip_peaks.PeakTable.build(self.peak_tuples), 1.0, 0, self.bam_file, 1.0)
+            self.assertEqual(len(peak_table), len(self.peak_tuples))
+            for pi in range(len(self.peak_tuples)):
+                self.assertAlmostEqual(peak_table.peaks['control_frags'][pi], true_frags[pi], places=9)
+
+
+################################################################################
+# filter_peaks_ignore
+#
+# Expected overlaps are those of intersectBed -wo on the fuzzed BED.
+################################################################################
+class TestFilterPeaksIgnore(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.ignore_bed = '%s/ignore.bed' % self.tmp_dir
+
+        # fuzzed to 1-based chr1 138-173, chr1 98-203, chr2 2-13, chr3 98-203
+        ignore_out = open(self.ignore_bed, 'w')
+        print >> ignore_out, 'chr1\t140\t170'
+        print >> ignore_out, 'chr1\t100\t200'
+        print >> ignore_out, 'chr2\t1\t10'
+        print >> ignore_out, 'chr3\t100\t200\trepeat\t0\t+'
+        ignore_out.close()
+
+        # (chrom, start, end, strand, overlaps)
+        self.peaks = [('chr1',80,97,'+',[]), ('chr1',80,98,'-',[(1,1)]),
+                      ('chr1',204,220,'+',[]), ('chr1',203,220,'*',[(1,1)]),
+                      ('chr1',150,160,'-',[(0,11),(1,11)]),
+                      ('chr2',1,1,'+',[]), ('chr2',1,2,'+',[(2,1)]),
+                      ('chr3',150,150,'-',[(3,1)]), ('chr3',150,150,'+',[(3,1)]),
+                      ('chr4',150,160,'+',[])]
+        self.peak_table = clip_peaks.PeakTable.build([(chrom,start,end,strand,'g1',10.0,0.0,0.001) for chrom, start, end, strand, overlaps in self.peaks])
+
+        clip_peaks.out_dir = self.tmp_dir
+
+    def test1(self):
+        kept = clip_peaks.filter_peaks_ignore(self.peak_table, self.ignore_bed)
+        self.assertEqual(kept.regions(), [p[:4] for p in self.peaks if not p[4]])
+        self.assertFalse(os.path.isfile('%s/filtered_peaks_ignore.gff' % self.tmp_dir))
+
+    def test_debug(self):
+        clip_peaks.print_filtered_peaks = True
+        kept = clip_peaks.filter_peaks_ignore(self.peak_table, self.ignore_bed, '_s1')
+        self.assertEqual(kept.regions(), [p[:4] for p in self.peaks if not p[4]])
+
+        fuzz_lines = ['chr1\t137\t173', 'chr1\t97\t203', 'chr2\t1\t13', 'chr3\t97\t203\trepeat\t0\t+']
+        ignored_pi = [pi for pi in range(len(self.peaks)) if self.peaks[pi][4]]
+        ignored_gff = self.peak_table.subset(ignored_pi).gff_lines()
+        true_lines = []
+        for pi, peak_gff in zip(ignored_pi, ignored_gff):
+            for li, overlap in self.peaks[pi][4]:
+                true_lines.append('%s\t%s\t%d\n' % (peak_gff, fuzz_lines[li], overlap))
+        self.assertEqual(open('%s/filtered_peaks_ignore_s1.gff' % self.tmp_dir).readlines(), true_lines)
+
+
+################################################################################
+# journal_gene
+################################################################################
+class TestJournal(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.journal_dir = '%s/journal' % self.tmp_dir
+        self.manifest = {'version':clip_peaks.journal_version, 'window_sizes':[50], 'p_vals':[0.001]}
+
+    def test1(self):
+        clip_peaks.start_journal(self.journal_dir, self.manifest)
+
+        peak_tuples = [('chr1', clip_peaks.np.int64(101), 180, '+', 'g1', 12.5, 0.0, 1.0/3)]
+        od_stats = (1.5, 2.0, 3.25, clip_peaks.np.array([0.5,1.0]), clip_peaks.np.array([0.0,0.25]))
+        journal_out = open('%s/genes.1.jsonl' % self.journal_dir, 'a')
+        clip_peaks.journal_gene(journal_out, 'g1', ([peak_tuples], 0, 0, 2.5, od_stats))
+        clip_peaks.journal_gene(journal_out, 'g2,g3', ([[]], 0, 0, 0.5, None))
+        journal_out.write('["g4", [[')
+        journal_out.close()
+
+        journal_results = clip_peaks.load_journal(self.journal_dir, self.manifest)
+        self.assertEqual(sorted(journal_results.keys()), ['g1','g2,g3'])
+        self.assertEqual(journal_results['g1'][0], [peak_tuples])
+        self.assertEqual(journal_results['g1'][4], [1.5, 2.0, 3.25, [0.5,1.0], [0.0,0.25]])
+        self.assertEqual(journal_results['g2,g3'], ([[]], 0, 0, 0.5, None))
+
+        # a changed option invalidates the journal
+        self.manifest['p_vals'] = [0.01]
+        self.assertEqual(clip_peaks.load_journal(self.journal_dir, self.manifest), None)
+
+
+################################################################################
+# merged_g2t
+#
+# Expected clusters are those of the intersectBed version.
+################################################################################
+class TestMergedG2t(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.ref_gtf = '%s/ref.gtf' % self.tmp_dir
+
+        # gA-gB-gC chain, gC touching gB, gD 1 bp past gC, gF nested in gE's
+        # intron, gG antisense to gD, and gI/gJ antisense with equal spans
+        genes = [('chr1','+','gA',[(100,150),(180,200)]), ('chr1','+','gB',[(150,300)]), ('chr1','+','gC',[(300,400)]), ('chr1','+','gD',[(401,500)]), ('chr1','+','gE',[(1000,1100),(1900,2000)]), ('chr1','+','gF',[(1200,1300)]), ('chr1','-','gG',[(450,600)]), ('chr1','-','gH',[(5000,6000)]), ('chr2','+','gI',[(100,200)]), ('chr2','-','gJ',[(100,200)])]
+
+        gtf_out = open(self.ref_gtf, 'w')
+        for chrom, strand, gid, exons in genes:
+            # gA and gE get a second, single exon transcript
+            for ti in range(1+(gid in ['gA','gE'])):
+                for (start,end) in exons[:len(exons)-ti]:
+                    print >> gtf_out, '%s\ttest\texon\t%d\t%d\t.\t%s\t.\tgene_id "%s"; transcript_id "%s.%d";' % (chrom,start,end,strand,gid,gid,ti)
+        gtf_out.close()
+
+    ############################################################
+    # g2t_lists
+    #
+    # Sort g2t's transcript_ids for comparison.
+    ############################################################
+    def g2t_lists(self, g2t):
+        return dict([(gene_key, sorted(g2t[gene_key])) for gene_key in g2t])
+
+    def test_stranded(self):
+        g2t, antisense_clusters = clip_peaks.merged_g2t(self.ref_gtf, False)
+
+        self.assertEqual(self.g2t_lists(g2t), {'gA,gB,gC':['gA.0','gA.1','gB.0','gC.0'], 'gD':['gD.0'], 'gE,gF':['gE.0','gE.1','gF.0'], 'gG':['gG.0'], 'gH':['gH.0'], 'gI':['gI.0'], 'gJ':['gJ.0']})
+        self.assertEqual(set(antisense_clusters), set())
+
+    def test_unstranded(self):
+        g2t, antisense_clusters = clip_peaks.merged_g2t(self.ref_gtf, True)
+
+        self.assertEqual(self.g2t_lists(g2t), {'gA,gB,gC':['gA.0','gA.1','gB.0','gC.0'], 'gD,gG':['gD.0','gG.0'], 'gE,gF':['gE.0','gE.1','gF.0'], 'gH':['gH.0'], 'gI,gJ':['gI.0','gJ.0']})
+        self.assertEqual(set(antisense_clusters), set(['gD,gG','gI,gJ']))
+
+
+################################################################################
+# position_reads_chunk
+################################################################################
+class TestPositionReadsChunk(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+
+        tx = clip_peaks.Gene('chr1', '+', {'gene_id':'g1', 'transcript_id':'t1'})
+        tx.add_exon(1001, 3000)
+        clip_peaks.peak_calling = {'g2t':{'g1':['t1']}, 'transcripts':{'t1':tx}}
+        self.bounds = [None, 1500, 1501, 2000, None]
+
+        # random reads, plus reads with long insertions that position them
+        # past their alignment's end, starting around each chunk boundary
+        starts = [random.randint(950,3050) for ri in range(1000)]
+        reads = self.random_reads('chr1', starts)
+        for bound in [1001, 1500, 1501, 2000, 3000]:
+            for pos in range(bound-60, bound+5):
+                reads.append(('chr1', pos-1, [(0,5),(1,40),(0,5)], False, True, 1, 1, '+'))
+                reads.append(('chr1', pos-1, [(0,5),(1,20),(0,40)], False, False, 1, 1, '+'))
+
+        self.bam_file = self.write_bam('reads.bam', [('chr1',10000)], reads)
+
+    def test1(self):
+        bam_in = pysam.Samfile(self.bam_file, 'rb')
+        for mapq_zero in [False, True]:
+            read_pos_weights = clip_peaks.position_reads(bam_in, 'chr1', 1001, 3000, '+', mapq_zero)
+
+            chunks_read_pos_weights = []
+            for ci in range(len(self.bounds)-1):
+                chunks_read_pos_weights += clip_peaks.position_reads_chunk(self.bam_file, 'g1', self.bounds[ci], self.bounds[ci+1], mapq_zero)
+            chunks_read_pos_weights.sort()
+
+            self.assertEqual(chunks_read_pos_weights, read_pos_weights)
+        bam_in.close()
+
+
+################################################################################
+# preflight_bam
+################################################################################
+class TestPreflight(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.reads = self.random_reads('chr1', [random.randint(0,9000) for ri in range(500)])
+        self.bam_file = self.write_bam('reads.bam', [('chr1',10000)], self.reads)
+
+        self.ref_gtf = '%s/ref.gtf' % self.tmp_dir
+        self.transcripts_gtf = '%s/transcripts.gtf' % self.tmp_dir
+        self.write_gtf([(101,2000), (3001,4000)])
+
+    ############################################################
+    # write_gtf
+    #
+    # Write ref_gtf with the given exons, and a gene line.
+    ############################################################
+    def write_gtf(self, exons):
+        gtf_out = open(self.ref_gtf, 'w')
+        print >> gtf_out, 'chr1\ttest\tgene\t1\t9000\t.\t+\t.\tgene_id "g1";'
+        for start, end in exons:
+            print >> gtf_out, 'chr1\ttest\texon\t%d\t%d\t.\t+\t.\tgene_id "g1"; transcript_id "t1";' % (start,end)
+        gtf_out.close()
+
+    def test1(self):
+        # an identical rewrite keeps transcripts.gtf, and the count hits
+        clip_peaks.write_exons_gtf(self.ref_gtf, self.transcripts_gtf)
+        os.utime(self.transcripts_gtf, (1000, 1000))
+        preflight = clip_peaks.preflight_bam(self.bam_file, self.transcripts_gtf)
+        self.assertTrue(0 < preflight['compatible_fragments'] < preflight['fragments'])
+
+        sidecar = json.load(open('%s.preflight.json' % self.bam_file))
+        for key in sidecar['compatible_gtfs']:
+            sidecar['compatible_gtfs'][key]['fragments'] = -1.0
+        json.dump(sidecar, open('%s.preflight.json' % self.bam_file, 'w'))
+
+        clip_peaks.write_exons_gtf(self.ref_gtf, self.transcripts_gtf)
+        self.assertEqual(os.stat(self.transcripts_gtf).st_mtime, 1000)
+        shutil.copy(self.transcripts_gtf, '%s/copy.gtf' % self.tmp_dir)
+        self.assertEqual(clip_peaks.preflight_bam(self.bam_file, '%s/copy.gtf' % self.tmp_dir)['compatible_fragments'], -1.0)
+
+    def test2(self):
+        # changed content recounts, dropping the stale count for that file
+        clip_peaks.write_exons_gtf(self.ref_gtf, self.transcripts_gtf)
+        first = clip_peaks.preflight_bam(self.bam_file, self.transcripts_gtf)['compatible_fragments']
+        clip_peaks.preflight_bam(self.bam_file, self.ref_gtf)
+
+        self.write_gtf([(101,2000)])
+        clip_peaks.write_exons_gtf(self.ref_gtf, self.transcripts_gtf)
+        self.assertTrue(clip_peaks.preflight_bam(self.bam_file, self.transcripts_gtf)['compatible_fragments'] < first)
+
+        sidecar = json.load(open('%s.preflight.json' % self.bam_file))
+        self.assertEqual(sorted([compatible['gtf'] for compatible in sidecar['compatible_gtfs'].values()]), [self.ref_gtf, self.transcripts_gtf])
+
+        # and without a GTF, the BAM stats are reused as they are
+        os.remove(self.ref_gtf)
+        preflight = clip_peaks.preflight_bam(self.bam_file)
+        self.assertEqual(len(preflight['compatible_gtfs']), 2)
+        read_lengths = [sum([length for op, length in read[2] if op in [0,1]]) for read in self.reads if read[5] > 0]
+        read_mean = float(sum(read_lengths)) / len(read_lengths)
+        read_sd = math.sqrt(sum([(rl-read_mean)**2 for rl in read_lengths]) / len(read_lengths))
+        self.assertEqual((preflight['read_length'], preflight['read_sd']), (int(read_mean+0.5), int(read_sd+0.5)))
+
+
+################################################################################
+# save_annotation
+################################################################################
+class TestAnnotationCache(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+
+        self.transcripts = {}
+        for tid, chrom, strand, gid, exons, fpkm in [('tx1','chr1','+','g1',[(1,20),(41,60)],1.5),
+                                                     ('tx2','chr1','+','g2',[(11,30)],0.25),
+                                                     ('tx3','chr2','*','g3',[(5,9),(20,25),(30,90)],1000000)]:
+            tx = clip_peaks.Gene(chrom, strand, {'gene_id':gid, 'transcript_id':tid})
+            for start, end in exons:
+                tx.add_exon(start, end)
+            tx.fpkm = fpkm
+            self.transcripts[tid] = tx
+        clip_peaks.set_transcript_junctions(self.transcripts)
+
+        self.g2t = {'g1,g2':set(['tx1','tx2']), 'g3':set(['tx3'])}
+
+    def test1(self):
+        annotation_dir = '%s/annotation' % self.tmp_dir
+        clip_peaks.save_annotation(annotation_dir, self.transcripts, self.g2t, {50:123, 25:148})
+        transcripts, g2t, txome_sizes = clip_peaks.load_annotation(annotation_dir)
+
+        self.assertEqual(txome_sizes, {50:123, 25:148})
+        self.assertEqual(g2t.keys(), self.g2t.keys())
+        for gene_id in self.g2t:
+            self.assertEqual(g2t[gene_id], list(self.g2t[gene_id]))
+
+        self.assertEqual(sorted(transcripts.keys()), sorted(self.transcripts.keys()))
+        for tid in self.transcripts:
+            tx = transcripts[tid]
+            true_tx = self.transcripts[tid]
+            self.assertEqual((tx.chrom, tx.strand, tx.kv, tx.fpkm, list(tx.junctions)), (true_tx.chrom, true_tx.strand, true_tx.kv, true_tx.fpkm, list(true_tx.junctions)))
+            self.assertEqual([(ex.start,ex.end) for ex in tx.exons], [(ex.start,ex.end) for ex in true_tx.exons])
+
+
+################################################################################
+# save_cluster_cache
+################################################################################
+class TestClusterCache(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.cache_file = '%s/clip_peaks_clusters.jsonl' % self.tmp_dir
+
+    def test1(self):
+        peak_tuples = [('chr1', 101, 180, '+', 'g1', 12.5, 0.0, 0.001)]
+        clip_peaks.save_cluster_cache(self.cache_file, {}, ['g1','g2'], ['k1','k2'], [([peak_tuples], 0, 0, 2.5, None), ([[]], 0, 0, 0.5, None)])
+
+        # a later run on g2 alone replaces its entry, keeping g1's
+        cluster_cache = clip_peaks.load_cluster_cache(self.cache_file)
+        clip_peaks.save_cluster_cache(self.cache_file, cluster_cache, ['g2'], ['k3'], [([[]], 0, 0, 1.5, None)])
+
+        cluster_cache = clip_peaks.load_cluster_cache(self.cache_file)
+        self.assertEqual(sorted(cluster_cache.keys()), ['k1','k3'])
+        self.assertEqual(cluster_cache['k1'], ('g1', ([peak_tuples], 0, 0, 2.5, None)))
+        self.assertEqual(cluster_cache['k3'], ('g2', ([[]], 0, 0, 1.5, None)))
+
+
+################################################################################
+# save_cufflinks_cache
+################################################################################
+class TestCufflinksCache(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.cache_dir = '%s/cache' % self.tmp_dir
+
+        # three Cufflinks runs of 100 bytes per file
+        self.cuff_dirs = []
+        for ci in range(3):
+            cuff_dir = '%s/cuff%d' % (self.tmp_dir, ci)
+            os.mkdir(cuff_dir)
+            for cuff_file in clip_peaks.cufflinks_cache_files:
+                open('%s/%s' % (cuff_dir,cuff_file), 'w').write(str(ci)*100)
+            self.cuff_dirs.append(cuff_dir)
+
+    def test1(self):
+        run_bytes = 100*len(clip_peaks.cufflinks_cache_files)
+        clip_peaks.save_cufflinks_cache(self.cache_dir, 'k0', self.cuff_dirs[0], 2*run_bytes)
+        clip_peaks.save_cufflinks_cache(self.cache_dir, 'k1', self.cuff_dirs[1], 2*run_bytes)
+        os.utime('%s/k0' % self.cache_dir, (1000, 1000))
+        os.utime('%s/k1' % self.cache_dir, (2000, 2000))
+
+        # using k0 makes k1 the least recently used
+        load_dir = '%s/load' % self.tmp_dir
+        os.mkdir(load_dir)
+        self.assertTrue(clip_peaks.load_cufflinks_cache(self.cache_dir, 'k0', load_dir))
+        self.assertEqual(open('%s/isoforms.fpkm_tracking' % load_dir).read(), '0'*100)
+
+        clip_peaks.save_cufflinks_cache(self.cache_dir, 'k2', self.cuff_dirs[2], 2*run_bytes)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['k0','k2'])
+        self.assertFalse(clip_peaks.load_cufflinks_cache(self.cache_dir, 'k1', load_dir))
+
+
+################################################################################
+# scan_stat_pvals
+################################################################################
+class TestScanStatPvals(unittest.TestCase):
+    def setUp(self):
+        self.window_size = 50
+        self.txome_size = 10000000
+
+    ############################################################
+    # compute_true_pval
+    #
+    # Approximation 3.3 via scipy's Poisson pmf.
+    ############################################################
+    def compute_true_pval(self, k, lambd):
+        L = float(self.txome_size)/self.window_size
+        psi = lambd*self.window_size
+        if k < psi:
+            return 1.0
+        else:
+            return 1.0 - math.exp(-(k-1.0)*(L-1.0)*poisson.pmf(k, psi))
+
+    def test1(self):
+        ks = [3, 3, 5, 12, 40, 3, 200, 3]
+        lambdas = [1e-4, 1e-4, 0.02, 0.3, 0.05, 1e-4*(1+1e-14), 2.0, 0.5]
+
+        code_pvals = clip_peaks.scan_stat_pvals(ks, self.window_size, self.txome_size, lambdas)
+
+        # again, from the cache
+        cache_pvals = clip_peaks.scan_stat_pvals(ks, self.window_size, self.txome_size, lambdas)
+
+        for i in range(len(ks)):
+            true_pval = self.compute_true_pval(ks[i], lambdas[i])
+            self.assertTrue(abs(true_pval - code_pvals[i]) <= 1e-9*true_pval)
+            self.assertEqual(code_pvals[i], cache_pvals[i])
+            self.assertEqual(code_pvals[i], clip_peaks.scan_stat_approx3(ks[i], self.window_size, self.txome_size, lambdas[i]))
+
+    def test2(self):
+        lambdas = [1e-6, 1e-4, 0.002, 0.02, 0.05, 0.3, 2.0, 10.0]
+        ks = range(0,1500)
+
+        for sig_p in [0.5, 0.05, 1e-6, 0.0]:
+            k_crit, k_lone = clip_peaks.scan_stat_critical(self.window_size, self.txome_size, lambdas, sig_p)
+            for li in range(len(lambdas)):
+                code_sig = [k > 2 and (k >= k_crit[li] or k == k_lone[li]) for k in ks]
+                true_sig = [k > 2 and self.compute_true_pval(k, lambdas[li]) < sig_p for k in ks]
+                self.assertEqual(true_sig, code_sig)
+
+
+################################################################################
+# sweep_reads
+################################################################################
+class TestSweepReads(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+
+        # nested, chained, empty, 1 bp, and distant regions, and a chromosome
+        # the BAM lacks
+        self.regions = [('chr1', 1000, 2000, '+'), ('chr1', 1500, 1800, '-'), ('chr1', 1900, 2500, '*'),
+                        ('chr1', 3000, 3000, '+'), ('chr1', 3100, 3101, '-'), ('chr1', 3200, 3202, '+'),
+                        ('chr1', 30000, 31000, '+'), ('chr1', 55000, 56000, '-'), ('chr1', 55500, 70000, '+'),
+                        ('chr2', 10, 500, '+'), ('chr3', 1, 100, '+')]
+
+        # random reads, plus reads starting and ending at each region's edges
+        starts = [random.randint(0,60000) for ri in range(2000)] + [random.randint(900,3300) for ri in range(400)]
+        for chrom, rstart, rend, rstrand in self.regions:
+            if chrom == 'chr1':
+                starts += [rstart-31, rstart-30, rstart-1, rstart, rend-2, rend-1, rend]
+        reads = self.random_reads('chr1', starts) + self.random_reads('chr2', [random.randint(0,600) for ri in range(100)])
+
+        self.bam_file = self.write_bam('reads.bam', [('chr1',100000), ('chr2',1000)], reads)
+
+    def test1(self):
+        bam_in = pysam.Samfile(self.bam_file, 'rb')
+        for mapq_zero in [False, True]:
+            swept = list(clip_peaks.sweep_reads(bam_in, self.regions, mapq_zero))
+            self.assertEqual([ri for ri, rpw in swept], clip_peaks.sweep_order(self.regions))
+
+            for ri, read_pos_weights in swept:
+                chrom, rstart, rend, rstrand = self.regions[ri]
+                if rend-1 < rstart:
+                    # fetch refuses an inverted region
+                    self.assertEqual(read_pos_weights, [])
+                else:
+                    self.assertEqual(read_pos_weights, clip_peaks.position_reads(bam_in, chrom, rstart, rend, rstrand, mapq_zero))
+        bam_in.close()
+
+    def test2(self):
+        # regions far apart fetch separately, and close ones together
+        bam_in = pysam.Samfile(self.bam_file, 'rb')
+        regions = [('chr1', 1000, 1100, '+'), ('chr1', 1100+clip_peaks.sweep_gap, 1200+clip_peaks.sweep_gap, '+'), ('chr1', 1201+2*clip_peaks.sweep_gap, 1300+2*clip_peaks.sweep_gap, '-')]
+        swept = dict(clip_peaks.sweep_reads(bam_in, regions))
+        for ri in range(len(regions)):
+            chrom, rstart, rend, rstrand = regions[ri]
+            self.assertEqual(swept[ri], clip_peaks.position_reads(bam_in, chrom, rstart, rend, rstrand))
+        bam_in.close()
+
+
+################################################################################
+# window_lambdas
+#
+# Rerun the convolute_lambda tests against the coverage track.
+################################################################################
+class TestWindowLambdas(TestConvoluteLambda):
+    ############################################################
+    # compute_code_lambdas
+    ############################################################
+    def compute_code_lambdas(self):
+        gene_len = len(self.isoform1.labels)
+        return list(clip_peaks.window_lambdas(self.gene_transcripts, 1, gene_len, self.window_size, self.total_reads))
+
+
 ################################################################################
 # windows2peaks
 ################################################################################
@@ -251,6 +1103,136 @@ class TestWindows2Peaks(unittest.TestCase):
             self.assertEqual(true_peaks[i],code_peaks[i])
 
 
+################################################################################
+# write_window_stats
+################################################################################
+class TestWindowStats(TempDirTestCase):
+    def test1(self):
+        # two clusters on chr1 and one on chr2
+        clusters = [('g1','chr1',101,400), ('g2,g3','chr1',351,900), ('g4','chr2',1,300)]
+
+        windows_out = open('%s/window_stats.bin' % self.tmp_dir, 'wb')
+        index_out = open('%s/window_stats.index' % self.tmp_dir, 'w')
+        true_windows = {}
+        for gene_id, chrom, start, end in clusters:
+            starts = range(start, end-49)
+            counts = [random.randint(0,20) for ws in starts]
+            pvals = [random.random() for ws in starts]
+            lambdas = [random.random() for ws in starts]
+            true_windows[gene_id] = zip(starts, counts, pvals, lambdas)
+
+            offset = windows_out.tell()
+            clip_peaks.write_window_stats(windows_out, clip_peaks.np.array(starts), clip_peaks.np.array(counts), clip_peaks.np.array(pvals), clip_peaks.np.array(lambdas))
+            print >> index_out, '%s\t%s\t%d\t%d\t%d\t%d' % (gene_id, chrom, start, end, offset, windows_out.tell()-offset)
+        windows_out.close()
+        index_out.close()
+
+        gene_windows = clip_peaks.read_window_stats('%s/window_stats' % self.tmp_dir, 'chr1', 300, 360)
+        self.assertEqual([gene_id for gene_id, windows in gene_windows], ['g1','g2,g3'])
+        for gene_id, windows in gene_windows:
+            true_region = [tw for tw in true_windows[gene_id] if 300 <= tw[0] <= 360]
+            self.assertEqual(windows.tolist(), true_region)
+
+
+################################################################################
+# PeakTable
+################################################################################
+class TestPeakTable(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+        self.peak_tuples = []
+        for i in range(200):
+            start = random.randint(1,100000)
+            scan_p = random.choice([0.0, 1.0, random.random(), 10**-random.uniform(0,300)])
+            self.peak_tuples.append((random.choice(['chr1','chr2']), start, start+random.randint(0,100), random.choice('+-*'), random.choice(['g1','g2,g3']), random.uniform(3,1000), random.random(), scan_p))
+
+    ############################################################
+    # gff_str
+    #
+    # Format a peak line by line.
+    ############################################################
+    def gff_str(self, peak_tuple, peak_id, control_frags, control_p):
+        chrom, start, end, strand, gene_id, frags, mm_frac, scan_p = peak_tuple
+        if control_p != None:
+            if control_p > 0:
+                peak_score = int(2000/math.pi*math.atan(-math.log(control_p,1000)))
+            else:
+                peak_score = 1000
+        elif scan_p > 0:
+            peak_score = int(2000/math.pi*math.atan(-math.log(scan_p,1000)))
+        else:
+            peak_score = 1000
+
+        cols = [chrom, 'clip_peaks', 'peak', str(start), str(end), str(peak_score), strand, '.', '']
+        if peak_id:
+            cols[-1] += 'id "PEAK%d"; ' % peak_id
+        cols[-1] += 'gene_id "%s"; fragments "%.1f"; scan_p "%.2e"; multimap_fraction "%.3f"' % (gene_id,frags,scan_p,mm_frac)
+        if control_frags != None:
+            cols[-1] += '; control_fragments "%.1f"' % control_frags
+        if control_p != None:
+            cols[-1] += '; control_p "%.2e"' % control_p
+
+        return '\t'.join(cols)
+
+    def test1(self):
+        # scan only, without ids
+        peak_table = clip_peaks.PeakTable.build(self.peak_tuples)
+        true_lines = [self.gff_str(pt, None, None, None) for pt in self.peak_tuples]
+        self.assertEqual(peak_table.gff_lines(), true_lines)
+
+    def test2(self):
+        # with control, with ids, after subsetting
+        peak_table = clip_peaks.PeakTable.build(self.peak_tuples)
+        control_frags = [random.uniform(0.1,100) for pt in self.peak_tuples]
+        control_p = [random.choice([0.0, 1.0, random.random(), 10**-random.uniform(0,300)]) for pt in self.peak_tuples]
+        peak_table.peaks['control_frags'] = control_frags
+        peak_table.peaks['control_p'] = control_p
+
+        keep = [i for i in range(len(self.peak_tuples)) if i % 3]
+        peak_table = peak_table.subset(keep)
+        true_lines = [self.gff_str(self.peak_tuples[i], ki+1, control_frags[i], control_p[i]) for ki, i in enumerate(keep)]
+        self.assertEqual(peak_table.gff_lines(ids=range(1,len(keep)+1)), true_lines)
+
+
+################################################################################
+# TranscriptTable
+################################################################################
+class TestTranscriptTable(unittest.TestCase):
+    def setUp(self):
+        self.table = clip_peaks.TranscriptTable.build([('t1', 'chr1', '+', 'g1', {'gene_id':'g1', 'transcript_id':'t1'}, [100], [200]),
+                                                       ('t2', 'chr2', '-', 'g2', 'gene_id "g2"; transcript_id "t2";', [], [])])
+        self.genes = self.table.genes()
+
+    def test1(self):
+        # added exons sort in after those starting at or before them
+        for start, end in [(300,400), (50,60), (100,150)]:
+            self.genes['t1'].add_exon(start, end)
+        self.genes['t2'].add_exon(10, 20)
+
+        self.assertEqual([(ex.start,ex.end) for ex in self.genes['t1'].exons], [(50,60), (100,200), (100,150), (300,400)])
+        self.assertEqual([(ex.start,ex.end) for ex in self.genes['t2'].exons], [(10,20)])
+        self.assertEqual(self.table.exon_offsets.tolist(), [0, 4, 5])
+        self.assertEqual((self.genes['t1'].start, self.genes['t1'].end), (50, 400))
+
+        # junctions set per transcript, then derived from the exons
+        self.genes['t2'].junctions = [11, 21]
+        self.assertEqual(list(self.genes['t1'].junctions), [])
+        self.assertEqual(list(self.genes['t2'].junctions), [11, 21])
+        self.table.set_junctions()
+        self.assertEqual(list(self.genes['t1'].junctions), [50, 61, 100, 201, 100, 151, 300, 401])
+        self.assertEqual(list(self.genes['t2'].junctions), [10, 21])
+
+    def test2(self):
+        # exons and kv are snapshots
+        self.assertTrue(isinstance(self.genes['t1'].exons, tuple))
+        for gene in self.genes.values():
+            kv = gene.kv
+            kv['gene_id'] = 'changed'
+            self.assertNotEqual(gene.kv['gene_id'], 'changed')
+
+        self.assertRaises(AttributeError, setattr, self.genes['t1'], 'labels', 'EEE')
+
+
 ################################################################################
 # __main__
 ################################################################################